@@ -56,6 +56,11 @@ export class Game extends events.EventEmitter {
     this.realm = null;
     this.me = null;
 
+    // Regions the server has sent, by realm ID and location, along with their
+    // etags. These outlive the realm (and the connection), so the server can
+    // skip sending regions that haven't changed.
+    this.regionCache = {};
+
     this.running = false;
 
     this.resources = new resources.Resources();
@@ -216,14 +221,28 @@ export class Game extends events.EventEmitter {
         return;
       }
 
+      var cached = this.getCachedRegion(this.realm.id, location);
+
       this.protocol.send(new packets.SightPacket({
-          location: location
+          location: location,
+          etag: cached !== null ? cached.etag : null
       }));
     });
 
     this.clientBounds = bounds;
   }
 
+  getCachedRegion(realmId, location) {
+    var key = [realmId, location.x, location.y].join(",");
+    return objects.hasOwnProp.call(this.regionCache, key) ?
+        this.regionCache[key] : null;
+  }
+
+  setCachedRegion(realmId, location, etag, message) {
+    var key = [realmId, location.x, location.y].join(",");
+    this.regionCache[key] = {etag: etag, message: message};
+  }
+
   onTransportOpen() {
     this.go();
   }
@@ -331,7 +350,8 @@ export class Game extends events.EventEmitter {
   go() {
     this.clientBounds = new geometry.Rectangle(0, 0, 0, 0);
     this.protocol.send(new packets.HelloPacket({
-        token: this.token || ""
+        token: this.token || "",
+        supportsBatching: true
     }));
 
     this.running = true;
@@ -47,8 +47,24 @@ export function install(game) {
       return;
     }
 
-    var region = new realm.Region(
-        geometry.Vector2.fromProtobuf(message.location), message.region);
+    var location = geometry.Vector2.fromProtobuf(message.location);
+    var regionMessage = message.region;
+
+    if (regionMessage === null) {
+      // The server omits regions we already have the current version of.
+      var cached = game.getCachedRegion(message.realmId, location);
+      if (cached === null || cached.etag !== message.etag) {
+        console.warn("Got no region for uncached region " + location.x + "," +
+                     location.y + ", discarding.");
+        return;
+      }
+      regionMessage = cached.message;
+    } else if (message.etag !== null) {
+      game.setCachedRegion(message.realmId, location, message.etag,
+                           regionMessage);
+    }
+
+    var region = new realm.Region(location, regionMessage);
     game.realm.addRegion(region);
   });
 
@@ -84,14 +100,11 @@ export function install(game) {
     var expectedLocation = geometry.Vector3.fromProtobuf(message.location);
 
     if (!targetLocation.equals(expectedLocation)) {
-      console.warn("Entity " + entity.id + " will not move into the correct " +
-                   "position. This is transient for large entities occupying " +
-                   "multiple regions. (" +
-                   "expected: " + expectedLocation.toString() + ", " +
-                   "actual: " + targetLocation.toString() + ", " +
-                   "original: " + entity.location.toString() +
-                   ")");
-      return;
+      // The server coalesces consecutive moves for slow connections, so we may
+      // be more than one step behind. Catch up to one step behind the expected
+      // location.
+      entity.location = expectedLocation.offset(
+          entity.getDirectionVector().negate());
     }
 
     entity.move();
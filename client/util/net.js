@@ -29,7 +29,16 @@ export class Transport extends events.EventEmitter {
 
     this.socket.onmessage = (e) => {
       this.currentRetryOperation = null;
-      this.emit("message", packets.Packet.decode(e.data));
+
+      var packet = packets.Packet.decode(e.data);
+
+      if (packet.type === packets.Packet.Type.BATCH) {
+        packets.PacketBatch.decode(packet.payload).packets.forEach((p) => {
+          this.emit("message", p);
+        });
+      } else {
+        this.emit("message", packet);
+      }
     };
   }
 
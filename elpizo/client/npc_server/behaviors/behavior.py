@@ -1,15 +1,7 @@
-import asyncio
-import networkx
+from elpizo.client.npc_server import pathfinding
 from elpizo.models import entities
 from elpizo.protos import packets_pb2
 from elpizo.util import geometry
-from elpizo.util import green
-
-
-def manhattan(a, b):
-  dx = abs(a.x - b.x)
-  dy = abs(a.y - b.y)
-  return dx + dy
 
 
 class PassabilityError(Exception):
@@ -21,11 +13,20 @@ class IncompletePathGraphError(Exception):
 
 
 class Behavior(object):
+  """
+  What an NPC does, updated by the server's behavior scheduler.
+  """
+
   REGISTRY = {}
 
+  # Seconds until the next update of a behavior with nothing to do.
+  IDLE_INTERVAL = 1
+
   def __init__(self, protocol, npc):
     self.protocol = protocol
     self.npc = npc
+    self.running = False
+    self.path_cache = pathfinding.PathCache()
 
   @classmethod
   def register(cls, subclass):
@@ -39,18 +40,13 @@ class Behavior(object):
   def stop(self):
     self.running = False
 
-  def run(self):
-    self.running = True
-
-    while self.running:
-      self.on_update()
-      self.be_nice()
-
   def on_update(self):
-    pass
+    """
+    Update the behavior. This must not block.
 
-  def be_nice(self):
-    self.sleep(0)
+    :returns: The number of seconds until the next update.
+    """
+    return self.IDLE_INTERVAL
 
   def turn(self, direction):
     self.npc.direction = direction
@@ -67,30 +63,42 @@ class Behavior(object):
     self.send(packets_pb2.StopMovePacket())
 
   def move_towards(self, target_location):
-    path = self.compute_path(target_location)
+    next = self.compute_next_location(target_location)
 
-    if len(path) == 1:
+    if next == self.npc.location:
       return
 
-    current, next, *_ = path
-    direction = entities.Entity.DIRECTIONS[next.offset(current.negate())]
+    direction = entities.Entity.DIRECTIONS[
+        next.offset(self.npc.location.negate())]
 
     if direction != self.npc.direction:
       self.turn(direction)
 
     self.move()
 
-  def compute_path(self, target_location):
+  def compute_next_location(self, target_location):
+    r = self.npc.realm
+    path_grid = r.path_grid
+
+    # NPCs near the same target share a flow field to it, and only find their
+    # own paths from further away.
     try:
-      return networkx.astar_path(self.npc.realm.path_graph, self.npc.location,
-                                 target_location, manhattan)
+      index = r.flow_fields.get_field(target_location).get_next_step(
+          self.npc.location.y * path_grid.width + self.npc.location.x)
+
+      if index is None:
+        index = self.path_cache.get_next_step(r.path_planner,
+                                              self.npc.location,
+                                              target_location)
     except KeyError:
       raise IncompletePathGraphError
-    except networkx.NetworkXNoPath:
+
+    if index is None:
       raise PassabilityError
 
-  def sleep(self, secs):
-    green.await_coro(asyncio.sleep(secs))
+    return geometry.Vector3(index % path_grid.width,
+                            index // path_grid.width,
+                            self.npc.location.z)
 
-  def wait_move(self, scale=1):
-    self.sleep(1 / self.npc.speed * scale)
+  def get_move_time(self, scale=1):
+    return 1 / self.npc.speed * scale
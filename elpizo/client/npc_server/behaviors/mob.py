@@ -1,11 +1,8 @@
-import asyncio
 import logging
 import random
 
 from elpizo.client.npc_server import behaviors
 from elpizo.models import entities
-from elpizo.util import geometry
-from elpizo.util import green
 
 logger = logging.getLogger(__name__)
 
@@ -16,10 +13,16 @@ class Pursue(behaviors.Behavior):
   def __init__(self, *args, **kwargs):
     super().__init__(*args, **kwargs)
     self.target_id = None
+    self.moving = False
 
   def on_update(self):
+    if self.moving:
+      self.moving = False
+      self.stop_move()
+      return 0
+
     if self.target_id is None:
-      return
+      return self.IDLE_INTERVAL
 
     target = self.server.store.entities.load(self.target_id)
 
@@ -27,29 +30,43 @@ class Pursue(behaviors.Behavior):
         entities.Entity.DIRECTION_VECTORS[target.direction].negate())
 
     if target_location == self.npc.location:
-      return
+      # The target can't get further away than a step in the meantime.
+      return self.get_move_time()
 
     try:
       self.move_towards(target_location)
     except behaviors.PassabilityError:
       logger.warn("No path to %r?", target_location)
+      return self.IDLE_INTERVAL
     except behaviors.IncompletePathGraphError:
       logger.warn("Sorry, path graph is incomplete.")
-    else:
-      self.wait_move(random.randint(10, 30) / 10.)
-      self.stop_move()
+      return self.IDLE_INTERVAL
+
+    self.moving = True
+    return self.get_move_time(random.randint(10, 30) / 10.)
 
 
 class Wander(behaviors.Behavior):
   NAME = "wander"
 
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.moving = False
+
   def on_update(self):
+    if self.moving:
+      self.moving = False
+      self.stop_move()
+      return 2
+
     direction = random.choice(list(entities.Entity.DIRECTION_VECTORS.keys()))
     self.turn(direction)
 
-    if self.npc.realm.path_graph.has_edge(
-      self.npc.location, self.npc.target_location):
+    if self.npc.realm.path_grid.can_move(self.npc.location, direction):
       self.move()
-      self.wait_move()
-      self.stop_move()
-      self.sleep(2)
+      self.moving = True
+      return self.get_move_time()
+
+    # Blocked, so look around again after a step's worth of time, rather than
+    # turning at every tick.
+    return self.get_move_time()
@@ -24,7 +24,8 @@ class Dispatcher(net.Protocol):
     logger.info("NPC server authorizing (I will crash if I fail).")
     self.send(None, packets_pb2.HelloPacket(
         token=self.server.mint.mint(".".join(["npc", self.server.id])
-            .encode("utf-8"))))
+            .encode("utf-8")),
+        supports_batching=True))
 
   def on_message(self, origin, message):
     type = message.DESCRIPTOR.GetOptions().Extensions[packets_pb2.packet_type]
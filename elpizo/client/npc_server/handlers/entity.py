@@ -53,7 +53,9 @@ def on_turn(protocol, entity, message):
 @with_entity
 def on_move(protocol, entity, message):
   if entity.id not in protocol.server.npcs:
-    entity.location = entity.target_location
+    # The server coalesces consecutive moves from the same entity, so this may
+    # be more than one step on from where we last saw it.
+    entity.location = geometry.Vector3.from_protobuf(message.location)
 
 
 @with_entity
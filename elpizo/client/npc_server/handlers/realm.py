@@ -1,19 +1,23 @@
 import logging
-import networkx
 import time
 
-from elpizo.models import entities
+from elpizo.client.npc_server import pathfinding
 from elpizo.models import realm
 from elpizo.models import geometry
-from elpizo.util import green
-from elpizo.util import record
 
 logger = logging.getLogger(__name__)
 
 
 def on_realm(protocol, origin, message):
   r = realm.Realm.from_protobuf(message.realm)
-  r.update(id=message.id, path_graph=networkx.DiGraph())
+  config = protocol.server.config
+
+  path_grid = pathfinding.PathGrid(r.size)
+  r.update(id=message.id, path_grid=path_grid,
+           path_planner=pathfinding.PathPlanner(path_grid),
+           flow_fields=pathfinding.FlowFields(path_grid,
+                                              config.flow_field_radius,
+                                              config.max_flow_fields))
   protocol.server.store.realms.add(r)
 
 
@@ -21,45 +25,18 @@ def on_region(protocol, origin, message):
   r = protocol.server.store.realms.load(message.realm_id)
   location = geometry.Vector2.from_protobuf(message.location)
 
-  try:
-    old_region = r.regions.load(location)
-  except KeyError:
-    pass
-  else:
-    # If we already have a region in the store, remove all its edges from the
-    # path graph.
-    r.path_graph.remove_edges_from(old_region.path_graph.edges())
-
   region = realm.Region.from_protobuf(message.region)
   region.location = location
-  region.update(entities=set(), path_graph=compute_path_graph(region))
+  region.update(entities=set())
   r.regions.add(region)
 
   start_time = time.monotonic()
 
-  r.path_graph.add_nodes_from(region.path_graph.nodes())
-  r.path_graph.add_edges_from(region.path_graph.edges())
+  # Any terrain the region had before is replaced, and only the clusters it
+  # affects are replanned.
+  r.path_grid.add_region(region)
+  r.path_planner.update_region(location)
 
   end_time = time.monotonic()
-  logger.info("Composed path graph for realm %s, %r in %.5fs.",
+  logger.info("Added region to path planner for realm %s, %r in %.5fs.",
               r.id, region.location, end_time - start_time)
-
-
-def compute_path_graph(region):
-  g = networkx.DiGraph()
-
-  for y in range(region.location.y - 1,
-                 region.location.y + realm.Region.SIZE + 1):
-    for x in range(region.location.x - 1,
-                   region.location.x + realm.Region.SIZE + 1):
-      origin = geometry.Vector2(x, y)
-
-      for direction, delta in entities.Entity.DIRECTION_VECTORS.items():
-        target = origin.offset(delta)
-        if region.is_terrain_passable_by(
-            None,
-            geometry.Rectangle(target.x, target.y, 1, 1),
-            direction):
-          g.add_edge(origin, target)
-
-  return g
@@ -1,10 +1,12 @@
 import asyncio
 import logging
+import statsd
 import uuid
 
 from elpizo import client
 from elpizo.client.npc_server import behaviors
 from elpizo.client.npc_server import handlers
+from elpizo.client.npc_server import scheduler
 from elpizo.client.npc_server import store
 from elpizo.client.npc_server.behaviors import registry
 from elpizo.util import green
@@ -19,6 +21,30 @@ def make_config_parser(*args, **kwargs):
   parser = client.make_config_parser(*args, **kwargs)
   parser.add_argument("--id", action="store", default=None,
                       help="The ID of the server.")
+  parser.add_argument("--behavior-tick-rate", action="store", default=20,
+                      type=float,
+                      help="Number of times per second to update the "
+                           "behaviors that are due.")
+  parser.add_argument("--behavior-tick-budget", action="store", default=0.02,
+                      type=float,
+                      help="Seconds each tick may spend updating behaviors "
+                           "before leaving the rest for the next tick.")
+  parser.add_argument("--flow-field-radius", action="store", default=16,
+                      type=int,
+                      help="Radius, in tiles, of the flow fields shared by "
+                           "NPCs heading to the same goal.")
+  parser.add_argument("--max-flow-fields", action="store", default=1024,
+                      type=int,
+                      help="Number of flow fields per realm to keep before "
+                           "evicting unused ones.")
+  parser.add_argument("--statsd-host", action="store", default="localhost",
+                      help="statsd host to connect to.")
+  parser.add_argument("--statsd-port", action="store", default=8125, type=int,
+                      help="statsd port to connect to.")
+  parser.add_argument("--stats-interval", action="store", default=10,
+                      type=float,
+                      help="Seconds between reports of pathfinding statistics "
+                           "to statsd.")
   return parser
 
 
@@ -37,6 +63,18 @@ class NPCServer(client.Client):
       self.id = self.config.id
 
     logger.info("I am NPC server %s.", self.id)
+
+    self.statsd = statsd.StatsClient(self.config.statsd_host,
+                                     self.config.statsd_port,
+                                     prefix="elpizo.npc_server")
+    self.stats_reporter = asyncio.async(
+        green.coroutine(self.report_stats)(), loop=self.loop)
+
+    self.behavior_scheduler = scheduler.BehaviorScheduler(
+        self, self.config.behavior_tick_rate, self.config.behavior_tick_budget)
+    self.behavior_ticker = asyncio.async(
+        green.coroutine(self.behavior_scheduler.run)(), loop=self.loop)
+
     super().on_start()
 
   def make_protocol(self, transport):
@@ -45,13 +83,51 @@ class NPCServer(client.Client):
   def start_behavior(self, behavior):
     logger.info("Starting behavior for NPC %s.", behavior.npc.id)
     self.npcs[behavior.npc.id] = behavior
-    asyncio.async(green.coroutine(behavior.run)(), loop=self.loop)
+    self.behavior_scheduler.add(behavior)
 
   def stop_npc(self, npc):
     logger.info("Stopping behavior for NPC %s.", npc.id)
     behavior = self.npcs.pop(npc.id)
     behavior.stop()
 
+  def report_stats(self):
+    while True:
+      green.await_coro(asyncio.sleep(self.config.stats_interval))
+      self.report_path_stats()
+
+  def report_path_stats(self):
+    """
+    Report path cache statistics for all behaviors, and flow field statistics
+    for all realms, to statsd.
+    """
+    hits = misses = 0
+    replan_time = 0
+
+    for behavior in self.npcs.values():
+      behavior_hits, behavior_misses, behavior_replan_time = \
+          behavior.path_cache.pop_stats()
+      hits += behavior_hits
+      misses += behavior_misses
+      replan_time += behavior_replan_time
+
+    self.statsd.incr("paths.hits", hits)
+    self.statsd.incr("paths.misses", misses)
+
+    if misses:
+      self.statsd.timing("paths.replan", replan_time / misses * 1000)
+
+    hits = misses = size = 0
+
+    for r in self.store.realms.loaded_records.values():
+      realm_hits, realm_misses = r.flow_fields.pop_stats()
+      hits += realm_hits
+      misses += realm_misses
+      size += len(r.flow_fields.fields)
+
+    self.statsd.incr("flow_fields.hits", hits)
+    self.statsd.incr("flow_fields.misses", misses)
+    self.statsd.gauge("flow_fields.size", size)
+
 
 def main():
   NPCServer(make_config_parser().parse_args()).run()
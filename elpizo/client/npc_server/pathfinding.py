@@ -0,0 +1,1061 @@
+import array
+import collections
+import heapq
+import time
+
+from elpizo.models import realm
+
+
+class PathGrid(object):
+  """
+  The terrain passabilities of a realm's known regions, laid out for finding
+  paths over.
+
+  Tiles are indexed by `y * width + x`. `passable[direction][i]` is 1 if tile i
+  can be entered moving in that direction, and 0 if it can't or its region
+  isn't known. `exits[i]` has bit `direction` set if a single tile entity on
+  tile i can move in that direction.
+  """
+
+  # The largest pocket of tiles that goals are checked for being enclosed in
+  # before searching for a path to them.
+  POCKET_SIZE = 64
+
+  def __init__(self, size):
+    self.width = size.x
+    self.height = size.y
+
+    num_tiles = self.width * self.height
+    self.passable = [bytearray(num_tiles) for _ in range(4)]
+    self.exits = bytearray(num_tiles)
+
+    # (x, y) locations of the regions that have been added -> the number of
+    # times their terrain has been, so that paths over them can tell if it has
+    # changed.
+    self.regions = collections.Counter()
+
+    # The number of times any terrain has been added.
+    self.version = 0
+
+    # Search state, allocated once and reused by every search, so that nothing
+    # needs to be cleared between searches. A tile's score (its distance from
+    # the start) and parent are only valid if its stamp is from the current
+    # search.
+    #
+    # These are lists rather than arrays, as indexing lists is much faster.
+    self.search = 0
+    self.stamps = [0] * num_tiles
+    self.scores = [0] * num_tiles
+    self.parents = [0] * num_tiles
+
+    # The rows of the bitmaps of regions, expanded into one byte per tile.
+    self._rows = {}
+
+  def _expand_row(self, bits):
+    row = self._rows.get(bits)
+
+    if row is None:
+      row = bytes((bits >> x) & 0x1 for x in range(realm.Region.SIZE))
+      self._rows[bits] = row
+
+    return row
+
+  def add_region(self, region):
+    """
+    Add the terrain of a region, replacing any it had before.
+    """
+    location = region.location
+
+    # Regions at the edge of the realm may overhang it.
+    width = min([realm.Region.SIZE, self.width - location.x])
+    height = min([realm.Region.SIZE, self.height - location.y])
+    row_mask = (1 << realm.Region.SIZE) - 1
+
+    for direction, bitmap in enumerate(region.passability_bitmaps):
+      passable = self.passable[direction]
+
+      for y in range(height):
+        start = (location.y + y) * self.width + location.x
+        passable[start:start + width] = self._expand_row(
+            (bitmap >> (y * realm.Region.SIZE)) & row_mask)[:width]
+
+    self.regions[location.x, location.y] += 1
+    self.version += 1
+
+    # The exits of the tiles around the region lead into it, so they change
+    # too.
+    self._update_exits(max([location.x - 1, 0]),
+                       max([location.y - 1, 0]),
+                       min([location.x + width + 1, self.width]),
+                       min([location.y + height + 1, self.height]))
+
+  def _update_exits(self, left, top, right, bottom):
+    # Rows of tiles are packed into integers of one byte per tile, so that the
+    # passabilities of the tiles in every direction can be combined a whole
+    # row at a time.
+    w = self.width
+    north, west, south, east = self.passable
+    n = right - left
+    empty = bytes(n)
+
+    for y in range(top, bottom):
+      row = y * w
+
+      exits = int.from_bytes(
+          north[row - w + left:row - w + right] if y > 0 else empty,
+          "little")
+      exits |= int.from_bytes(
+          south[row + w + left:row + w + right] if y < self.height - 1
+                                                else empty,
+          "little") << 2
+
+      if left > 0:
+        exits |= int.from_bytes(west[row + left - 1:row + right - 1],
+                                "little") << 1
+      else:
+        exits |= int.from_bytes(west[row:row + right - 1],
+                                "little") << 9
+
+      if right < w:
+        exits |= int.from_bytes(east[row + left + 1:row + right + 1],
+                                "little") << 3
+      else:
+        exits |= int.from_bytes(east[row + left + 1:row + right],
+                                "little") << 3
+
+      self.exits[row + left:row + right] = exits.to_bytes(n, "little")
+
+  def is_known(self, x, y):
+    return 0 <= x < self.width and 0 <= y < self.height and \
+           (realm.Region.floor(x), realm.Region.floor(y)) in self.regions
+
+  def can_move(self, location, direction):
+    """
+    Check if a single tile entity at a location can move in a direction.
+    """
+    return self.is_known(location.x, location.y) and \
+           bool((self.exits[location.y * self.width + location.x] >>
+                 direction) & 0x1)
+
+  def is_enclosed(self, start_index, goal_index, budget):
+    """
+    Check if a goal can only be reached from a pocket of fewer than `budget`
+    tiles around it that the start isn't in, by searching backwards from the
+    goal.
+    """
+    width = self.width
+    num_tiles = width * self.height
+    exits = self.exits
+    stamps = self.stamps
+
+    self.search += 1
+    seen = self.search
+    stamps[goal_index] = seen
+
+    pending = [goal_index]
+    n = 0
+
+    while pending:
+      index = pending.pop()
+      n += 1
+      if n >= budget or index == start_index:
+        return False
+
+      # A tile leads here if it has an exit in the direction of this tile.
+      for bit, source in ((0x1, index + width), (0x2, index + 1),
+                          (0x4, index - width), (0x8, index - 1)):
+        if 0 <= source < num_tiles and exits[source] & bit and \
+           stamps[source] != seen:
+          stamps[source] = seen
+          pending.append(source)
+
+    return True
+
+  def find_path(self, start, goal):
+    """
+    Find a shortest path between two tiles with A*, by the Manhattan distance.
+
+    :param start: The location to start from.
+    :param goal: The location to reach.
+    :returns: The indexes of the tiles along the path, including the start and
+              the goal, or None if there is no path.
+    :throws KeyError: The start or the goal isn't in a known region.
+    """
+    if not self.is_known(start.x, start.y) or \
+       not self.is_known(goal.x, goal.y):
+      raise KeyError((start, goal))
+
+    start_index = start.y * self.width + start.x
+    goal_index = goal.y * self.width + goal.x
+
+    # Without a path, A* only gives up after searching everywhere it can reach
+    # from the start. Goals in small pockets are ruled out up front instead.
+    if self.is_enclosed(start_index, goal_index, self.POCKET_SIZE):
+      return None
+
+    return self.search_path(start_index, goal_index)
+
+  def search_path(self, start_index, goal_index):
+    """
+    Find a shortest path between two tiles, by index, with A*.
+    """
+    width = self.width
+    exits = self.exits
+    stamps = self.stamps
+    scores = self.scores
+    parents = self.parents
+
+    goal_y = goal_index // width
+    goal_x = goal_index - goal_y * width
+
+    # Tiles reached in this search are stamped with `opened`, and those whose
+    # shortest path is known with `closed`.
+    self.search += 2
+    opened = self.search - 1
+    closed = self.search
+
+    stamps[start_index] = opened
+    scores[start_index] = 0
+    parents[start_index] = -1
+
+    # Every step costs 1 and changes the Manhattan distance to the goal by 1,
+    # so the estimate of a path through a neighbor is either the same as
+    # through the tile (stepping closer), or 2 more (stepping away). The open
+    # set is therefore only ever two buckets of tiles, rather than a heap.
+    current = [start_index]
+    later = []
+
+    while current or later:
+      if not current:
+        current, later = later, current
+
+      index = current.pop()
+      if stamps[index] == closed:
+        # Reached again more cheaply, and already expanded.
+        continue
+      stamps[index] = closed
+
+      if index == goal_index:
+        path = [index]
+        while parents[index] != -1:
+          index = parents[index]
+          path.append(index)
+        path.reverse()
+        return path
+
+      tile_exits = exits[index]
+      if not tile_exits:
+        continue
+
+      y = index // width
+      x = index - y * width
+      next_score = scores[index] + 1
+
+      # The four directions are unrolled, as this is the innermost loop.
+      if tile_exits & 0x1:
+        target = index - width
+        stamp = stamps[target]
+        if stamp < opened or stamp == opened and scores[target] > next_score:
+          stamps[target] = opened
+          scores[target] = next_score
+          parents[target] = index
+          (current if y > goal_y else later).append(target)
+
+      if tile_exits & 0x2:
+        target = index - 1
+        stamp = stamps[target]
+        if stamp < opened or stamp == opened and scores[target] > next_score:
+          stamps[target] = opened
+          scores[target] = next_score
+          parents[target] = index
+          (current if x > goal_x else later).append(target)
+
+      if tile_exits & 0x4:
+        target = index + width
+        stamp = stamps[target]
+        if stamp < opened or stamp == opened and scores[target] > next_score:
+          stamps[target] = opened
+          scores[target] = next_score
+          parents[target] = index
+          (current if y < goal_y else later).append(target)
+
+      if tile_exits & 0x8:
+        target = index + 1
+        stamp = stamps[target]
+        if stamp < opened or stamp == opened and scores[target] > next_score:
+          stamps[target] = opened
+          scores[target] = next_score
+          parents[target] = index
+          (current if x < goal_x else later).append(target)
+
+    return None
+
+
+class PathPlanner(object):
+  """
+  Plans paths hierarchically over a path grid, with regions as clusters.
+
+  Where two clusters meet, each run of pairs of tiles facing each other across
+  the boundary that can be crossed, and walked along on both sides, is an
+  entrance. Each entrance has a portal (one of the pairs) for each direction it
+  can be crossed in, shared if possible. The abstract graph has portal tiles
+  as nodes, with edges across each portal, and between the portal tiles of
+  each cluster that one can reach from the other within the cluster.
+
+  Every portal tile keeps the distances within its cluster from every tile to
+  it. Paths are planned over the abstract graph, joined to the start by those
+  distances and to the goal by the distances to it, then refined into tiles by
+  following them. Paths are near shortest, but not always shortest, as they go
+  through portals.
+
+  Paths between tiles in the same or neighboring clusters, or within
+  `FLAT_DISTANCE` of each other, are found over the grid directly instead, so
+  short chases stay shortest.
+  """
+
+  SIZE = realm.Region.SIZE
+  FLAT_DISTANCE = SIZE * 2
+  UNREACHABLE = 0xffff
+
+  def __init__(self, grid):
+    self.grid = grid
+
+    # (cluster, cluster) -> [(from tile, to tile)] of the portals across the
+    # boundary between two clusters, with the top or left cluster first.
+    self.portals = {}
+
+    # Cluster -> portal tiles in it.
+    self.tiles = {}
+
+    # Portal tile -> tiles it leads to across portals.
+    self.crossings = collections.defaultdict(set)
+
+    # Portal tile -> {tile: distance} of the other portal tiles in its cluster
+    # it can reach.
+    self.links = {}
+
+    # Portal tile -> the distances within its cluster from every tile to it,
+    # by position in the cluster.
+    self.fields = {}
+
+    # Cluster -> the positions each position in the cluster leads to, and is
+    # led to from, within the cluster.
+    self.adjacencies = {}
+
+  def get_cluster(self, index):
+    y = index // self.grid.width
+    x = index - y * self.grid.width
+    return (x - x % self.SIZE, y - y % self.SIZE)
+
+  def update_region(self, location):
+    """
+    Recompute the parts of the abstract graph a region affects, after it has
+    been added to the grid: the boundaries around it, and the links within it
+    and its neighbors.
+    """
+    cluster = (location.x, location.y)
+    boundaries = self.get_boundaries(cluster)
+
+    self.adjacencies.pop(cluster, None)
+
+    for boundary in boundaries:
+      self.update_boundary(*boundary)
+
+    # The terrain of the neighbors hasn't changed, only their portals on the
+    # boundary with the region, so the rest of their portal tiles' distances
+    # can be kept.
+    self.update_links(cluster)
+    for first, second in boundaries:
+      self.update_links(second if first == cluster else first,
+                        terrain_changed=False)
+
+  def get_boundaries(self, cluster):
+    # Boundaries are keyed with the top or left cluster first.
+    x, y = cluster
+    return [((x - self.SIZE, y), cluster), (cluster, (x + self.SIZE, y)),
+            ((x, y - self.SIZE), cluster), (cluster, (x, y + self.SIZE))]
+
+  def update_boundary(self, first, second):
+    grid = self.grid
+    exits = grid.exits
+    w = grid.width
+
+    for source, target in self.portals.pop((first, second), ()):
+      self.crossings[source].discard(target)
+      if not self.crossings[source]:
+        del self.crossings[source]
+
+    if not grid.is_known(*first) or not grid.is_known(*second):
+      return
+
+    if first[1] == second[1]:
+      # Side by side: the boundary is a column, crossed east (from first to
+      # second) and west, and walked along south and north.
+      pairs = [(y * w + second[0] - 1, y * w + second[0])
+               for y in range(first[1], min([first[1] + self.SIZE,
+                                             grid.height]))]
+      forward, backward, along, back_along = 0x8, 0x2, 0x4, 0x1
+    else:
+      # One above the other: the boundary is a row, crossed south and north,
+      # and walked along east and west.
+      pairs = [((second[1] - 1) * w + x, second[1] * w + x)
+               for x in range(first[0], min([first[0] + self.SIZE,
+                                             grid.width]))]
+      forward, backward, along, back_along = 0x4, 0x1, 0x8, 0x2
+
+    # Runs are split wherever either side can't be walked along in both
+    # directions, so that any crossing in a run can be rerouted through the
+    # run's portals.
+    runs = []
+    run = []
+    last_a = last_b = None
+
+    for a, b in pairs:
+      if run and not (exits[last_a] & along and exits[a] & back_along and
+                      exits[last_b] & along and exits[b] & back_along):
+        runs.append(run)
+        run = []
+
+      if exits[a] & forward or exits[b] & backward:
+        run.append((a, b))
+      elif run:
+        runs.append(run)
+        run = []
+
+      last_a, last_b = a, b
+
+    if run:
+      runs.append(run)
+
+    portals = []
+
+    for run in runs:
+      # The pairs nearest the middle of the run are preferred, and those that
+      # can be crossed both ways most of all.
+      middle = (len(run) - 1) / 2
+      by_preference = [pair for _, pair in sorted(
+          enumerate(run),
+          key=lambda entry: (not (exits[entry[1][0]] & forward and
+                                  exits[entry[1][1]] & backward),
+                             abs(entry[0] - middle)))]
+
+      for a, b in by_preference:
+        if exits[a] & forward:
+          portals.append((a, b))
+          break
+
+      for a, b in by_preference:
+        if exits[b] & backward:
+          portals.append((b, a))
+          break
+
+    self.portals[first, second] = portals
+    for source, target in portals:
+      self.crossings[source].add(target)
+
+  def update_links(self, cluster, terrain_changed=True):
+    tiles = set()
+
+    for boundary in self.get_boundaries(cluster):
+      for source, target in self.portals.get(boundary, ()):
+        tiles.update([source, target])
+    tiles = {tile for tile in tiles if self.get_cluster(tile) == cluster}
+
+    for tile in self.tiles.pop(cluster, ()):
+      del self.links[tile]
+      if terrain_changed or tile not in tiles:
+        del self.fields[tile]
+
+    if tiles:
+      self.tiles[cluster] = tiles
+
+    for tile in tiles:
+      if tile not in self.fields:
+        self.fields[tile] = self.get_field(tile, cluster)
+
+    positions = {tile: self.get_position(tile, cluster) for tile in tiles}
+
+    for tile in tiles:
+      self.links[tile] = {}
+
+    for target in tiles:
+      to_target = self.fields[target]
+      for tile in tiles:
+        distance = to_target[positions[tile]]
+        if tile != target and distance != self.UNREACHABLE:
+          self.links[tile][target] = distance
+
+  def get_position(self, index, cluster):
+    # The position of a tile within its cluster.
+    y = index // self.grid.width
+    x = index - y * self.grid.width
+    return (y - cluster[1]) * self.SIZE + x - cluster[0]
+
+  def get_adjacency(self, cluster):
+    """
+    Get the positions each position in a cluster leads to, and is led to
+    from, without leaving the cluster.
+    """
+    try:
+      return self.adjacencies[cluster]
+    except KeyError:
+      pass
+
+    grid = self.grid
+    exits = grid.exits
+    w = grid.width
+    size = self.SIZE
+
+    left, top = cluster
+    width = min([size, grid.width - left])
+    height = min([size, grid.height - top])
+
+    forward = [[] for _ in range(size * size)]
+    backward = [[] for _ in range(size * size)]
+
+    for y in range(height):
+      for x in range(width):
+        position = y * size + x
+        tile_exits = exits[(top + y) * w + left + x]
+
+        for bit, offset, inside in ((0x1, -size, y > 0),
+                                    (0x2, -1, x > 0),
+                                    (0x4, size, y < height - 1),
+                                    (0x8, 1, x < width - 1)):
+          if inside and tile_exits & bit:
+            forward[position].append(position + offset)
+            backward[position + offset].append(position)
+
+    self.adjacencies[cluster] = (forward, backward)
+    return forward, backward
+
+  def get_field(self, origin, cluster):
+    """
+    Get the distances from every tile in a cluster to a tile in it, without
+    leaving the cluster.
+
+    :returns: An array of the distances by position in the cluster, where
+              UNREACHABLE marks tiles that can't reach it.
+    """
+    # Searching backwards, a tile is reached from the tiles that lead to it.
+    _, adjacency = self.get_adjacency(cluster)
+
+    field = array.array("H", [self.UNREACHABLE]) * (self.SIZE * self.SIZE)
+
+    position = self.get_position(origin, cluster)
+    field[position] = 0
+
+    frontier = [position]
+    distance = 0
+
+    while frontier:
+      distance += 1
+      next_frontier = []
+
+      for position in frontier:
+        for neighbor in adjacency[position]:
+          if field[neighbor] == self.UNREACHABLE:
+            field[neighbor] = distance
+            next_frontier.append(neighbor)
+
+      frontier = next_frontier
+
+    return field
+
+  def follow_field(self, start_index, field, cluster):
+    """
+    Follow a field of distances to a tile downhill from another tile, to get a
+    path between them.
+    """
+    adjacency, _ = self.get_adjacency(cluster)
+
+    w = self.grid.width
+    left, top = cluster
+
+    position = self.get_position(start_index, cluster)
+    path = [start_index]
+
+    while field[position]:
+      distance = field[position] - 1
+      position = next(neighbor for neighbor in adjacency[position]
+                      if field[neighbor] == distance)
+      path.append((top + position // self.SIZE) * w + left +
+                  position % self.SIZE)
+
+    return path
+
+  def find_path(self, start, goal):
+    """
+    Plan a path between two tiles.
+
+    :param start: The location to start from.
+    :param goal: The location to reach.
+    :returns: The indexes of the tiles along the path, including the start and
+              the goal, or None if there is no path.
+    :throws KeyError: The start or the goal isn't in a known region.
+    """
+    grid = self.grid
+
+    if not grid.is_known(start.x, start.y) or \
+       not grid.is_known(goal.x, goal.y):
+      raise KeyError((start, goal))
+
+    start_index = start.y * grid.width + start.x
+    goal_index = goal.y * grid.width + goal.x
+
+    if grid.is_enclosed(start_index, goal_index, grid.POCKET_SIZE):
+      return None
+
+    start_cluster = self.get_cluster(start_index)
+    goal_cluster = self.get_cluster(goal_index)
+
+    # Short paths are cheap enough to find directly, and going through portals
+    # would make them detour.
+    if abs(start_cluster[0] - goal_cluster[0]) <= self.SIZE and \
+       abs(start_cluster[1] - goal_cluster[1]) <= self.SIZE or \
+       abs(start.x - goal.x) + abs(start.y - goal.y) <= self.FLAT_DISTANCE:
+      return grid.search_path(start_index, goal_index)
+
+    # The goal isn't a portal tile, so the distances to it are found for just
+    # this path.
+    to_goal = self.get_field(goal_index, goal_cluster)
+
+    waypoints = self.plan(start_index, start_cluster, goal_index,
+                          goal_cluster, to_goal)
+    if waypoints is None:
+      return None
+
+    # Within clusters, follow the distances to the next waypoint.
+    path = [start_index]
+
+    for leg_start, leg_goal in zip(waypoints, waypoints[1:]):
+      if leg_goal in self.crossings.get(leg_start, ()):
+        path.append(leg_goal)
+      else:
+        field = to_goal if leg_goal == goal_index else self.fields[leg_goal]
+        path.extend(self.follow_field(leg_start, field,
+                                      self.get_cluster(leg_goal))[1:])
+
+    return path
+
+  def plan(self, start_index, start_cluster, goal_index, goal_cluster,
+           to_goal):
+    """
+    Find the portal tiles a path between tiles in different clusters goes
+    through, with A* over the abstract graph.
+
+    :returns: The start, the portal tiles and the goal, or None if there is no
+              path.
+    """
+    w = self.grid.width
+    goal_y = goal_index // w
+    goal_x = goal_index - goal_y * w
+
+    # The start and the goal are linked to the portal tiles of their clusters
+    # for just this search.
+    start_position = self.get_position(start_index, start_cluster)
+    start_links = {}
+    for tile in self.tiles.get(start_cluster, ()):
+      to_tile = self.fields[tile]
+      if to_tile[start_position] != self.UNREACHABLE:
+        start_links[tile] = to_tile[start_position]
+
+    goal_links = {}
+    for tile in self.tiles.get(goal_cluster, ()):
+      distance = to_goal[self.get_position(tile, goal_cluster)]
+      if distance != self.UNREACHABLE:
+        goal_links[tile] = distance
+
+    scores = {start_index: 0}
+    parents = {start_index: None}
+    open_heap = [(0, start_index)]
+    closed = set()
+
+    while open_heap:
+      _, index = heapq.heappop(open_heap)
+      if index in closed:
+        continue
+      closed.add(index)
+
+      if index == goal_index:
+        waypoints = []
+        while index is not None:
+          waypoints.append(index)
+          index = parents[index]
+        waypoints.reverse()
+        return waypoints
+
+      score = scores[index]
+
+      edges = list((start_links if index == start_index
+                    else self.links.get(index, {})).items())
+      edges.extend((target, 1) for target in self.crossings.get(index, ()))
+      if index in goal_links:
+        edges.append((goal_index, goal_links[index]))
+
+      for target, cost in edges:
+        next_score = score + cost
+        if target in scores and scores[target] <= next_score:
+          continue
+
+        scores[target] = next_score
+        parents[target] = index
+
+        target_y = target // w
+        target_x = target - target_y * w
+        heapq.heappush(open_heap,
+                       (next_score + abs(target_x - goal_x) +
+                        abs(target_y - goal_y), target))
+
+    return None
+
+
+class PathCache(object):
+  """
+  A path being followed towards a goal, kept between steps so that it's only
+  replanned when it no longer leads there.
+
+  The path is kept while the goal stays on it, or moves one step past its end
+  (up to `MAX_EXTENSIONS` times between replans, so that it can't wander too
+  far from the shortest path), and the terrain of the regions it crosses is
+  unchanged.
+  """
+
+  MAX_EXTENSIONS = 8
+
+  def __init__(self):
+    self.planner = None
+    self.path = None
+    self.position = 0
+    self.extensions = 0
+
+    # (x, y) locations of the regions the path crosses -> the versions of their
+    # terrain it was planned over.
+    self.versions = {}
+
+    self.hits = 0
+    self.misses = 0
+    self.replan_time = 0
+
+  def pop_stats(self):
+    """
+    Get and reset the number of path queries that reused the path, the number
+    that replanned it, and the total time spent replanning.
+    """
+    stats = (self.hits, self.misses, self.replan_time)
+    self.hits = self.misses = 0
+    self.replan_time = 0
+    return stats
+
+  def get_next_step(self, planner, start, goal):
+    """
+    Get the next step of the path from a tile to a goal.
+
+    :param planner: The path planner to plan with, if the path needs to be
+                    replanned.
+    :param start: The location to step from.
+    :param goal: The location to reach.
+    :returns: The index of the next tile along the path, the start's if it is
+              the goal, or None if there is no path.
+    :throws KeyError: The start or the goal isn't in a known region.
+    """
+    grid = planner.grid
+    start_index = start.y * grid.width + start.x
+    goal_index = goal.y * grid.width + goal.x
+
+    if planner is self.planner and self.follow(start_index, goal_index):
+      self.hits += 1
+    else:
+      self.misses += 1
+
+      start_time = time.monotonic()
+      try:
+        path = planner.find_path(start, goal)
+      finally:
+        self.replan_time += time.monotonic() - start_time
+
+      self.planner = planner
+      self.path = path
+      self.position = 0
+      self.extensions = 0
+
+      if path is None:
+        return None
+
+      self.versions = {}
+      for index in path:
+        self.add_version(index)
+
+    return self.path[min([self.position + 1, len(self.path) - 1])]
+
+  def add_version(self, index):
+    grid = self.planner.grid
+    y = index // grid.width
+    location = (realm.Region.floor(index - y * grid.width),
+                realm.Region.floor(y))
+
+    if location not in self.versions:
+      self.versions[location] = grid.regions[location]
+
+  def follow(self, start_index, goal_index):
+    """
+    Advance along the path to a tile, and move its end to a goal, if it still
+    leads there.
+
+    :returns: True if the path can still be followed, otherwise False.
+    """
+    path = self.path
+    if path is None:
+      return False
+
+    # The path is followed one step at a time, so the start is either where
+    # the last query was from, or the step after it.
+    position = self.position
+    if path[position] != start_index:
+      position += 1
+      if position == len(path) or path[position] != start_index:
+        return False
+
+    grid = self.planner.grid
+
+    for location, version in self.versions.items():
+      if grid.regions[location] != version:
+        return False
+
+    try:
+      end = path.index(goal_index, position)
+    except ValueError:
+      last = path[-1]
+      direction = {-grid.width: 0, -1: 1,
+                   grid.width: 2, 1: 3}.get(goal_index - last)
+
+      if self.extensions == self.MAX_EXTENSIONS or direction is None or \
+         not (grid.exits[last] >> direction) & 0x1:
+        return False
+
+      path.append(goal_index)
+      self.add_version(goal_index)
+      self.extensions += 1
+    else:
+      del path[end + 1:]
+
+    self.position = position
+    return True
+
+
+class FlowField(object):
+  """
+  The distances to a goal from the tiles around it, so that anything heading
+  there can find its next step without searching.
+
+  Only tiles within `radius` of the goal, along either axis, are covered, and
+  only paths that stay within them are considered. Distances are found by a
+  breadth-first search backwards from the goal, which only goes as far as the
+  tiles asked about so far.
+  """
+
+  UNREACHABLE = 0xffff
+
+  def __init__(self, grid, goal_index, radius):
+    self.grid = grid
+    self.goal_index = goal_index
+
+    goal_y = goal_index // grid.width
+    goal_x = goal_index - goal_y * grid.width
+
+    self.left = max([goal_x - radius, 0])
+    self.top = max([goal_y - radius, 0])
+    self.right = min([goal_x + radius + 1, grid.width])
+    self.bottom = min([goal_y + radius + 1, grid.height])
+
+    # The version of the grid, and of each region under the field, that the
+    # field was found over.
+    self.grid_version = grid.version
+    self.versions = {
+        (x, y): grid.regions[x, y]
+        for y in range(realm.Region.floor(self.top), self.bottom,
+                       realm.Region.SIZE)
+        for x in range(realm.Region.floor(self.left), self.right,
+                       realm.Region.SIZE)}
+
+    # Distances by position in the field, and the positions the search will
+    # continue from.
+    width = self.right - self.left
+    self.distances = array.array("H", [self.UNREACHABLE]) * \
+                     (width * (self.bottom - self.top))
+
+    position = (goal_y - self.top) * width + goal_x - self.left
+    self.distances[position] = 0
+    self.frontier = [position]
+    self.distance = 0
+
+  def is_current(self):
+    """
+    Check if the terrain under the field is unchanged.
+    """
+    grid = self.grid
+
+    if self.grid_version != grid.version:
+      for location, version in self.versions.items():
+        if grid.regions[location] != version:
+          return False
+
+      # Only terrain elsewhere changed.
+      self.grid_version = grid.version
+
+    return True
+
+  def search(self, target_position):
+    # Continue the search until it reaches a position, or runs out of tiles.
+    exits = self.grid.exits
+    w = self.grid.width
+    left = self.left
+    top = self.top
+    width = self.right - left
+    height = self.bottom - top
+
+    distances = self.distances
+    frontier = self.frontier
+    distance = self.distance
+
+    while frontier and distances[target_position] == self.UNREACHABLE:
+      distance += 1
+      next_frontier = []
+
+      for position in frontier:
+        y = position // width
+        x = position - y * width
+        index = (top + y) * w + left + x
+
+        # Each neighbor leads here if it has an exit towards here: the one to
+        # the north moving south, and so on.
+        if y > 0 and exits[index - w] & 0x4 and \
+           distances[position - width] == self.UNREACHABLE:
+          distances[position - width] = distance
+          next_frontier.append(position - width)
+
+        if x > 0 and exits[index - 1] & 0x8 and \
+           distances[position - 1] == self.UNREACHABLE:
+          distances[position - 1] = distance
+          next_frontier.append(position - 1)
+
+        if y < height - 1 and exits[index + w] & 0x1 and \
+           distances[position + width] == self.UNREACHABLE:
+          distances[position + width] = distance
+          next_frontier.append(position + width)
+
+        if x < width - 1 and exits[index + 1] & 0x2 and \
+           distances[position + 1] == self.UNREACHABLE:
+          distances[position + 1] = distance
+          next_frontier.append(position + 1)
+
+      frontier = next_frontier
+
+    self.frontier = frontier
+    self.distance = distance
+
+  def get_next_step(self, index):
+    """
+    Get the next step towards the goal from a tile.
+
+    :returns: The index of the next tile, the tile's own if it is the goal, or
+              None if the goal can't be reached from it within the field.
+    """
+    w = self.grid.width
+    y = index // w
+    x = index - y * w
+
+    if not (self.left <= x < self.right and self.top <= y < self.bottom):
+      return None
+
+    width = self.right - self.left
+    position = (y - self.top) * width + x - self.left
+
+    distances = self.distances
+    if distances[position] == self.UNREACHABLE:
+      self.search(position)
+
+    distance = distances[position]
+
+    if distance == self.UNREACHABLE:
+      return None
+
+    if distance == 0:
+      return index
+
+    # One of the neighbors within the field is a step closer, and has been
+    # reached already.
+    tile_exits = self.grid.exits[index]
+    distance -= 1
+
+    if y > self.top and tile_exits & 0x1 and \
+       distances[position - width] == distance:
+      return index - w
+
+    if x > self.left and tile_exits & 0x2 and \
+       distances[position - 1] == distance:
+      return index - 1
+
+    if y < self.bottom - 1 and tile_exits & 0x4 and \
+       distances[position + width] == distance:
+      return index + w
+
+    return index + 1
+
+
+class FlowFields(object):
+  """
+  Flow fields to the goals being headed to, shared by everything heading to
+  the same goal.
+
+  A field is kept until the terrain under it changes or, once `max_fields`
+  fields are kept, it has gone the longest without being asked for.
+  """
+
+  def __init__(self, grid, radius, max_fields):
+    self.grid = grid
+    self.radius = radius
+    self.max_fields = max_fields
+
+    # Goal index -> field, least recently asked for first.
+    self.fields = collections.OrderedDict()
+
+    self.hits = 0
+    self.misses = 0
+
+  def pop_stats(self):
+    """
+    Get and reset the number of times a field was reused, and the number of
+    fields made.
+    """
+    stats = (self.hits, self.misses)
+    self.hits = self.misses = 0
+    return stats
+
+  def get_field(self, goal):
+    """
+    Get the flow field to a goal.
+
+    :param goal: The location of the goal.
+    :returns: The flow field.
+    :throws KeyError: The goal isn't in a known region.
+    """
+    if not self.grid.is_known(goal.x, goal.y):
+      raise KeyError(goal)
+
+    goal_index = goal.y * self.grid.width + goal.x
+    field = self.fields.get(goal_index)
+
+    if field is not None and field.is_current():
+      self.hits += 1
+    else:
+      self.misses += 1
+      field = FlowField(self.grid, goal_index, self.radius)
+      self.fields[goal_index] = field
+
+    self.fields.move_to_end(goal_index)
+
+    while len(self.fields) > self.max_fields:
+      self.fields.popitem(last=False)
+
+    return field
@@ -0,0 +1,229 @@
+import collections
+import random
+import unittest
+
+from elpizo.client.npc_server import pathfinding
+from elpizo.models import entities
+from elpizo.models import geometry
+from elpizo.models import realm
+
+
+# Realms that don't end on a region boundary, so that the last regions
+# overhang them.
+WIDTH = realm.Region.SIZE * 3 + 5
+HEIGHT = realm.Region.SIZE * 2 + 9
+
+# Tile index offset -> the exit bit for it, with the grid's width.
+STEP_BITS = {-WIDTH: 0x1, -1: 0x2, WIDTH: 0x4, 1: 0x8}
+
+
+def make_region(rand, x, y):
+  # Mostly open terrain, with walls and tiles that can only be entered in some
+  # directions.
+  passabilities = []
+  for _ in range(realm.Region.SIZE * realm.Region.SIZE):
+    roll = rand.random()
+    if roll < 0.7:
+      passabilities.append(0b1111)
+    elif roll < 0.9:
+      passabilities.append(0b0000)
+    else:
+      passabilities.append(rand.randrange(16))
+
+  return realm.Region(location=geometry.Vector2(x, y), layers=[],
+                      passabilities=passabilities)
+
+
+def find_distances(regions, start, bounds=None):
+  """
+  Find the distances from a tile to every tile it can reach, by breadth-first
+  search over the passabilities of the regions directly.
+
+  :param regions: (x, y) -> region of the known regions.
+  :param start: The (x, y) tile to start from.
+  :param bounds: The (left, top, right, bottom) tiles to stay within, if any.
+  :returns: (x, y) -> distance.
+  """
+  left, top, right, bottom = bounds or (0, 0, WIDTH, HEIGHT)
+  left = max([left, 0])
+  top = max([top, 0])
+  right = min([right, WIDTH])
+  bottom = min([bottom, HEIGHT])
+
+  if not (left <= start[0] < right and top <= start[1] < bottom):
+    return {}
+
+  distances = {start: 0}
+  pending = collections.deque([start])
+
+  while pending:
+    x, y = pending.popleft()
+
+    for direction, delta in entities.Entity.DIRECTION_VECTORS.items():
+      target = (x + delta.x, y + delta.y)
+      tx, ty = target
+      if not (left <= tx < right and top <= ty < bottom) or \
+         target in distances:
+        continue
+
+      region = regions.get((realm.Region.floor(tx), realm.Region.floor(ty)))
+      if region is None:
+        continue
+
+      passability = region.passabilities[
+          (ty - region.location.y) * realm.Region.SIZE + tx - region.location.x]
+      if (passability >> direction) & 0x1:
+        distances[target] = distances[x, y] + 1
+        pending.append(target)
+
+  return distances
+
+
+class PathfindingTest(unittest.TestCase):
+  NUM_SEEDS = 3
+  NUM_QUERIES = 100
+  NUM_GOALS = 20
+  RADIUS = 12
+
+  def setUp(self):
+    self.locations = [(x, y)
+                      for y in range(0, HEIGHT, realm.Region.SIZE)
+                      for x in range(0, WIDTH, realm.Region.SIZE)]
+
+  def add_region(self, region):
+    self.regions[region.location.x, region.location.y] = region
+    self.grid.add_region(region)
+    self.planner.update_region(region.location)
+
+  def assert_legal(self, path, start, goal):
+    self.assertEqual(path[0], start)
+    self.assertEqual(path[-1], goal)
+
+    for a, b in zip(path, path[1:]):
+      self.assertIn(b - a, STEP_BITS)
+      self.assertTrue(self.grid.exits[a] & STEP_BITS[b - a],
+                      "no exit from {a} to {b}".format(a=a, b=b))
+
+  def random_known_tile(self):
+    x, y = self.rand.choice(sorted(self.regions))
+    return (self.rand.randrange(x, min([x + realm.Region.SIZE, WIDTH])),
+            self.rand.randrange(y, min([y + realm.Region.SIZE, HEIGHT])))
+
+  def random_nearby_tile(self, location, radius):
+    while True:
+      x = location[0] + self.rand.randint(-radius, radius)
+      y = location[1] + self.rand.randint(-radius, radius)
+      if self.grid.is_known(x, y):
+        return (x, y)
+
+  def is_short(self, start, goal):
+    # Whether the planner finds the path over the grid directly.
+    size = pathfinding.PathPlanner.SIZE
+    return abs(realm.Region.floor(start[0]) -
+               realm.Region.floor(goal[0])) <= size and \
+           abs(realm.Region.floor(start[1]) -
+               realm.Region.floor(goal[1])) <= size or \
+           abs(start[0] - goal[0]) + abs(start[1] - goal[1]) <= \
+           pathfinding.PathPlanner.FLAT_DISTANCE
+
+  def check_paths(self):
+    grid = self.grid
+
+    for _ in range(self.NUM_QUERIES):
+      start = self.random_known_tile()
+      goal = self.rand.choice(self.goals)
+
+      start_index = start[1] * WIDTH + start[0]
+      goal_index = goal[1] * WIDTH + goal[0]
+
+      distance = find_distances(self.regions, start).get(goal)
+
+      path = grid.find_path(geometry.Vector2(*start), geometry.Vector2(*goal))
+      if distance is None:
+        self.assertIsNone(path)
+      else:
+        self.assertIsNotNone(path)
+        self.assert_legal(path, start_index, goal_index)
+        self.assertEqual(len(path) - 1, distance)
+
+      planned = self.planner.find_path(geometry.Vector2(*start),
+                                       geometry.Vector2(*goal))
+      if distance is None:
+        self.assertIsNone(planned)
+      else:
+        self.assertIsNotNone(planned)
+        self.assert_legal(planned, start_index, goal_index)
+
+        if self.is_short(start, goal):
+          self.assertEqual(len(planned) - 1, distance)
+        else:
+          self.assertGreaterEqual(len(planned) - 1, distance)
+
+      # Flow fields only consider paths within their radius of the goal, so
+      # they are followed from nearby.
+      nearby = self.random_nearby_tile(goal, self.RADIUS)
+      nearby_index = nearby[1] * WIDTH + nearby[0]
+
+      field = self.flow_fields.get_field(geometry.Vector2(*goal))
+      field_distance = find_distances(
+          self.regions, nearby,
+          (goal[0] - self.RADIUS, goal[1] - self.RADIUS,
+           goal[0] + self.RADIUS + 1, goal[1] + self.RADIUS + 1)).get(goal)
+
+      index = nearby_index
+      followed = [index]
+      while True:
+        index = field.get_next_step(index)
+        if index is None or index == followed[-1]:
+          break
+        followed.append(index)
+        self.assertLessEqual(len(followed), WIDTH * HEIGHT)
+
+      if field_distance is None:
+        self.assertIsNone(index)
+      else:
+        self.assert_legal(followed, nearby_index, goal_index)
+        self.assertEqual(len(followed) - 1, field_distance)
+
+  def test_paths_on_random_realms(self):
+    for seed in range(self.NUM_SEEDS):
+      self.rand = random.Random(seed)
+      self.regions = {}
+      self.grid = pathfinding.PathGrid(geometry.Vector2(WIDTH, HEIGHT))
+      self.planner = pathfinding.PathPlanner(self.grid)
+      self.flow_fields = pathfinding.FlowFields(self.grid, self.RADIUS,
+                                                self.NUM_GOALS)
+
+      # Some regions are missing at first.
+      missing = set(self.rand.sample(self.locations,
+                                     len(self.locations) // 3))
+      for x, y in self.locations:
+        if (x, y) not in missing:
+          self.add_region(make_region(self.rand, x, y))
+
+      # The same goals are headed to throughout, so that flow fields to them
+      # outlive changes to the terrain under them.
+      self.goals = [self.random_known_tile() for _ in range(self.NUM_GOALS)]
+      self.check_paths()
+
+      x, y = sorted(missing)[0]
+      with self.assertRaises(KeyError):
+        self.grid.find_path(geometry.Vector2(*self.random_known_tile()),
+                            geometry.Vector2(x, y))
+      with self.assertRaises(KeyError):
+        self.planner.find_path(geometry.Vector2(x, y),
+                               geometry.Vector2(*self.random_known_tile()))
+
+      # Then they arrive, and some of the others are sent again with new
+      # terrain.
+      for x, y in sorted(missing):
+        self.add_region(make_region(self.rand, x, y))
+      self.check_paths()
+
+      for x, y in self.rand.sample(self.locations, len(self.locations) // 2):
+        self.add_region(make_region(self.rand, x, y))
+      self.check_paths()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,90 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from elpizo.util import green
+
+logger = logging.getLogger(__name__)
+
+
+class BehaviorScheduler(object):
+  """
+  Runs the updates of every behavior from a single fixed-rate tick.
+
+  Each behavior's update says how long to wait until its next one, and it's
+  not touched in between, so idle behaviors cost nothing. Each tick runs the
+  updates that are due, until it has spent its budget. The rest are left for
+  the next tick, earliest first.
+  """
+
+  def __init__(self, server, rate, budget):
+    self.server = server
+    self.interval = 1 / rate
+    self.budget = budget
+
+    # Heap of (due time, serial, behavior). Behaviors that have stopped are
+    # dropped when they come up.
+    self.queue = []
+    self.serials = itertools.count()
+
+  def add(self, behavior):
+    """
+    Start running a behavior, with its first update due at the next tick.
+    """
+    behavior.running = True
+    self.schedule(behavior, time.monotonic())
+
+  def schedule(self, behavior, due_time):
+    heapq.heappush(self.queue, (due_time, next(self.serials), behavior))
+
+  def tick(self):
+    start_time = time.monotonic()
+    deadline = start_time + self.budget
+
+    updates = 0
+
+    while self.queue and self.queue[0][0] <= start_time:
+      if updates and time.monotonic() >= deadline:
+        break
+
+      _, _, behavior = heapq.heappop(self.queue)
+      if not behavior.running:
+        continue
+
+      try:
+        delay = behavior.on_update()
+      except Exception:
+        # A single bad behavior must not stop the others, but it isn't
+        # retried, as it would likely fail again.
+        logger.exception("Behavior for NPC %s failed, stopping it.",
+                         behavior.npc.id)
+        behavior.stop()
+        continue
+
+      updates += 1
+      self.schedule(behavior, time.monotonic() + delay)
+
+    self.server.statsd.incr("behaviors.updates", updates)
+
+    if self.queue and self.queue[0][0] <= start_time:
+      # The budget ran out before every update that was due had run.
+      self.server.statsd.incr("behaviors.budget_exhausted")
+
+  def run(self):
+    next_tick_time = time.monotonic()
+
+    while True:
+      next_tick_time += self.interval
+      delay = next_tick_time - time.monotonic()
+
+      if delay > 0:
+        green.await_coro(asyncio.sleep(delay))
+      else:
+        # We've fallen behind, so don't try to catch up with a burst of ticks.
+        self.server.statsd.incr("behaviors.overruns")
+        next_tick_time = time.monotonic()
+
+      with self.server.statsd.timer("behaviors.tick"):
+        self.tick()
@@ -1,3 +1,5 @@
+import asyncio
+
 from elpizo.models import entities
 from elpizo.models import geometry
 from elpizo.models import realm
@@ -10,12 +12,30 @@ class DictAdapter(object):
   def get(self, key):
     return self.dict[key]
 
+  @asyncio.coroutine
+  def get_async(self, key):
+    return self.get(key)
+
   def set(self, key, value):
     self.dict[key] = value
 
   def delete(self, key):
     del self.dict[key]
 
+  def get_many(self, keys):
+    return {key: self.dict[key] for key in keys if key in self.dict}
+
+  @asyncio.coroutine
+  def get_many_async(self, keys):
+    return self.get_many(keys)
+
+  def set_many(self, items):
+    self.dict.update(items)
+
+  def delete_many(self, keys):
+    for key in keys:
+      del self.dict[key]
+
   def next_serial(self):
     raise NotImplementedError
 
@@ -31,3 +51,12 @@ class Store(object):
   def make_region_store(self, r):
     assert r.id is not None
     return realm.RegionStore(r, self.entities, DictAdapter({}))
+
+  def is_entity_pinned(self, entity):
+    return True
+
+  def is_region_pinned(self, region):
+    return True
+
+  def is_location_owned(self, realm_id, location):
+    return True
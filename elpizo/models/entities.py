@@ -1,4 +1,3 @@
-import asyncio
 import collections
 import contextlib
 import logging
@@ -9,7 +8,8 @@ from elpizo.models import realm
 from elpizo.models import record
 from elpizo.models import items
 from elpizo.protos import entities_pb2
-from elpizo.util import green
+from elpizo.protos import packets_pb2
+from elpizo.util import net
 from elpizo.util import support
 
 
@@ -43,10 +43,20 @@ class Entity(record.ProtobufRecord):
 
   DIRECTIONS = {v: k for k, v in DIRECTION_VECTORS.items()}
 
+  _bounds = None
+  _bounds_location = None
+  _bounds_bbox = None
+
+  _public_snapshot = None
+  _protected_snapshot = None
+
   def __init__(self, *args, **kwargs):
     super().__init__(*args, **kwargs)
     self.location_log = collections.deque()
-    self.location_lock = asyncio.Lock()
+
+    self._region_locations_key = None
+    self._region_locations_bounds = None
+    self._region_locations = []
 
   def log_location(self, time, location):
     self.location_log.append((time, location))
@@ -82,6 +92,71 @@ class Entity(record.ProtobufRecord):
     protobuf.type = "avatar"
     return protobuf
 
+  @classmethod
+  def get_snapshot_fields(cls):
+    """
+    Get the names of the attributes that snapshots of the class are made from.
+    """
+    try:
+      return cls.__dict__["_snapshot_fields"]
+    except KeyError:
+      fields = frozenset(field.record_field for field in cls.get_fields())
+      cls._snapshot_fields = fields
+      return fields
+
+  def __setattr__(self, name, value):
+    super().__setattr__(name, value)
+
+    # Writing a field makes the snapshots stale.
+    if name in self.get_snapshot_fields():
+      self.invalidate_snapshots()
+
+  def mark_dirty(self):
+    super().mark_dirty()
+
+    # Fields changed in place (e.g. the inventory) can't be noticed as they're
+    # written, but are followed by marking the entity dirty.
+    self.invalidate_snapshots()
+
+  def invalidate_snapshots(self):
+    self.__dict__["_public_snapshot"] = None
+    self.__dict__["_protected_snapshot"] = None
+
+  @property
+  def public_snapshot(self):
+    """
+    The serialized public protobuf of the entity. It is cached until a field is
+    next written, or the entity is next marked dirty.
+    """
+    if self._public_snapshot is None:
+      self._public_snapshot = self.to_public_protobuf().SerializeToString()
+    return self._public_snapshot
+
+  @property
+  def protected_snapshot(self):
+    """
+    The serialized protected protobuf of the entity. It is cached until a field
+    is next written, or the entity is next marked dirty.
+    """
+    if self._protected_snapshot is None:
+      self._protected_snapshot = \
+          self.to_protected_protobuf().SerializeToString()
+    return self._protected_snapshot
+
+  def make_entity_packet(self, protected=False):
+    """
+    Make an ENTITY packet from the cached snapshot of the entity, without
+    re-encoding it.
+
+    :param protected: Whether to send the protected (rather than public)
+                      snapshot.
+    """
+    return net.SerializedMessage(
+        packets_pb2.EntityPacket,
+        net.encode_message_field(
+            packets_pb2.EntityPacket, "entity",
+            self.protected_snapshot if protected else self.public_snapshot))
+
   @classmethod
   def from_protobuf_polymorphic(cls, proto):
     return cls.REGISTRY[proto.type].from_protobuf(proto)
@@ -96,23 +171,72 @@ class Entity(record.ProtobufRecord):
 
   @property
   def bounds(self):
-    return self.bbox.offset(self.location)
+    # Locations and bounding boxes are immutable, so the bounds only need to be
+    # recomputed when either of them is replaced.
+    location = self.location
+    bbox = self.bbox
+
+    if location is not self._bounds_location or bbox is not self._bounds_bbox:
+      self._bounds = bbox.offset(location)
+      self._bounds_location = location
+      self._bounds_bbox = bbox
+
+    return self._bounds
+
+  @property
+  def region_locations(self):
+    """
+    The locations of the regions this entity's bounds intersect.
+
+    The list is cached and only recomputed when the entity crosses a region
+    boundary, so callers must not mutate it.
+    """
+    bounds = self.bounds
+    if bounds is self._region_locations_bounds and \
+       self._region_locations_key[0] == self.realm_id:
+      return self._region_locations
+
+    key = (self.realm_id,
+           realm.Region.floor(bounds.left), realm.Region.floor(bounds.top),
+           realm.Region.ceil(bounds.right), realm.Region.ceil(bounds.bottom))
+
+    if key != self._region_locations_key:
+      self._region_locations = list(
+          self.realm.intersecting_region_locations(bounds))
+      self._region_locations_key = key
+    self._region_locations_bounds = bounds
+
+    return self._region_locations
 
   @property
   def regions(self):
-    return self.realm.load_intersecting_regions(self.bounds)
+    for location in self.region_locations:
+      yield self.realm.regions.load(location)
 
   @contextlib.contextmanager
   def movement(self):
-    initial_regions = list(self.regions)
+    initial_region_locations = self.region_locations
 
     yield
 
-    for region in initial_regions:
-      region.entities.remove(self)
+    self.mark_dirty()
+
+    region_locations = self.region_locations
 
-    for region in self.regions:
-      region.entities.add(self)
+    for location in initial_region_locations:
+      if location not in region_locations:
+        region = self.realm.region_at(location.x, location.y)
+        region.remove_entity(self)
+        region.mark_dirty()
+
+    for location in region_locations:
+      region = self.realm.region_at(location.x, location.y)
+
+      if location in initial_region_locations:
+        region.move_entity(self)
+      else:
+        region.add_entity(self)
+        region.mark_dirty()
 
   def is_passable_by(self, entity, direction):
     return False
@@ -121,20 +245,51 @@ class Entity(record.ProtobufRecord):
     protocol.send(self.id, message)
 
   def send_via_bus(self, bus, target, message):
-    return asyncio.gather(*[
-        green.coroutine(self.send)(protocol, message)
-        for protocol in bus.get_protocols_for_channel(target.channel)])
+    return self.send_to_protocols(
+        bus.get_protocols_for_channel(target.channel), message)
 
   def broadcast(self, bus, channel, message):
-    return asyncio.gather(*[
-        green.coroutine(self.send)(protocol, message)
-        for protocol in bus.get_protocols_for_channel(channel)
-        if protocol.policy.can_receive_broadcasts_from(self)])
+    packet = self.broadcast_to_protocols(
+        bus.get_protocols_for_channel(channel), message)
+
+    # Subscribers to the channel elsewhere are reached through the bus.
+    bus.relay_to_channel(channel, self.id, packet)
+
+  def broadcast_to_regions(self, bus, message, locations=None):
+    """
+    Broadcast a message to every subscriber of the given region locations (by
+    default, the regions the entity is in). Each subscriber receives the
+    message at most once.
+    """
+    if locations is None:
+      locations = self.region_locations
+
+    packet = self.broadcast_to_protocols(
+        bus.get_protocols_for_regions(self.realm_id, locations), message)
+
+    # Subscribers to these regions elsewhere are reached through the bus.
+    bus.relay_to_regions(self.realm_id, locations, self.id, packet)
+
+  def broadcast_to_protocols(self, protocols, message):
+    return self.send_to_protocols(
+        [protocol for protocol in protocols
+         if protocol.policy.can_receive_broadcasts_from(self)],
+        message)
+
+  def send_to_protocols(self, protocols, message):
+    """
+    Send a message to many protocols. The packet is serialized once and the
+    same bytes are queued on every protocol.
+
+    :returns: The serialized packet.
+    """
+    packet = net.Protocol.serialize_packet(self.id, message)
+    packet_type = net.get_packet_type(message)
 
-  def broadcast_to_regions(self, bus, message):
-    return asyncio.gather(*[
-        self.broadcast(bus, region.channel, message)
-        for region in self.regions])
+    for protocol in protocols:
+      protocol.send_packet(packet, self.id, packet_type)
+
+    return packet
 
   @property
   def bus_key(self):
@@ -283,9 +438,35 @@ class EntityStore(record.PolymorphicProtobufStore):
   RECORD_TYPE = Entity
   PROTOBUF_TYPE = entities_pb2.Entity
 
-  def __init__(self, parent, kvs):
+  def __init__(self, parent, kvs, max_size=None):
     self.parent = parent
-    super().__init__(kvs)
+    super().__init__(kvs, max_size)
+
+  def is_pinned(self, entity):
+    # An entity that is still linked from a loaded region can't be evicted, or
+    # the region would end up referring to a stale copy of it.
+    if any(entity.realm.regions.is_loaded(location)
+           for location in entity.region_locations):
+      return True
+
+    return self.parent.is_entity_pinned(entity)
+
+  def is_owned(self, entity):
+    return self.parent.is_location_owned(entity.realm_id, entity.location)
+
+  def save(self, entity):
+    if self.is_owned(entity):
+      super().save(entity)
+
+  def save_many(self, entities):
+    super().save_many([entity for entity in entities if self.is_owned(entity)])
+
+  def save_for_handoff(self, entity):
+    """
+    Save an entity that has moved into a location owned by another shard,
+    before handing it off to that shard.
+    """
+    super().save(entity)
 
   def add(self, entity):
     super().add(entity)
@@ -294,10 +475,11 @@ class EntityStore(record.PolymorphicProtobufStore):
   def create(self, entity):
     super().create(entity)
     for region in entity.regions:
-      region.entities.add(entity)
+      region.add_entity(entity)
       entity.realm.regions.save(region)
 
   def destroy(self, entity):
     super().destroy(entity)
     for region in entity.regions:
-      region.entities.remove(entity)
+      region.remove_entity(entity)
+      region.mark_dirty()
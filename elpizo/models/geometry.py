@@ -1,51 +1,53 @@
-from elpizo.models import record
 from elpizo.protos import geometry_pb2
 from elpizo.util import geometry
 
 
-class Vector2(geometry.Vector2, record.ProtobufRecord):
+class Vector2(geometry.Vector2):
+  # The protobuf conversions live here rather than in util.geometry, so the
+  # value types used in hot code don't carry any record machinery.
+  __slots__ = ()
+
   PROTOBUF_TYPE = geometry_pb2.Vector2
-  FIELDS = [
-      record.Field("x", record.Scalar),
-      record.Field("y", record.Scalar),
-  ]
 
-  def __init__(self, x=None, y=None):
-    # We need to make the x and y parameters optional for deserialization to
-    # work.
-    super().__init__(x, y)
+  def to_protobuf(self):
+    return self.PROTOBUF_TYPE(x=self.x, y=self.y)
+
+  @classmethod
+  def from_protobuf(cls, proto):
+    return cls(proto.x, proto.y)
 
   def __repr__(self):
     return "models.geometry." + super().__repr__()
 
 
-class Vector3(geometry.Vector3, record.ProtobufRecord):
+class Vector3(geometry.Vector3):
+  __slots__ = ()
+
   PROTOBUF_TYPE = geometry_pb2.Vector3
-  FIELDS = [
-      record.Field("x", record.Scalar),
-      record.Field("y", record.Scalar),
-      record.Field("z", record.Scalar),
-  ]
 
-  def __init__(self, x=None, y=None, z=None):
-    super().__init__(x, y, z)
+  def to_protobuf(self):
+    return self.PROTOBUF_TYPE(x=self.x, y=self.y, z=self.z)
+
+  @classmethod
+  def from_protobuf(cls, proto):
+    return cls(proto.x, proto.y, proto.z)
 
   def __repr__(self):
     return "models.geometry." + super().__repr__()
 
 
-class Rectangle(geometry.Rectangle, record.ProtobufRecord):
+class Rectangle(geometry.Rectangle):
+  __slots__ = ()
+
   PROTOBUF_TYPE = geometry_pb2.Rectangle
-  FIELDS = [
-      record.Field("left", record.Scalar),
-      record.Field("top", record.Scalar),
-      record.Field("width", record.Scalar),
-      record.Field("height", record.Scalar),
-  ]
-
-  def __init__(self, left=None, top=None, width=None, height=None):
-    # We need to make all the parameters optional for deserialization to work.
-    super().__init__(left, top, width, height)
+
+  def to_protobuf(self):
+    return self.PROTOBUF_TYPE(left=self.left, top=self.top, width=self.width,
+                              height=self.height)
+
+  @classmethod
+  def from_protobuf(cls, proto):
+    return cls(proto.left, proto.top, proto.width, proto.height)
 
   def __repr__(self):
     return "models.geometry." + super().__repr__()
@@ -1,9 +1,14 @@
+import asyncio
+import collections
 import logging
 import math
+import zlib
 
 from elpizo.models import geometry
 from elpizo.models import record
+from elpizo.protos import packets_pb2
 from elpizo.protos import realm_pb2
+from elpizo.util import net
 
 
 logger = logging.getLogger(__name__)
@@ -18,13 +23,18 @@ class Realm(record.ProtobufRecord):
 
   def __init__(self, *args, **kwargs):
     self.regions = None
+
+    # Loaded regions, keyed by (x, y) location, such that tile lookups don't
+    # need to allocate any vectors.
+    self.region_mosaic = {}
+
     super().__init__(*args, **kwargs)
 
   @property
   def bounds(self):
     return geometry.Rectangle(0, 0, self.size.x, self.size.y)
 
-  def load_intersecting_regions(self, bounds):
+  def intersecting_region_locations(self, bounds):
     left = max([Region.floor(bounds.left), 0])
     top = max([Region.floor(bounds.top), 0])
     right = min([Region.ceil(bounds.right), self.size.x])
@@ -32,31 +42,66 @@ class Realm(record.ProtobufRecord):
 
     for y in range(top, bottom, Region.SIZE):
       for x in range(left, right, Region.SIZE):
-          yield self.regions.load(geometry.Vector2(x, y))
+          yield geometry.Vector2(x, y)
 
-  def is_terrain_passable_by(self, entity, bounds, direction):
-    if not self.bounds.contains(bounds):
+  def load_intersecting_regions(self, bounds):
+    for location in self.intersecting_region_locations(bounds):
+      yield self.regions.load(location)
+
+  def region_at(self, x, y):
+    """
+    Get the region containing the tile at (x, y), loading it if required.
+
+    :throws KeyError: The region does not exist.
+    """
+    region_x = Region.floor(x)
+    region_y = Region.floor(y)
+
+    region = self.region_mosaic.get((region_x, region_y))
+    if region is None:
+      region = self.regions.load(geometry.Vector2(region_x, region_y))
+    return region
+
+  def is_tile_terrain_passable(self, x, y, direction):
+    if not (0 <= x < self.size.x and 0 <= y < self.size.y):
       return False
 
     try:
-      regions = list(self.load_intersecting_regions(bounds))
+      region = self.region_at(x, y)
     except KeyError:
       return False
 
-    return all(region.is_terrain_passable_by(entity, bounds, direction)
-               for region in regions)
+    return bool((region.passability_bitmaps[direction] >>
+                 ((y - region.location.y) * Region.SIZE +
+                  (x - region.location.x))) & 0x1)
 
-  def is_passable_by(self, entity, bounds, direction):
-    if not self.bounds.contains(bounds):
+  def is_terrain_passable_by(self, entity, bounds, direction):
+    if not (0 <= bounds.left and bounds.right <= self.size.x and
+            0 <= bounds.top and bounds.bottom <= self.size.y):
       return False
 
-    try:
-      regions = list(self.load_intersecting_regions(bounds))
-    except KeyError:
+    for y in range(bounds.top, bounds.bottom):
+      for x in range(bounds.left, bounds.right):
+        if not self.is_tile_terrain_passable(x, y, direction):
+          return False
+
+    return True
+
+  def is_passable_by(self, entity, bounds, direction):
+    if not self.is_terrain_passable_by(entity, bounds, direction):
       return False
 
-    return all(region.is_passable_by(entity, bounds, direction)
-               for region in regions)
+    for y in range(bounds.top, bounds.bottom):
+      for x in range(bounds.left, bounds.right):
+        try:
+          region = self.region_at(x, y)
+        except KeyError:
+          return False
+
+        if not region.is_tile_unobstructed_for(entity, x, y, direction):
+          return False
+
+    return True
 
 
 class Layer(record.ProtobufRecord):
@@ -77,6 +122,14 @@ class Region(record.ProtobufRecord):
 
   SIZE = 16
 
+  _passability_bitmaps = None
+  _occupancy = None
+
+  terrain_version = 0
+
+  _public_snapshot = None
+  _public_snapshot_version = None
+
   @classmethod
   def floor(cls, x):
     return (x // cls.SIZE) * cls.SIZE
@@ -107,24 +160,181 @@ class Region(record.ProtobufRecord):
     proto.ClearField("entity_ids_idx")
     return proto
 
+  def get_public_snapshot(self, realm):
+    """
+    Get the serialized public protobuf of the region. It is cached until the
+    terrain of the region next changes.
+
+    :param realm: The realm the region belongs to.
+    :returns: A tuple of the etag of the snapshot and the snapshot itself.
+    """
+    if self._public_snapshot_version != self.terrain_version:
+      serialized = self.to_public_protobuf(realm).SerializeToString()
+      self._public_snapshot = (zlib.crc32(serialized), serialized)
+      self._public_snapshot_version = self.terrain_version
+
+    return self._public_snapshot
+
+  def make_region_packet(self, realm, client_etag=None):
+    """
+    Make a REGION packet from the cached snapshot of the region, without
+    re-encoding it.
+
+    :param realm: The realm the region belongs to.
+    :param client_etag: The etag of the copy of the region the client has
+                        cached, if any. If it is current, the region is left
+                        out of the packet.
+    """
+    etag, serialized = self.get_public_snapshot(realm)
+
+    packet = packets_pb2.RegionPacket(
+        realm_id=realm.id, location=self.location.to_protobuf(),
+        etag=etag).SerializeToString()
+
+    if client_etag != etag:
+      packet += net.encode_message_field(packets_pb2.RegionPacket, "region",
+                                         serialized)
+
+    return net.SerializedMessage(packets_pb2.RegionPacket, packet)
+
+  def mark_terrain_changed(self):
+    """
+    Mark the terrain (layers and passabilities) of the region as changed. This
+    only needs to be called after mutating them in place.
+    """
+    self.terrain_version += 1
+    self._passability_bitmaps = None
+
+  @property
+  def layers(self):
+    return self._layers
+
+  @layers.setter
+  def layers(self, layers):
+    self._layers = layers
+    self.mark_terrain_changed()
+
+  @property
+  def passabilities(self):
+    return self._passabilities
+
+  @passabilities.setter
+  def passabilities(self, passabilities):
+    self._passabilities = passabilities
+    self.mark_terrain_changed()
+
+  @property
+  def passability_bitmaps(self):
+    """
+    The passabilities of the region, decoded into one bitmap per direction. Bit
+    `y * SIZE + x` of `passability_bitmaps[direction]` is set if the tile at
+    (x, y) is passable in that direction.
+    """
+    if self._passability_bitmaps is None:
+      bitmaps = [0, 0, 0, 0]
+
+      for i, passability in enumerate(self.passabilities):
+        for direction in range(len(bitmaps)):
+          if (passability >> direction) & 0x1:
+            bitmaps[direction] |= 1 << i
+
+      self._passability_bitmaps = bitmaps
+
+    return self._passability_bitmaps
+
   def is_terrain_passable_by(self, entity, bounds, direction):
-    bounds = bounds.offset(self.location.negate())
+    # Clip the bounds to the region, in region coordinates.
+    left = max([bounds.left - self.location.x, 0])
+    top = max([bounds.top - self.location.y, 0])
+    right = min([bounds.right - self.location.x, Region.SIZE])
+    bottom = min([bounds.bottom - self.location.y, Region.SIZE])
 
-    for y in range(bounds.top, bounds.bottom):
-      for x in range(bounds.left, bounds.right):
-        if 0 <= x < Region.SIZE and 0 <= y < Region.SIZE and \
-          not ((self.passabilities[y * Region.SIZE + x] >> direction) & 0x1):
-          return False
+    if left >= right or top >= bottom:
+      return True
 
-    return True
+    row_mask = ((1 << (right - left)) - 1) << left
+    mask = 0
+    for y in range(top, bottom):
+      mask |= row_mask << (y * Region.SIZE)
 
-  def is_passable_by(self, entity, bounds, direction):
-    if not self.is_terrain_passable_by(entity, bounds, direction):
-      return False
+    return self.passability_bitmaps[direction] & mask == mask
+
+  @property
+  def entities(self):
+    return self._entities
 
-    return not any(target.bounds.intersects(bounds) and
-                   not target.is_passable_by(entity, direction)
-                   for target in self.entities)
+  @entities.setter
+  def entities(self, entities):
+    # Entities must be added and removed via add_entity() and remove_entity()
+    # rather than mutated in place, so that the occupancy grid stays in sync.
+    self._entities = entities
+    self._occupancy = None
+
+  @property
+  def occupancy(self):
+    """
+    A grid of the entities covering each tile of the region, keyed by (x, y)
+    in realm coordinates. Tiles that no entity covers are absent.
+    """
+    if self._occupancy is None:
+      self._occupancy = collections.defaultdict(set)
+      self._occupied_tiles = {}
+
+      for entity in self.entities:
+        self._occupy(entity)
+
+    return self._occupancy
+
+  def _occupy(self, entity):
+    bounds = entity.bounds
+
+    left = max([bounds.left, self.location.x])
+    top = max([bounds.top, self.location.y])
+    right = min([bounds.right, self.location.x + Region.SIZE])
+    bottom = min([bounds.bottom, self.location.y + Region.SIZE])
+
+    tiles = [(x, y) for y in range(top, bottom) for x in range(left, right)]
+    for tile in tiles:
+      self._occupancy[tile].add(entity)
+    self._occupied_tiles[entity] = tiles
+
+  def _vacate(self, entity):
+    for tile in self._occupied_tiles.pop(entity):
+      occupants = self._occupancy[tile]
+      occupants.remove(entity)
+      if not occupants:
+        del self._occupancy[tile]
+
+  def add_entity(self, entity):
+    self.entities.add(entity)
+    if self._occupancy is not None:
+      self._occupy(entity)
+
+  def remove_entity(self, entity):
+    self.entities.remove(entity)
+    if self._occupancy is not None:
+      self._vacate(entity)
+
+  def move_entity(self, entity):
+    """
+    Update the occupancy grid for an entity in the region that has moved.
+    """
+    if self._occupancy is not None:
+      self._vacate(entity)
+      self._occupy(entity)
+
+  def is_tile_unobstructed_for(self, entity, x, y, direction):
+    return all(target is entity or target.is_passable_by(entity, direction)
+               for target in self.occupancy.get((x, y), ()))
+
+  def is_unobstructed_for(self, entity, bounds, direction):
+    return all(self.is_tile_unobstructed_for(entity, x, y, direction)
+               for y in range(bounds.top, bounds.bottom)
+               for x in range(bounds.left, bounds.right))
+
+  def is_passable_by(self, entity, bounds, direction):
+    return self.is_terrain_passable_by(entity, bounds, direction) and \
+           self.is_unobstructed_for(entity, bounds, direction)
 
   @property
   def channel(self):
@@ -153,33 +363,141 @@ class RealmStore(record.ProtobufStore):
       logger.info("Saving all child regions for realm: %s", realm.id)
       realm.regions.save_all()
 
+  def save_many(self, realms):
+    realms = list(realms)
+    super().save_many(realms)
+
+    for realm in realms:
+      if realm.regions is not None:
+        logger.info("Saving all child regions for realm: %s", realm.id)
+        realm.regions.save_all()
+
+  def save_dirty(self, batch_size=None):
+    # Regions are saved along with their realm by save(), so we only need to
+    # save dirty regions of realms that are themselves clean.
+    clean_realms = [realm for realm in self.loaded_records.values()
+                    if not realm.is_dirty and realm.regions is not None]
+
+    n = super().save_dirty(batch_size)
+    for realm in clean_realms:
+      n += realm.regions.save_dirty(batch_size)
+    return n
+
 
 class RegionStore(record.ProtobufStore):
   RECORD_TYPE = Region
   PROTOBUF_TYPE = realm_pb2.Region
 
-  def __init__(self, realm, entities, kvs):
+  def __init__(self, realm, entities, kvs, max_size=None):
     self.realm = realm
     self.entities = entities
-    super().__init__(kvs)
+    super().__init__(kvs, max_size)
+
+  def is_pinned(self, region):
+    return self.entities.parent.is_region_pinned(region)
+
+  def add(self, region):
+    super().add(region)
+    self.realm.region_mosaic[region.location.x, region.location.y] = \
+        region
+
+  def expire(self, region):
+    super().expire(region)
+
+    key = (region.location.x, region.location.y)
+    if self.realm.region_mosaic.get(key) is region:
+      del self.realm.region_mosaic[key]
+
+  def is_loaded(self, vec):
+    return "{x},{y}".format(x=vec.x, y=vec.y) in self.loaded_records
 
   def load(self, vec):
     return super().load("{x},{y}".format(x=vec.x, y=vec.y))
 
+  @asyncio.coroutine
+  def load_async(self, vec):
+    return (yield from super().load_async("{x},{y}".format(x=vec.x, y=vec.y)))
+
+  def load_many(self, vecs):
+    return super().load_many("{x},{y}".format(x=vec.x, y=vec.y)
+                             for vec in vecs)
+
+  @asyncio.coroutine
+  def load_many_async(self, vecs):
+    return (yield from super().load_many_async(
+        "{x},{y}".format(x=vec.x, y=vec.y) for vec in vecs))
+
   def load_closest(self, location):
     return self.load(location.map(Region.floor))
 
   def find(self, id):
     region = super().find(id)
-    region.update(realm=self.realm,
-                  entities={self.entities.load(entity_id)
-                            for entity_id in region.entity_ids_idx})
+    self._resolve_entities([region])
+    return region
+
+  @asyncio.coroutine
+  def find_async(self, id):
+    region = yield from super().find_async(id)
+    yield from self._resolve_entities_async([region])
     return region
 
+  def find_many(self, ids):
+    regions = super().find_many(ids)
+    self._resolve_entities(regions.values())
+    return regions
+
+  @asyncio.coroutine
+  def find_many_async(self, ids):
+    regions = yield from super().find_many_async(ids)
+    yield from self._resolve_entities_async(regions.values())
+    return regions
+
+  def _resolve_entities(self, regions):
+    # Load the entities of all the regions in a single request, rather than
+    # one request per entity.
+    #
+    # The regions aren't in the cache yet, so their entities aren't pinned and
+    # we mustn't evict any entities until they are.
+    regions = list(regions)
+    entity_ids = self._get_entity_ids(regions)
+    self._bind_entities(regions, dict(zip(
+        entity_ids, self.entities.load_many(entity_ids, evict=False))))
+
+  @asyncio.coroutine
+  def _resolve_entities_async(self, regions):
+    regions = list(regions)
+    entity_ids = self._get_entity_ids(regions)
+    self._bind_entities(regions, dict(zip(
+        entity_ids,
+        (yield from self.entities.load_many_async(entity_ids, evict=False)))))
+
+  def _get_entity_ids(self, regions):
+    return [entity_id for region in regions
+                      for entity_id in region.entity_ids_idx]
+
+  def _bind_entities(self, regions, entities):
+    for region in regions:
+      region.update(realm=self.realm,
+                    entities={entities[entity_id]
+                              for entity_id in region.entity_ids_idx})
+
+  def is_owned(self, region):
+    return self.entities.parent.is_location_owned(self.realm.id,
+                                                  region.location)
+
   def save(self, region):
+    if not self.is_owned(region):
+      return
+
     region.update(entity_ids_idx=[entity.id for entity in region.entities])
     super().save(region)
 
+  def save_many(self, regions):
+    regions = [region for region in regions if self.is_owned(region)]
+    for region in regions:
+      region.update(entity_ids_idx=[entity.id for entity in region.entities])
+    super().save_many(regions)
+
   def keys(self):
     # We don't want to use the store's integer coercion.
     for key in self.kvs.keys():
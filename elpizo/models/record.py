@@ -23,32 +23,94 @@ class PolymorphicProtobufStore(ProtobufStore):
 
 
 class ProtobufRecord(record.Record):
-  FIELDS = []
+  """
+  A record that can be converted to and from a protobuf, according to the
+  `FIELDS` of the class and its superclasses.
 
-  def to_protobuf(self):
-    proto = self.PROTOBUF_TYPE()
+  The first time a class is converted, a serializer and deserializer
+  specialized for its fields are generated and cached on the class.
+  """
 
-    for superclass in self.__class__.__mro__:
+  FIELDS = []
+
+  @classmethod
+  def get_fields(cls):
+    for superclass in cls.__mro__:
       if not issubclass(superclass, ProtobufRecord):
         break
 
-      for field in superclass.FIELDS:
-        field.serialize_to(proto, self)
+      # Only take fields the class declares itself, otherwise a subclass that
+      # doesn't declare any would repeat the fields of its superclass. Looking
+      # them up with `superclass.FIELDS` did exactly that, for Avatar and the
+      # item classes.
+      yield from vars(superclass).get("FIELDS", [])
+
+  def to_protobuf(self):
+    cls = self.__class__
+
+    try:
+      serializer = cls.__dict__["_serializer"]
+    except KeyError:
+      serializer = cls._serializer = _compile_serializer(cls)
 
-    return proto
+    return serializer(self)
 
   @classmethod
   def from_protobuf(cls, proto):
-    record = cls()
+    try:
+      deserializer = cls.__dict__["_deserializer"]
+    except KeyError:
+      deserializer = cls._deserializer = _compile_deserializer(cls)
 
-    for superclass in cls.__mro__:
-      if not issubclass(superclass, ProtobufRecord):
-        break
+    return deserializer(proto)
 
-      for field in superclass.FIELDS:
-        field.deserialize_to(record, proto)
 
-    return record
+def _compile(name, cls, make_body):
+  namespace = {"cls": cls}
+  extensions = {}
+  lines = []
+
+  for i, field in enumerate(cls.get_fields()):
+    if field.extension is None:
+      target = "proto"
+    else:
+      # Look up each extension once, rather than once per field.
+      if field.extension not in extensions:
+        extensions[field.extension] = "ext{}".format(len(extensions))
+        namespace[extensions[field.extension] + "_descriptor"] = \
+            field.extension
+        lines.append("  {0} = proto.Extensions[{0}_descriptor]".format(
+            extensions[field.extension]))
+      target = extensions[field.extension]
+
+    type_name = "type{}".format(i)
+    namespace[type_name] = field.type
+    lines.extend(make_body(field, target, type_name))
+
+  exec("\n".join(lines).join(_TEMPLATES[name]), namespace)
+  return namespace[name]
+
+
+_TEMPLATES = {
+    "serialize": ("def serialize(record):\n"
+                  "  proto = cls.PROTOBUF_TYPE()\n",
+                  "\n  return proto\n"),
+    "deserialize": ("def deserialize(proto):\n"
+                    "  record = cls()\n",
+                    "\n  return record\n")
+}
+
+
+def _compile_serializer(cls):
+  return _compile("serialize", cls,
+                  lambda field, target, type_name:
+                      field.compile_serializer(target, type_name))
+
+
+def _compile_deserializer(cls):
+  return _compile("deserialize", cls,
+                  lambda field, target, type_name:
+                      field.compile_deserializer(target, type_name))
 
 
 class Scalar(object):
@@ -85,6 +147,32 @@ class Field(object):
         proto = proto.Extensions[self.extension]
       return proto
 
+  # serialize_to() and deserialize_to() interpret a field on every call. The
+  # compile_*() methods generate equivalent, specialized source code for
+  # ProtobufRecord to run instead.
+
+  def compile_serializer(self, target, type_name):
+    lines = ["  value = getattr(record, {!r}, None)".format(self.record_field),
+             "  if value is not None:"]
+
+    if self.type is Scalar:
+      lines.append("    {}.{} = value".format(target, self.proto_field))
+    else:
+      lines.append("    {}.{}.MergeFrom({}.to_protobuf(value))".format(
+          target, self.proto_field, type_name))
+
+    return lines
+
+  def compile_deserializer(self, target, type_name):
+    if self.type is Scalar:
+      value = "{}.{}".format(target, self.proto_field)
+    else:
+      value = "{}.from_protobuf({}.{})".format(type_name, target,
+                                               self.proto_field)
+
+    return ["  record.{} = {} if {}.HasField({!r}) else None".format(
+        self.record_field, value, target, self.proto_field)]
+
   def serialize_to(self, proto, record):
     proto = self.get_target_proto(proto)
     value = getattr(record, self.record_field, None)
@@ -104,6 +192,24 @@ class Field(object):
 
 
 class RepeatedField(Field):
+  def compile_serializer(self, target, type_name):
+    values = "getattr(record, {!r}, [])".format(self.record_field)
+
+    if self.type is not Scalar:
+      values = "({}.to_protobuf(value) for value in {})".format(type_name,
+                                                               values)
+
+    return ["  {}.{}.extend({})".format(target, self.proto_field, values)]
+
+  def compile_deserializer(self, target, type_name):
+    if self.type is Scalar:
+      value = "list({}.{})".format(target, self.proto_field)
+    else:
+      value = "[{}.from_protobuf(value) for value in {}.{}]".format(
+          type_name, target, self.proto_field)
+
+    return ["  record.{} = {}".format(self.record_field, value)]
+
   def serialize_to(self, proto, record):
     proto = self.get_target_proto(proto)
     getattr(proto, self.proto_field).extend(
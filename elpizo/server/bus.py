@@ -1,20 +1,50 @@
 import asyncio
+import asyncio_redis
 import collections
 import logging
+import uuid
 import websockets.exceptions
 
+from asyncio_redis import encoders
+from elpizo.models import geometry
+from elpizo.protos import bus_pb2
 from elpizo.util import green
+from elpizo.util import net
 
 
 logger = logging.getLogger(__name__)
 
 
 class Bus(object):
+  """
+  Routes packets to the protocols subscribed to channels in this process.
+  """
+
+  REGION_NAMESPACE = "region"
+
   def __init__(self):
     self.protocols = {}
     self.channels = collections.defaultdict(set)
     self.subscriptions = {}
 
+    # Spatial index of realm ID -> (x, y) region location -> bus keys, for
+    # region channels. This lets region broadcasts look up subscribers by
+    # location without building channel tuples.
+    self.region_subscribers = collections.defaultdict(
+        lambda: collections.defaultdict(set))
+
+    # Called with (realm ID, location, interested) when a region gains its
+    # first subscriber or loses its last one.
+    self.interest_listener = None
+
+    # Called with (realm ID, locations, origin, serialized packet) for every
+    # broadcast to regions, to pass it on to subscribers elsewhere.
+    self.region_relay = None
+
+    # Likewise, called with (channel, origin, serialized packet) for every
+    # broadcast to any other channel.
+    self.channel_relay = None
+
   def add(self, bus_key, protocol):
     logger.debug("Added key to bus: %d", bus_key)
 
@@ -33,15 +63,56 @@ class Bus(object):
     return self.protocols[bus_key]
 
   def get_protocols_for_channel(self, channel):
-    for bus_key in list(self.channels.get(channel, set())):
+    return self.get_protocols_for_channels([channel])
+
+  def get_protocols_for_channels(self, channels):
+    """
+    Get the protocols subscribed to any of the given channels. A protocol
+    subscribed to more than one of the channels is only returned once.
+    """
+    bus_keys = set()
+    for channel in channels:
+      bus_keys.update(self.channels.get(channel, ()))
+    return self._get_protocols(bus_keys)
+
+  def get_protocols_for_regions(self, realm_id, locations):
+    """
+    Get the protocols subscribed to any of the regions at the given locations
+    in a realm. A protocol subscribed to more than one of the regions is only
+    returned once.
+    """
+    index = self.region_subscribers.get(realm_id)
+    if index is None:
+      return []
+
+    bus_keys = set()
+    for location in locations:
+      bus_keys.update(index.get((location.x, location.y), ()))
+    return self._get_protocols(bus_keys)
+
+  def _get_protocols(self, bus_keys):
+    protocols = []
+    for bus_key in bus_keys:
       try:
-        yield self.get(bus_key)
+        protocols.append(self.get(bus_key))
       except KeyError:
         logger.warn("Client disappeared during channel query: %s", bus_key)
+    return protocols
+
+  def relay_to_regions(self, realm_id, locations, origin, packet):
+    if self.region_relay is not None:
+      self.region_relay(realm_id, locations, origin, packet)
+
+  def relay_to_channel(self, channel, origin, packet):
+    if self.channel_relay is not None:
+      self.channel_relay(channel, origin, packet)
 
   def has(self, bus_key):
     return bus_key in self.protocols
 
+  def has_subscribers(self, channel):
+    return bool(self.channels.get(channel))
+
   def send(self, bus_key, origin, message):
     try:
       protocol = self.get(bus_key)
@@ -54,6 +125,173 @@ class Bus(object):
     self.channels[channel].add(bus_key)
     self.subscriptions[bus_key].add(channel)
 
+    if channel[0] == self.REGION_NAMESPACE:
+      _, realm_id, location = channel
+      bus_keys = self.region_subscribers[realm_id][location.x, location.y]
+
+      if not bus_keys and self.interest_listener is not None:
+        self.interest_listener(realm_id, location, True)
+      bus_keys.add(bus_key)
+
   def unsubscribe(self, bus_key, channel):
     self.channels[channel].remove(bus_key)
+    if not self.channels[channel]:
+      del self.channels[channel]
     self.subscriptions[bus_key].remove(channel)
+
+    if channel[0] == self.REGION_NAMESPACE:
+      _, realm_id, location = channel
+      index = self.region_subscribers[realm_id]
+      index[location.x, location.y].remove(bus_key)
+      if not index[location.x, location.y]:
+        del index[location.x, location.y]
+
+        if self.interest_listener is not None:
+          self.interest_listener(realm_id, location, False)
+
+
+class RedisBus(Bus):
+  """
+  A bus that also reaches subscribers in other processes, over Redis pub/sub.
+
+  Broadcasts are delivered to subscribers in this process directly, and
+  published to Redis for everyone else. A process subscribes to a channel on
+  Redis once, when the channel gains its first local subscriber, however many
+  local subscribers it goes on to have.
+  """
+
+  CHANNEL_PREFIX = "bus"
+
+  def __init__(self, redis, redis_host, redis_port):
+    super().__init__()
+    self.redis = redis
+    self.redis_host = redis_host
+    self.redis_port = redis_port
+
+    # Identifies this process, so that it can skip its own broadcasts.
+    self.source = uuid.uuid4().bytes
+
+    # Region broadcasts are numbered, and the last number seen from every
+    # process is kept, so that a broadcast published to several regions is
+    # only delivered once.
+    self.sequence = 0
+    self.last_sequences = {}
+
+    # Redis channel -> bus channel, for the channels subscribed to.
+    self.redis_channels = {}
+    self.subscriber = None
+
+  @classmethod
+  def get_redis_channel(cls, channel):
+    if channel[0] == cls.REGION_NAMESPACE:
+      _, realm_id, location = channel
+      parts = [cls.REGION_NAMESPACE, realm_id, location.x, location.y]
+    else:
+      parts = channel
+
+    return ".".join([cls.CHANNEL_PREFIX] +
+                    [str(part) for part in parts]).encode("utf-8")
+
+  def subscribe(self, bus_key, channel):
+    is_new = channel not in self.channels
+    super().subscribe(bus_key, channel)
+
+    if is_new:
+      redis_channel = self.get_redis_channel(channel)
+      self.redis_channels[redis_channel] = channel
+
+      if self.subscriber is not None:
+        asyncio.async(self.subscriber.subscribe([redis_channel]))
+
+  def unsubscribe(self, bus_key, channel):
+    super().unsubscribe(bus_key, channel)
+
+    if channel not in self.channels:
+      redis_channel = self.get_redis_channel(channel)
+      del self.redis_channels[redis_channel]
+
+      if self.subscriber is not None:
+        asyncio.async(self.subscriber.unsubscribe([redis_channel]))
+
+  def relay_to_regions(self, realm_id, locations, origin, packet):
+    self.sequence += 1
+
+    message = bus_pb2.BusMessage(
+        source=self.source, sequence=self.sequence, realm_id=realm_id,
+        locations=[location.to_protobuf() for location in locations],
+        packet=packet)
+    if origin is not None:
+      message.origin = origin
+    data = message.SerializeToString()
+
+    for location in locations:
+      self.publish(self.get_redis_channel((self.REGION_NAMESPACE, realm_id,
+                                           location)), data)
+
+  def relay_to_channel(self, channel, origin, packet):
+    message = bus_pb2.BusMessage(source=self.source, packet=packet)
+    if origin is not None:
+      message.origin = origin
+
+    self.publish(self.get_redis_channel(channel), message.SerializeToString())
+
+  def publish(self, redis_channel, data):
+    # Publishes are sent in the order they're issued, as the Redis pool writes
+    # commands in order, so every process sees our broadcasts in order.
+    asyncio.async(self.redis.publish(redis_channel, data))
+
+  def on_published(self, redis_channel, data):
+    message = bus_pb2.BusMessage.FromString(data)
+
+    if message.source == self.source:
+      # We delivered this to our own subscribers before publishing it.
+      return
+
+    if message.HasField("sequence"):
+      if message.sequence <= self.last_sequences.get(message.source, 0):
+        # Already delivered, from the channel of another of its regions.
+        return
+      self.last_sequences[message.source] = message.sequence
+
+      protocols = self.get_protocols_for_regions(
+          message.realm_id,
+          [geometry.Vector2.from_protobuf(location)
+           for location in message.locations])
+    else:
+      try:
+        channel = self.redis_channels[redis_channel]
+      except KeyError:
+        # We unsubscribed while this was on its way.
+        return
+
+      protocols = self.get_protocols_for_channel(channel)
+
+    origin = message.origin if message.HasField("origin") else None
+    packet_type = net.peek_packet_type(message.packet)
+
+    for protocol in protocols:
+      protocol.send_packet(message.packet, origin, packet_type)
+
+  def run(self):
+    connection = green.await_coro(asyncio_redis.Connection.create(
+        host=self.redis_host, port=self.redis_port,
+        encoder=encoders.BytesEncoder()))
+
+    try:
+      subscriber = green.await_coro(connection.start_subscribe())
+
+      # Catch up on anything subscribed to before we were connected.
+      self.subscriber = subscriber
+      if self.redis_channels:
+        green.await_coro(subscriber.subscribe(list(self.redis_channels)))
+
+      while True:
+        reply = green.await_coro(subscriber.next_published())
+
+        try:
+          self.on_published(reply.channel, reply.value)
+        except Exception:
+          logger.exception("Failed to handle a bus message.")
+    finally:
+      self.subscriber = None
+      connection.close()
@@ -0,0 +1,45 @@
+import logging
+import signal
+import subprocess
+import sys
+
+from elpizo.server import server
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+  """
+  Run a server as a cluster of shards on this machine, one worker process per
+  shard. Takes the same arguments as the server.
+  """
+  config = server.make_config_parser(
+      description="Run a sharded server on this machine.").parse_args()
+
+  if config.num_shards < 2:
+    sys.exit("A cluster needs --num-shards of at least 2.")
+
+  logging.basicConfig(level=getattr(logging, config.log_level, None))
+
+  workers = []
+  for index in range(config.num_shards):
+    logger.info("Starting shard %d of %d.", index, config.num_shards)
+    workers.append(subprocess.Popen(
+        [sys.executable, "-m", "elpizo.server"] + sys.argv[1:] +
+        ["--shard-index", str(index)]))
+
+  try:
+    for worker in workers:
+      worker.wait()
+  except KeyboardInterrupt:
+    logger.info("Stopping shards.")
+  finally:
+    for worker in workers:
+      if worker.poll() is None:
+        worker.send_signal(signal.SIGINT)
+    for worker in workers:
+      worker.wait()
+
+
+if __name__ == "__main__":
+  main()
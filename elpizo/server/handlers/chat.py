@@ -1,16 +1,32 @@
+import asyncio
+
 from elpizo.protos import packets_pb2
+from elpizo.protos import shards_pb2
 from elpizo.util import net
 
 
+@asyncio.coroutine
 def on_chat(protocol, actor, message):
   ns, name = message.target.split(".")
 
   if ns not in ["chatroom", "conversation"]:
     raise net.ProtocolError("unknown chat namespace: {}".format(ns))
 
-  actor.broadcast(
-      protocol.server.bus,
-      (ns, name),
-      packets_pb2.ChatPacket(target=message.target,
-                             actor_name=actor.name,
-                             text=message.text))
+  chat_message = packets_pb2.ChatPacket(target=message.target,
+                                        actor_name=actor.name,
+                                        text=message.text)
+
+  actor.broadcast(protocol.server.bus, (ns, name), chat_message)
+
+
+def relay_chat(server, channel, origin, packet):
+  # Subscribers on other shards are reached through the shard link.
+  ns, name = channel
+  server.shard_link.publish_nowait(shards_pb2.ShardMessage(
+      chat=shards_pb2.ChatRelay(namespace=ns, name=name, packet=packet)))
+
+
+def on_chat_relay(server, source, relay):
+  for protocol in server.bus.get_protocols_for_channel((relay.namespace,
+                                                        relay.name)):
+    protocol.send_packet(relay.packet)
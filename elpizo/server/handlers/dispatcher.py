@@ -1,3 +1,5 @@
+import asyncio
+import contextlib
 import logging
 import traceback
 import websockets
@@ -6,11 +8,13 @@ from elpizo.protos import packets_pb2
 from elpizo.models import geometry
 from elpizo.server.handlers import chat
 from elpizo.server.handlers import echo
+from elpizo.server.handlers import handoff
 from elpizo.server.handlers import hello
 from elpizo.server.handlers import item
 from elpizo.server.handlers import move
 from elpizo.server.handlers import viewport
 from elpizo.server import policies
+from elpizo.util import green
 from elpizo.util import net
 
 logger = logging.getLogger(__name__)
@@ -19,12 +23,27 @@ logger = logging.getLogger(__name__)
 class Dispatcher(net.Protocol):
   HANDLERS = {}
 
-  def __init__(self, server, *args, **kwargs):
+  RELAY_CONTROL_PACKET_TYPES = {packets_pb2.Packet.HANDOFF}
+
+  def __init__(self, server, *args, is_private=False, **kwargs):
     super().__init__(*args, **kwargs)
     self.server = server
 
+    # Connections to the private port come from other shards (and NPC
+    # servers), which may hand a session off with the first packet.
+    self.is_private = is_private
+    self.accepts_handoff = is_private
+    self.handed_off = False
+
+    # The relay we moved away from while a relayed handoff is ending.
+    self.handoff_relay = None
+
   @classmethod
   def register(cls, type, f):
+    """
+    Register a handler for a packet type. Handlers may be asyncio coroutines,
+    or plain functions, which are run in greenlets on the native path.
+    """
     cls.HANDLERS[type] = f
 
   def bind_policy(self, policy):
@@ -37,6 +56,39 @@ class Dispatcher(net.Protocol):
     self.bind_policy(policies.UnauthenticatedPolicy())
 
   def on_message(self, origin, message):
+    actor, handler, timer = self.prepare_message(origin, message)
+
+    with timer:
+      try:
+        if asyncio.iscoroutinefunction(handler):
+          green.await_coro(handler(self, actor, message))
+        elif handler is not None:
+          handler(self, actor, message)
+      finally:
+        self.accepts_handoff = False
+
+  @asyncio.coroutine
+  def on_message_async(self, origin, message):
+    actor, handler, timer = self.prepare_message(origin, message)
+
+    with timer:
+      try:
+        if asyncio.iscoroutinefunction(handler):
+          yield from handler(self, actor, message)
+        elif handler is not None:
+          # Only handlers that haven't been ported to asyncio pay for a
+          # greenlet.
+          yield from green.coroutine(handler)(self, actor, message)
+      finally:
+        self.accepts_handoff = False
+
+  def prepare_message(self, origin, message):
+    """
+    Look up the actor and handler for a message.
+
+    :returns: The actor (if any), the handler (if any), and a context manager
+              timing the handler.
+    """
     actor = self.policy.get_actor(origin)
 
     if actor is None:
@@ -47,15 +99,26 @@ class Dispatcher(net.Protocol):
     type = message.DESCRIPTOR.GetOptions().Extensions[packets_pb2.packet_type]
     packet_name = Dispatcher.PACKET_NAMES.get(type, "opcode {}".format(type))
 
-    with self.server.statsd.timer("on_message"), \
-         self.server.statsd.timer("packets." + packet_name), \
-         self.server.statsd.timer("actors." + actor_id):
-      try:
-        handler = self.HANDLERS[type]
-      except KeyError:
-        logger.warn("Unhandled packet: %s", packet_name)
-      else:
-        handler(self, actor, message)
+    handler = self.HANDLERS.get(type)
+    if handler is None:
+      logger.warn("Unhandled packet: %s", packet_name)
+
+    return actor, handler, self.time_message(packet_name, actor_id)
+
+  @contextlib.contextmanager
+  def time_message(self, packet_name, actor_id):
+    statsd = self.server.statsd
+
+    with statsd.timer("on_message"), \
+         statsd.timer("packets." + packet_name), \
+         statsd.timer("actors." + actor_id):
+      yield
+
+  def on_relay_control(self, relay, origin, message):
+    handoff.on_relayed_handoff(self, relay, message)
+
+  def on_relay_closed(self, relay):
+    handoff.on_relay_closed(self, relay)
 
   def on_close(self):
     self.policy.on_finish()
@@ -80,6 +143,7 @@ class Dispatcher(net.Protocol):
 Dispatcher.register(packets_pb2.Packet.CHAT, chat.on_chat)
 Dispatcher.register(packets_pb2.Packet.DISCARD, item.on_discard)
 Dispatcher.register(packets_pb2.Packet.ECHO, echo.on_echo)
+Dispatcher.register(packets_pb2.Packet.HANDOFF, handoff.on_handoff)
 Dispatcher.register(packets_pb2.Packet.HELLO, hello.on_hello)
 Dispatcher.register(packets_pb2.Packet.PICK_UP, item.on_pick_up)
 Dispatcher.register(packets_pb2.Packet.MODIFY_EQUIPMENT,
@@ -1,2 +1,6 @@
+import asyncio
+
+
+@asyncio.coroutine
 def on_echo(protocol, actor, message):
   protocol.send(None, message)
@@ -0,0 +1,270 @@
+import hashlib
+import logging
+import struct
+import time
+
+from elpizo.models import geometry
+from elpizo.protos import packets_pb2
+from elpizo.server import bus
+from elpizo.server import policies
+from elpizo.util import mint
+from elpizo.util import net
+
+logger = logging.getLogger(__name__)
+
+# Handoff tokens only need to outlive the handoff itself.
+TOKEN_EXPIRY = 30
+TOKEN_FORMAT = "!II"
+
+
+def hand_off(protocol, actor, shard):
+  """
+  Hand an actor's session off to another shard, without the client
+  reconnecting.
+
+  If the client is connected to this shard, its connection is relayed to the
+  other shard from here on. If its connection is relayed to us from another
+  shard, the handoff is sent back for that shard to re-point its relay.
+
+  :param protocol: The protocol the actor is on.
+  :param actor: The actor, which must be a player.
+  :param shard: The shard that now owns the actor.
+  """
+  server = protocol.server
+  start_time = time.monotonic()
+
+  packet = net.Protocol.serialize_packet(
+      None, make_handoff_packet(protocol, actor, shard, start_time))
+
+  # Anything the client sends from now on is for the new owner.
+  protocol.hold()
+
+  if protocol.is_private:
+    detach(protocol, actor)
+
+    # The held packets are returned to the relaying shard at the end of the
+    # handoff.
+    send_control_packet(protocol, packet)
+  else:
+    try:
+      transport = server.shards.connect(shard)
+    except Exception:
+      # The actor isn't saved where it is now, so its next session starts
+      # from where it was last saved, on our side of the boundary.
+      logger.exception("Could not connect to shard %s to hand off %s.",
+                       shard, actor.id)
+      protocol.transport.close()
+      return
+
+    detach(protocol, actor)
+
+    protocol.relay_to(transport, packet)
+    protocol.release()
+
+  logger.info("Handed off %s to shard %s.", actor.id, shard)
+  server.statsd.incr("shards.handoffs")
+  server.statsd.timing("shards.handoff",
+                       (time.monotonic() - start_time) * 1000)
+
+
+def make_handoff_packet(protocol, actor, shard, now):
+  ephemera = protocol.get_ephemera(actor)
+
+  sighted_regions = []
+  for channel in protocol.server.bus.subscriptions[actor.bus_key]:
+    if channel[0] == bus.Bus.REGION_NAMESPACE:
+      _, realm_id, location = channel
+      if realm_id == actor.realm_id:
+        sighted_regions.append(location.to_protobuf())
+
+  entity = protocol.server.store.entities.serialize(actor)
+
+  # Times are sent as ages, as clocks aren't comparable between processes.
+  return packets_pb2.HandoffPacket(
+      target_shard=shard,
+      entity_id=actor.id,
+      entity=entity,
+      token=protocol.server.mint.mint(
+          make_token_body(actor.id, shard, entity), expiry=TOKEN_EXPIRY),
+      location_log=[
+          packets_pb2.HandoffPacket.LocationLogEntry(
+              age=now - log_time, location=location.to_protobuf())
+          for log_time, location in actor.location_log],
+      last_move_age=now - ephemera.last_move_time,
+      sighted_regions=sighted_regions,
+      supports_batching=protocol.transport.batch_interval is not None)
+
+
+def make_token_body(entity_id, shard, entity):
+  return struct.pack(TOKEN_FORMAT, entity_id, shard) + \
+         hashlib.sha256(entity).digest()
+
+
+def check_token(protocol, message):
+  """
+  Check that a handoff was minted by a shard, for this entity and shard.
+
+  :throws net.ProtocolError: If the handoff's token isn't valid.
+  """
+  try:
+    body = protocol.server.mint.unmint(message.token)
+  except mint.InvalidTokenError as e:
+    raise net.ProtocolError("Invalid handoff token: {}".format(e))
+
+  if body != make_token_body(message.entity_id, message.target_shard,
+                             message.entity):
+    raise net.ProtocolError("Handoff token is for another handoff.")
+
+
+def send_control_packet(protocol, packet):
+  # Handoffs are never batched, so they go out straight away.
+  protocol.send_packet(packet, None, packets_pb2.Packet.HANDOFF)
+  protocol.transport.end_batch()
+
+
+def detach(protocol, actor):
+  """
+  Remove every trace of a handed off actor from this shard.
+
+  The actor is saved first, so that anything reading it from the store (such
+  as routing the client's next HELLO) finds it where the new owner has it.
+  """
+  server = protocol.server
+
+  server.store.entities.save_for_handoff(actor)
+
+  protocol.bind_policy(policies.UnauthenticatedPolicy())
+  protocol.handed_off = True
+
+  actor.remove_from_bus(server.bus)
+
+  for region in actor.regions:
+    if actor in region.entities:
+      region.remove_entity(actor)
+      region.mark_dirty()
+
+  # The new owner saves the actor from now on.
+  server.store.entities.expire(actor)
+
+
+def adopt(protocol, message):
+  """
+  Take over an actor's session from another shard.
+  """
+  server = protocol.server
+  entity_store = server.store.entities
+  now = time.monotonic()
+
+  actor = entity_store.deserialize(message.entity_id, message.entity)
+
+  stale = entity_store.loaded_records.get(actor.id)
+  if stale is not None:
+    # We may have a read-only copy of the actor from watching its old regions.
+    for location in stale.region_locations:
+      region = stale.realm.region_mosaic.get((location.x, location.y))
+      if region is not None and stale in region.entities:
+        region.remove_entity(stale)
+    entity_store.expire(stale)
+
+  entity_store.add(actor)
+
+  for entry in message.location_log:
+    actor.log_location(now - entry.age,
+                       geometry.Vector3.from_protobuf(entry.location))
+
+  policy = policies.PlayerPolicy(actor.id, server)
+  if message.HasField("last_move_age"):
+    policy.ephemera.last_move_time = now - message.last_move_age
+
+  if message.supports_batching and server.config.batch_interval > 0:
+    protocol.transport.enable_batching(server.config.batch_interval,
+                                       server.config.max_batch_size)
+
+  protocol.bind_policy(policy)
+  protocol.handed_off = False
+  policy.join(protocol)
+
+  for region in actor.regions:
+    if actor not in region.entities:
+      region.add_entity(actor)
+      region.mark_dirty()
+  actor.mark_dirty()
+
+  for location in message.sighted_regions:
+    region = actor.realm.regions.load(geometry.Vector2.from_protobuf(location))
+    actor.subscribe(server.bus, region.channel)
+
+  # Subscribers on this side of the boundary haven't seen the actor arrive.
+  actor.broadcast_to_regions(server.bus, actor.make_entity_packet())
+
+  logger.info("Adopted %s from another shard.", actor.id)
+
+
+def on_handoff(protocol, actor, message):
+  if not message.HasField("entity"):
+    # The relaying shard has stopped relaying to us, so we return what it
+    # relayed after we handed off.
+    if not protocol.is_private or not protocol.handed_off:
+      raise net.ProtocolError("Unexpected end of handoff.")
+
+    send_control_packet(protocol, net.Protocol.serialize_packet(
+        None,
+        packets_pb2.HandoffPacket(target_shard=message.target_shard,
+                                  returned_packets=protocol.take_held())))
+    return
+
+  if not protocol.accepts_handoff:
+    raise net.ProtocolError("Unexpected handoff.")
+
+  if message.target_shard != protocol.server.shards.index:
+    raise net.ProtocolError("Handoff to the wrong shard: {}".format(
+        message.target_shard))
+
+  check_token(protocol, message)
+  adopt(protocol, message)
+
+
+def on_relayed_handoff(protocol, relay, message):
+  if not message.HasField("entity"):
+    if relay is not protocol.handoff_relay:
+      logger.warn("Unexpected end of handoff.")
+      return
+
+    # Packets the old owner returned were sent before anything we held.
+    protocol.handoff_relay = None
+    protocol.release(*message.returned_packets)
+    relay.close()
+    return
+
+  # The shard we relay to handed the session off, so we re-point the relay at
+  # the new owner, or take the session over if that's us. Either way, relays
+  # are never more than one hop.
+  server = protocol.server
+
+  protocol.hold()
+  protocol.handoff_relay = relay
+  protocol.relay = None
+
+  try:
+    if message.target_shard == server.shards.index:
+      adopt(protocol, message)
+    else:
+      protocol.relay_to(server.shards.connect(message.target_shard),
+                        net.Protocol.serialize_packet(None, message))
+  except Exception:
+    logger.exception("Could not take over a handoff to shard %s.",
+                     message.target_shard)
+    protocol.transport.close()
+    return
+
+  relay.send(net.Protocol.serialize_packet(
+      None, packets_pb2.HandoffPacket(target_shard=message.target_shard)))
+
+
+def on_relay_closed(protocol, relay):
+  if relay is protocol.handoff_relay:
+    # The old owner went away before ending the handoff, so there's nothing
+    # more to wait for.
+    logger.warn("Relay closed before the end of a handoff.")
+    protocol.handoff_relay = None
+    protocol.release()
@@ -0,0 +1,247 @@
+import argparse
+import asyncio
+import io
+import statsd
+import unittest
+import websockets.exceptions
+
+from Crypto.PublicKey import RSA
+
+from elpizo.client.npc_server import store
+from elpizo.models import entities
+from elpizo.models import geometry
+from elpizo.models import realm
+from elpizo.models.items import registry
+from elpizo.protos import packets_pb2
+from elpizo.server import bus
+from elpizo.server import handlers
+from elpizo.server import policies
+from elpizo.server import server
+from elpizo.server import shard
+from elpizo.util import green
+from elpizo.util import mint
+from elpizo.util import net
+
+
+REALM_ID = 1
+PLAYER_ID = 1
+
+
+class MemoryWebSocket(object):
+  """
+  One end of a websocket between two coroutines in this process.
+  """
+
+  def __init__(self):
+    self.packets = asyncio.Queue()
+    self.peer = None
+    self.open = True
+
+  @classmethod
+  def pair(cls):
+    left, right = cls(), cls()
+    left.peer = right
+    right.peer = left
+    return left, right
+
+  @asyncio.coroutine
+  def send(self, packet):
+    if not self.open:
+      raise websockets.exceptions.InvalidState("Connection is closed.")
+    yield from self.peer.packets.put(packet)
+
+  @asyncio.coroutine
+  def recv(self):
+    packet = yield from self.packets.get()
+    if packet is None:
+      self.open = False
+    return packet
+
+  @asyncio.coroutine
+  def close(self):
+    if self.open:
+      self.open = False
+      yield from self.packets.put(None)
+      yield from self.peer.packets.put(None)
+
+
+class MemoryStore(store.Store):
+  """
+  A game store on tables shared by every shard, as Redis is.
+  """
+
+  def __init__(self, shards, tables):
+    self.shards = shards
+    self.tables = tables
+    self.realms = realm.RealmStore(self, store.DictAdapter(tables["realms"]))
+    self.entities = entities.EntityStore(
+        self, store.DictAdapter(tables["entities"]))
+
+  def make_region_store(self, r):
+    return realm.RegionStore(r, self.entities,
+                             store.DictAdapter(self.tables["regions"]))
+
+  def is_location_owned(self, realm_id, location):
+    return self.shards.is_local_location(realm_id, location)
+
+
+class MemoryShardMap(shard.ShardMap):
+  def __init__(self, servers, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.servers = servers
+
+  def connect(self, index):
+    # Connecting waits on IO, as it would over the network.
+    green.await_coro(asyncio.sleep(0))
+
+    left, right = MemoryWebSocket.pair()
+    asyncio.async(handlers.Dispatcher(self.servers[index],
+                                      net.Transport(right),
+                                      is_private=True).run_async())
+    return net.Transport(left)
+
+
+class Shard(object):
+  """
+  A shard, with everything the packet handlers need from a server, running
+  without a world tick.
+  """
+
+  world_tick = None
+  debug = True
+  shard_link = None
+
+  submit = server.Server.submit
+
+  def __init__(self, num_shards, index, servers, tables, mint):
+    self.config = argparse.Namespace(batch_interval=0, max_batch_size=8192)
+    self.shards = MemoryShardMap(servers, num_shards, index, "localhost", 0,
+                                 stripe_width=1)
+    self.bus = bus.Bus()
+    self.store = MemoryStore(self.shards, tables)
+    self.statsd = statsd.StatsClient(prefix="elpizo.tests")
+    self.mint = mint
+
+    servers[index] = self
+
+  def is_local_location(self, realm_id, location):
+    return self.shards.is_local_location(realm_id, location)
+
+
+class PlayerDispatcher(handlers.Dispatcher):
+  def on_open(self):
+    super().on_open()
+
+    # Clients are logged in without a minted token.
+    policy = policies.PlayerPolicy(PLAYER_ID, self.server)
+    self.bind_policy(policy)
+    policy.on_hello(self)
+
+
+def make_tables():
+  tables = {"realms": {}, "regions": {}, "entities": {}}
+
+  tables["realms"][REALM_ID] = realm.RealmStore.serialize(
+      realm.Realm(name="Test", size=geometry.Vector2(realm.Region.SIZE * 2,
+                                                     realm.Region.SIZE)))
+
+  # The player starts on the east edge of the first region.
+  tables["entities"][PLAYER_ID] = entities.EntityStore.serialize(
+      entities.Player(
+          name="test", gender="female", body="light", facial=None, hair=None,
+          direction=3, health=10, realm_id=REALM_ID,
+          location=geometry.Vector3(realm.Region.SIZE - 1, 0, 0),
+          bbox=geometry.Rectangle(0, 0, 1, 1), inventory=[], head_item=None,
+          torso_item=None, legs_item=None, feet_item=None, weapon=None,
+          online=True))
+
+  for x in [0, realm.Region.SIZE]:
+    tables["regions"]["{x},0".format(x=x)] = realm.RegionStore.serialize(
+        realm.Region(
+            location=geometry.Vector2(x, 0), layers=[],
+            passabilities=[0b1111] * (realm.Region.SIZE * realm.Region.SIZE),
+            entity_ids_idx=[PLAYER_ID] if x == 0 else []))
+
+  return tables
+
+
+class HandOffTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    registry.initialize()
+    cls.mint = mint.Mint(io.BytesIO(RSA.generate(1024).exportKey()))
+
+  def setUp(self):
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.loop)
+
+    self.tables = make_tables()
+
+    servers = {}
+    self.shards = [Shard(2, index, servers, self.tables, self.mint)
+                   for index in range(2)]
+
+  def tearDown(self):
+    self.loop.close()
+    asyncio.set_event_loop(None)
+
+  def run_client(self, f):
+    self.loop.run_until_complete(asyncio.wait_for(green.coroutine(f)(), 5))
+
+  def test_crossing_in_native_mode(self):
+    start = geometry.Vector3(realm.Region.SIZE - 1, 0, 0)
+    end = start.offset(entities.Entity.DIRECTION_VECTORS[3])
+
+    old_owner = self.shards[self.shards[0].shards.get_shard_for_location(
+        REALM_ID, start)]
+    new_owner = self.shards[self.shards[0].shards.get_shard_for_location(
+        REALM_ID, end)]
+    self.assertIsNot(old_owner, new_owner)
+
+    protocol = None
+
+    def client():
+      nonlocal protocol
+
+      left, right = MemoryWebSocket.pair()
+      protocol = PlayerDispatcher(old_owner, net.Transport(right))
+      session = asyncio.async(protocol.run_async())
+      transport = net.Transport(left)
+
+      def echo(*messages):
+        for message in messages + (packets_pb2.EchoPacket(payload="echo"),):
+          transport.send(net.Protocol.serialize_packet(None, message))
+
+        while True:
+          for _, message in net.Protocol.deserialize_packets(
+              transport.recv()):
+            if isinstance(message, packets_pb2.EchoPacket):
+              return
+
+      echo()
+
+      # Moves must be spaced out for the server to accept them.
+      green.await_coro(asyncio.sleep(1 / entities.Actor.BASE_SPEED))
+      echo(packets_pb2.MovePacket(location=end.to_protobuf()))
+
+      transport.close()
+      green.await_coro(session)
+
+    self.run_client(client)
+
+    self.assertNotIn(PLAYER_ID, old_owner.store.entities.loaded_records)
+    self.assertEqual(
+        new_owner.store.entities.loaded_records[PLAYER_ID].location, end)
+
+    # The old owner saved the player as it handed it off.
+    self.assertEqual(entities.EntityStore.deserialize(
+        PLAYER_ID, self.tables["entities"][PLAYER_ID]).location, end)
+
+    # The client closed first, but the old owner still stopped writing to it,
+    # and to the relay.
+    self.assertTrue(protocol.transport.writer.done())
+    self.assertTrue(protocol.relay.writer.done())
+
+
+if __name__ == "__main__":
+  unittest.main()
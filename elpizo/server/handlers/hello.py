@@ -1,7 +1,7 @@
+import asyncio
 import functools
 
 from elpizo.models import entities
-from elpizo.protos import packets_pb2
 from elpizo.server import policies
 from elpizo.util import mint
 from elpizo.util import net
@@ -21,11 +21,31 @@ def on_hello(protocol, actor, message):
     raise net.ProtocolError("Unknown authentication realm: {}".format(
         auth_realm))
 
-  policy = policy_factory(id, protocol.server)
+  server = protocol.server
+
+  if auth_realm == "player" and server.shards is not None:
+    player = server.store.entities.find(int(id))
+
+    if not server.is_local_location(player.realm_id, player.location):
+      # The player belongs to another shard, so we relay the connection there,
+      # starting with this packet.
+      protocol.hold()
+      protocol.relay_to(
+          server.shards.connect(server.shards.get_shard_for_location(
+              player.realm_id, player.location)),
+          net.Protocol.serialize_packet(None, message))
+      protocol.release()
+      return
+
+  if message.supports_batching and server.config.batch_interval > 0:
+    protocol.transport.enable_batching(server.config.batch_interval,
+                                       server.config.max_batch_size)
+
+  policy = policy_factory(id, server)
   protocol.bind_policy(policy)
   policy.on_hello(protocol)
 
 
+@asyncio.coroutine
 def on_whoami(protocol, actor, message):
-  actor.send(protocol,
-             packets_pb2.EntityPacket(entity=actor.to_protected_protobuf()))
+  actor.send(protocol, actor.make_entity_packet(protected=True))
@@ -22,6 +22,7 @@ def on_pick_up(protocol, actor, message):
   actor.send(protocol,
              packets_pb2.InventoryPacket(item=drop.item.to_protobuf()))
   actor.inventory_dict[drop.item.id] = drop.item
+  actor.mark_dirty()
   protocol.server.store.entities.destroy(drop)
 
 
@@ -33,14 +34,13 @@ def on_discard(protocol, actor, message):
   except KeyError:
     # The client probably has a stale list.
     return
+  actor.mark_dirty()
 
   drop = entities.Drop(item=item, location=actor.location,
                        realm_id=actor.realm_id)
   protocol.server.store.entities.create(drop)
 
-  drop.broadcast_to_regions(
-      protocol.server.bus,
-      packets_pb2.EntityPacket(entity=drop.to_public_protobuf()))
+  drop.broadcast_to_regions(protocol.server.bus, drop.make_entity_packet())
 
 
 def on_modify_equipment(protocol, actor, message):
@@ -71,6 +71,7 @@ def on_modify_equipment(protocol, actor, message):
       return
 
     setattr(actor, slot_name, equipment)
+    actor.mark_dirty()
 
     # Make the client place the item in slot 0 of the player's inventory (since
     # the client should have 0 information for the inventories of other actors
@@ -87,6 +88,7 @@ def on_modify_equipment(protocol, actor, message):
     # Handle dequipping.
     setattr(actor, slot_name, None)
     actor.inventory_dict[current_equipment.id] = current_equipment
+    actor.mark_dirty()
 
     actor.broadcast_to_regions(
         protocol.server.bus,
@@ -1,14 +1,43 @@
+import asyncio
 import time
 
 from elpizo.models import entities
 from elpizo.models import geometry
 from elpizo.protos import packets_pb2
+from elpizo.server.handlers import handoff
 from elpizo.util import green
+from elpizo.util import net
 
 
+def get_move_region_locations(actor, location):
+  # The regions the actor is in are included, as it's removed from the ones it
+  # leaves.
+  return set(actor.region_locations) | \
+         set(actor.realm.intersecting_region_locations(
+             actor.bbox.offset(location)))
+
+
+@asyncio.coroutine
 def on_move(protocol, actor, message):
-  ephemera = protocol.get_ephemera(actor)
   now = time.monotonic()
+
+  # Every region the move touches is loaded up front, so that applying it never
+  # waits on IO.
+  expected_location = geometry.Vector3.from_protobuf(message.location)
+
+  try:
+    yield from actor.realm.regions.load_many_async(
+        list(get_move_region_locations(actor, expected_location)))
+  except KeyError:
+    # A region that doesn't exist is impassable, which applying the move
+    # handles.
+    pass
+
+  protocol.server.submit(apply_move, protocol, actor, message, now)
+
+
+def apply_move(protocol, actor, message, now):
+  ephemera = protocol.get_ephemera(actor)
   dt = now - ephemera.last_move_time
 
   old_location = actor.location
@@ -17,30 +46,37 @@ def on_move(protocol, actor, message):
 
   expected_location = geometry.Vector3.from_protobuf(message.location)
 
+  server = protocol.server
+  is_local = server.is_local_location(actor.realm_id, new_location)
+
+  # The speed check compensates for slow connections by 0.25. NPCs can't leave
+  # the shard that simulates them, so a shard boundary is a wall to them.
   if new_location != expected_location or \
-      dt < 1 / actor.speed * 0.25: # compensate for slow connections by 0.25
+      dt < 1 / actor.speed * 0.25 or \
+      (not is_local and not protocol.policy.can_hand_off):
     actor.send(protocol, packets_pb2.TeleportPacket(
         location=actor.location.to_protobuf(),
         direction=actor.direction))
     return
 
-  old_regions = list(actor.regions)
-
-  # BEGIN CRITICAL SECTION: We need to update the location of the actor, and
-  # ensure no conflicting writes occur due to greenlet switching during IO.
-  #
-  # Passability checking MUST be done within the critical section, as we only
-  # know where we're moving to within the critical section.
-  with green.locking(actor.location_lock):
-    # Check for realm passability.
-    passable = actor.realm.is_passable_by(actor,
-                                          actor.bbox.offset(new_location),
-                                          actor.direction)
-
-    if passable:
-      with actor.movement():
-        actor.location = new_location
-  # END CRITICAL SECTION
+  # This list is only replaced (never mutated) when the actor crosses a region
+  # boundary, so it's safe to hold on to.
+  old_region_locations = actor.region_locations
+
+  # Checking passability and moving happen without yielding, so nothing else
+  # can move into the same tiles in between, and no lock is needed. If a region
+  # the move touches was evicted since it was loaded, the move is rejected
+  # rather than waiting on IO to load it again.
+  realm = actor.realm
+  passable = all(realm.regions.is_loaded(location)
+                 for location in get_move_region_locations(actor,
+                                                           new_location)) and \
+             realm.is_passable_by(actor, actor.bbox.offset(new_location),
+                                  actor.direction)
+
+  if passable:
+    with actor.movement():
+      actor.location = new_location
 
   if not passable:
     actor.send(protocol, packets_pb2.TeleportPacket(
@@ -48,51 +84,73 @@ def on_move(protocol, actor, message):
         direction=actor.direction))
     return
 
-  # We don't need strict sequentiality of the location log, so we keep this out
-  # of the critical section.
   ephemera.last_move_time = now
   actor.log_location(now, old_location)
   actor.retain_log_after(now - 1)
 
-  new_region_locations = set(region.location for region in actor.regions)
-  old_region_locations = set(region.location for region in old_regions)
+  new_region_locations = actor.region_locations
 
-  added_region_locations = new_region_locations - old_region_locations
-  removed_region_locations = old_region_locations - new_region_locations
+  if new_region_locations is not old_region_locations:
+    added_region_locations = set(new_region_locations) - \
+                             set(old_region_locations)
+    removed_region_locations = set(old_region_locations) - \
+                               set(new_region_locations)
 
-  # Broadcast ENTER to the regions the entity is entering.
-  actor_protobuf = actor.to_public_protobuf()
+    # Broadcast ENTER to the regions the entity is entering. The cached
+    # snapshot of the actor is spliced into each packet.
+    actor_field = net.encode_message_field(packets_pb2.EnterPacket, "entity",
+                                           actor.public_snapshot)
 
-  for region_location in removed_region_locations:
-    for new_region_location in new_region_locations:
-      actor.broadcast(
+    for region_location in removed_region_locations:
+      actor.broadcast_to_regions(
           protocol.server.bus,
-          ("region", actor.realm.id, new_region_location),
-          packets_pb2.EnterPacket(
-              location=region_location.to_protobuf(),
-              entity=actor_protobuf))
-
-  # Broadcast EXIT to the regions the entity is exiting.
-  for region_location in added_region_locations:
-    for old_region_location in old_region_locations:
-      actor.broadcast(
+          net.SerializedMessage(
+              packets_pb2.EnterPacket,
+              # The entity field is required, so the rest of the packet is
+              # partial until the actor field is appended.
+              packets_pb2.EnterPacket(
+                  location=region_location.to_protobuf())
+                  .SerializePartialToString() + actor_field),
+          new_region_locations)
+
+    # Broadcast EXIT to the regions the entity is exiting.
+    for region_location in added_region_locations:
+      actor.broadcast_to_regions(
           protocol.server.bus,
-          ("region", actor.realm.id, old_region_location),
-          packets_pb2.ExitPacket(
-              location=region_location.to_protobuf()))
+          packets_pb2.ExitPacket(location=region_location.to_protobuf()),
+          old_region_locations)
 
   # For every region that we moved from, we broadcast that we moved.
-  for region in old_regions:
-    actor.broadcast(
-        protocol.server.bus,
-        region.channel,
-        packets_pb2.MovePacket(location=new_location.to_protobuf()))
+  actor.broadcast_to_regions(
+      protocol.server.bus,
+      packets_pb2.MovePacket(location=new_location.to_protobuf()),
+      old_region_locations)
+
+  if not is_local:
+    # The actor crossed into a region owned by another shard. Handing it off
+    # may wait on IO, so on the native path it gets a greenlet of its own.
+    green.spawn(handoff.hand_off, protocol, actor,
+                server.shards.get_shard_for_location(actor.realm_id,
+                                                     new_location))
 
 
+@asyncio.coroutine
 def on_stop_move(protocol, actor, message):
+  # This is submitted (rather than broadcast immediately) so it stays ordered
+  # with moves.
+  protocol.server.submit(apply_stop_move, protocol, actor, message)
+
+
+def apply_stop_move(protocol, actor, message):
   actor.broadcast_to_regions(protocol.server.bus, message)
 
 
+@asyncio.coroutine
 def on_turn(protocol, actor, message):
+  protocol.server.submit(apply_turn, protocol, actor, message)
+
+
+def apply_turn(protocol, actor, message):
   actor.direction = message.direction
+  actor.mark_dirty()
   actor.broadcast_to_regions(protocol.server.bus, message)
@@ -1,17 +1,18 @@
+import asyncio
+
 from elpizo.models import entities
 from elpizo.models import geometry
 from elpizo.protos import packets_pb2
 from elpizo.util import green
 
 
+@asyncio.coroutine
 def on_sight(protocol, actor, message):
-  region = actor.realm.regions.load(geometry.Vector2.from_protobuf(
-      message.location))
+  region = yield from actor.realm.regions.load_async(
+      geometry.Vector2.from_protobuf(message.location))
 
-  protocol.send(None, packets_pb2.RegionPacket(
-      realm_id=actor.realm.id,
-      location=region.location.to_protobuf(),
-      region=region.to_protobuf()))
+  protocol.send(None, region.make_region_packet(
+      actor.realm, message.etag if message.HasField("etag") else None))
 
   # The client may receive extraneous packets regarding entities it doesn't
   # yet know about, but it will eventually receive up-to-date information
@@ -20,13 +21,13 @@ def on_sight(protocol, actor, message):
 
   for entity in list(region.entities):
     if entity.id != actor.id:
-      entity.send(protocol,
-                  packets_pb2.EntityPacket(entity=entity.to_public_protobuf()))
+      entity.send(protocol, entity.make_entity_packet())
 
 
+@asyncio.coroutine
 def on_unsight(protocol, actor, message):
-  region = actor.realm.regions.load(geometry.Vector2.from_protobuf(
-      message.location))
+  region = yield from actor.realm.regions.load_async(
+      geometry.Vector2.from_protobuf(message.location))
   actor.unsubscribe(protocol.server.bus, region.channel)
 
   for entity in list(region.entities):
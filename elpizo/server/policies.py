@@ -11,6 +11,8 @@ logger = logging.getLogger(__name__)
 
 
 class UnauthenticatedPolicy(object):
+  can_hand_off = False
+
   def on_hello(self, protocol):
     pass
 
@@ -31,12 +33,28 @@ class UnauthenticatedPolicy(object):
 
 
 class PlayerPolicy(object):
+  # Players are handed off to the shard owning the region they move into.
+  can_hand_off = True
+
   def __init__(self, id, server):
     self.server = server
     self.player = server.store.entities.load(int(id))
     self.ephemera = entities.Ephemera()
 
   def on_hello(self, protocol):
+    self.join(protocol)
+
+    protocol.send(
+        None,
+        packets_pb2.RealmPacket(id=self.player.realm.id,
+                                realm=self.player.realm.to_protobuf()))
+    self.player.send(protocol,
+                     self.player.make_entity_packet(protected=True))
+
+  def join(self, protocol):
+    """
+    Put the player on the bus, without telling the client anything.
+    """
     if self.server.bus.has(self.player.bus_key):
       # We remove the protocol from the player associated with the bus, since
       # we're switching the player to a different protocol.
@@ -48,15 +66,6 @@ class PlayerPolicy(object):
       self.server.bus.remove(self.player.bus_key)
 
     self.player.add_to_bus(self.server.bus, protocol)
-
-    protocol.send(
-        None,
-        packets_pb2.RealmPacket(id=self.player.realm.id,
-                                realm=self.player.realm.to_protobuf()))
-    self.player.send(
-        protocol,
-        packets_pb2.EntityPacket(entity=self.player.to_protected_protobuf()))
-
     self.player.subscribe(self.server.bus, self.player.channel)
 
     # Only self.players get chat access.
@@ -85,6 +94,9 @@ class PlayerPolicy(object):
 
 
 class NPCPolicy(object):
+  # NPCs stay on the shard that simulates them.
+  can_hand_off = False
+
   def __init__(self, id, server):
     self.server = server
     self.id = id
@@ -99,31 +111,37 @@ class NPCPolicy(object):
     self.server.bus.add(self.bus_key, protocol)
     logger.info("Hello, NPC server %s!", self.id)
 
-    for realm in self.server.store.realms.load_all():
+    realms = self.server.store.realms
+
+    for realm in realms.load_all():
+      # Only the regions of this shard are simulated here.
+      region_locations = [
+          location for location in realm.regions.keys()
+          if self.server.is_local_location(realm.id, location)]
+
+      if not region_locations:
+        continue
+
       protocol.send(
           None,
           packets_pb2.RealmPacket(id=realm.id,
                                   realm=realm.to_protobuf()))
 
-      for region in realm.regions.load_all():
+      for region in realm.regions.load_many(region_locations):
         self.server.bus.subscribe(self.bus_key, region.channel)
 
-        protocol.send(None, packets_pb2.RegionPacket(
-            location=region.location.to_protobuf(),
-            realm_id=realm.id,
-            region=region.to_public_protobuf(realm)))
+        protocol.send(None, region.make_region_packet(realm))
 
         for entity in region.entities:
           if isinstance(entity, entities.NPC):
             self.npcs[entity.id] = entity
             self.npc_ephemeras[entity.id] = entities.Ephemera()
 
-            entity_protobuf = entity.to_protected_protobuf()
+            entity_packet = entity.make_entity_packet(protected=True)
           else:
-            entity_protobuf = entity.to_public_protobuf()
+            entity_packet = entity.make_entity_packet()
 
-          entity.send(protocol, packets_pb2.EntityPacket(
-              entity=entity_protobuf))
+          entity.send(protocol, entity_packet)
 
   def on_despawn(self, origin):
     if origin in self.npcs:
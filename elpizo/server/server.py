@@ -1,5 +1,6 @@
 import asyncio
 import asyncio_redis
+import functools
 import logging
 import statsd
 import websockets
@@ -8,7 +9,10 @@ from asyncio_redis import encoders
 from elpizo import platform
 from elpizo.server import bus
 from elpizo.server import handlers
+from elpizo.server import shard
 from elpizo.server import store
+from elpizo.server import tick
+from elpizo.server.handlers import chat
 from elpizo.util import green
 from elpizo.util import net
 
@@ -29,15 +33,114 @@ def make_config_parser(*args, **kwargs):
                       help="statsd host to connect to.")
   parser.add_argument("--statsd-port", action="store", default=8125, type=int,
                       help="statsd port to connect to.")
+  parser.add_argument("--max-loaded-entities", action="store", default=50000,
+                      type=int,
+                      help="Number of entities to keep loaded before evicting "
+                           "unused ones, or 0 for no limit.")
+  parser.add_argument("--max-loaded-regions", action="store", default=4096,
+                      type=int,
+                      help="Number of regions per realm to keep loaded before "
+                           "evicting unused ones, or 0 for no limit.")
+  parser.add_argument("--bus", action="store", default="memory",
+                      choices=["memory", "redis"],
+                      help="Bus backend. The in-memory bus only reaches "
+                           "clients of this process, or of other shards over "
+                           "the shard link. The Redis bus reaches clients of "
+                           "any process over Redis pub/sub.")
+  parser.add_argument("--stats-interval", action="store", default=10,
+                      type=float,
+                      help="Seconds between reports of store statistics to "
+                           "statsd.")
+  parser.add_argument("--checkpoint-interval", action="store", default=60,
+                      type=float,
+                      help="Seconds between writes of changed records to the "
+                           "store, or 0 to only write on shutdown.")
+  parser.add_argument("--max-send-queue-size", action="store", default=1000,
+                      type=int,
+                      help="Number of packets to queue for a connection "
+                           "before it is considered overflowed, or 0 for no "
+                           "limit.")
+  parser.add_argument("--send-queue-overflow", action="store",
+                      default=net.Transport.DISCONNECT,
+                      choices=[net.Transport.DROP, net.Transport.DISCONNECT],
+                      help="What to do when a connection's send queue "
+                           "overflows.")
+  parser.add_argument("--batch-interval", action="store", default=0.01,
+                      type=float,
+                      help="Seconds to accumulate packets for before sending "
+                           "them as a batch, to clients that support it, or 0 "
+                           "to not batch packets.")
+  parser.add_argument("--max-batch-size", action="store", default=8192,
+                      type=int,
+                      help="Bytes of packets after which a batch is sent "
+                           "without waiting for the batch interval.")
+  parser.add_argument("--tick-rate", action="store", default=0, type=float,
+                      help="Ticks per second to apply moves at, or 0 to apply "
+                           "them as they arrive.")
+  parser.add_argument("--handler-mode", action="store", default="native",
+                      choices=["native", "green"],
+                      help="Whether connections run as native asyncio "
+                           "coroutines, which only run handlers that haven't "
+                           "been ported to asyncio in greenlets, or each in a "
+                           "greenlet of its own.")
+  parser.add_argument("--num-shards", action="store", default=1, type=int,
+                      help="Number of shards (worker processes) the realms "
+                           "are split across.")
+  parser.add_argument("--shard-index", action="store", default=0, type=int,
+                      help="Index of the shard this process serves.")
+  parser.add_argument("--shard-host", action="store", default="localhost",
+                      help="Host the private ports of shards are on.")
+  parser.add_argument("--shard-base-port", action="store", default=9000,
+                      type=int,
+                      help="Private port of the first shard. Shard n listens "
+                           "on this port plus n.")
+  parser.add_argument("--shard-stripe-width", action="store", default=0,
+                      type=int,
+                      help="Width, in regions, of the vertical stripes realms "
+                           "are split into across shards, or 0 to assign "
+                           "whole realms to shards.")
+  parser.add_argument("--shard-spare-connections", action="store", default=4,
+                      type=int,
+                      help="Number of connections to keep open to every other "
+                           "shard ahead of handing sessions off to it.")
   return parser
 
 
 class Application(platform.Application):
   def on_start(self):
-    self.bus = bus.Bus()
-    self.store = store.GameStore(green.await_coro(asyncio_redis.Pool.create(
+    if self.config.num_shards > 1:
+      self.shards = shard.ShardMap(self.config.num_shards,
+                                   self.config.shard_index,
+                                   self.config.shard_host,
+                                   self.config.shard_base_port,
+                                   self.config.shard_stripe_width,
+                                   self.config.shard_spare_connections)
+      lock_key = self.shards.lock_key
+
+      if self.config.shard_stripe_width > 0 and not self.mint.can_mint:
+        raise ValueError("Shards hand players off across stripes with "
+                         "minted tokens, so they need the private mint key.")
+    else:
+      self.shards = None
+      lock_key = store.GameStore._LOCK_KEY
+
+    redis = green.await_coro(asyncio_redis.Pool.create(
         host=self.config.redis_host, port=self.config.redis_port,
-        encoder=encoders.BytesEncoder())))
+        encoder=encoders.BytesEncoder()))
+
+    if self.config.bus == "redis":
+      self.bus = bus.RedisBus(redis, self.config.redis_host,
+                              self.config.redis_port)
+    else:
+      self.bus = bus.Bus()
+
+    self.store = store.GameStore(
+        redis,
+        self.bus,
+        max_loaded_entities=self.config.max_loaded_entities or None,
+        max_loaded_regions=self.config.max_loaded_regions or None,
+        lock_key=lock_key,
+        shards=self.shards)
     self.statsd = statsd.StatsClient(self.config.statsd_host,
                                      self.config.statsd_port,
                                      prefix="elpizo")
@@ -47,7 +150,7 @@ class Application(platform.Application):
 
     if self.store.is_lock_acquired:
       logger.info("Flushing stores.")
-      self.store.save_all()
+      self.store.checkpoint()
       try:
         self.store.unlock()
       except store.StoreError as e:
@@ -57,22 +160,171 @@ class Application(platform.Application):
 
     logger.info("Goodbye.")
 
+  def is_local_location(self, realm_id, location):
+    return self.shards is None or \
+           self.shards.is_local_location(realm_id, location)
+
 
 class Server(Application):
   def on_start(self):
     super().on_start()
-    self.listen(self.config.bind_port, self.config.bind_host)
+    self.transports = set()
+    self.store.lock()
+
+    if self.shards is None:
+      self.listen(self.config.bind_port, self.config.bind_host)
+      self.shard_link = None
+      self.shard_linker = None
+      self.boundary_link = None
+    else:
+      # Every shard accepts connections on the shared public port, and relays
+      # players to the shard that owns them. Relayed connections (and NPC
+      # servers) arrive on the shard's private port.
+      self.listen(self.config.bind_port, self.config.bind_host,
+                  reuse_port=True)
+      self.listen(self.shards.get_port(self.shards.index),
+                  self.config.shard_host, is_private=True)
+
+      self.shards.warm()
+
+      if isinstance(self.bus, bus.RedisBus):
+        # The bus reaches clients of other shards by itself.
+        self.shard_link = None
+        self.shard_linker = None
+        self.boundary_link = None
+      else:
+        self.shard_link = shard.ShardLink(self.shards, self.store.redis,
+                                          self.config.redis_host,
+                                          self.config.redis_port)
+        self.shard_link.register("chat",
+                                 functools.partial(chat.on_chat_relay, self))
+        self.bus.channel_relay = functools.partial(chat.relay_chat, self)
+        self.boundary_link = shard.BoundaryLink(self.shards, self.shard_link,
+                                                self.bus)
+        self.shard_linker = asyncio.async(
+            green.coroutine(self.shard_link.run)(), loop=self.loop)
+
+    if isinstance(self.bus, bus.RedisBus):
+      self.bus_runner = asyncio.async(green.coroutine(self.bus.run)(),
+                                      loop=self.loop)
+    else:
+      self.bus_runner = None
+
+    if self.config.checkpoint_interval > 0:
+      self.checkpointer = asyncio.async(
+          green.coroutine(self.store.run_checkpointer)(
+              self.config.checkpoint_interval),
+          loop=self.loop)
+    else:
+      self.checkpointer = None
+
+    self.stats_reporter = asyncio.async(
+        green.coroutine(self.report_stats)(), loop=self.loop)
+
+    if self.config.tick_rate > 0:
+      self.world_tick = tick.WorldTick(self, self.config.tick_rate)
+      self.world_ticker = asyncio.async(
+          green.coroutine(self.world_tick.run)(), loop=self.loop)
+    else:
+      self.world_tick = None
+      self.world_ticker = None
 
-  def listen(self, port, host):
+  def on_stop(self):
+    if self.shard_linker is not None:
+      self.shard_linker.cancel()
+    if self.bus_runner is not None:
+      self.bus_runner.cancel()
+    if self.world_ticker is not None:
+      self.world_ticker.cancel()
+    if self.checkpointer is not None:
+      self.checkpointer.cancel()
+    self.stats_reporter.cancel()
+    super().on_stop()
+
+  def submit(self, f, protocol, *args):
+    """
+    Apply an intent, either immediately or at the next world tick if the world
+    is ticking.
+
+    :param f: The function applying the intent.
+    :param protocol: The protocol the intent arrived on.
+    :param args: Any additional arguments to `f`.
+    """
+    if self.world_tick is None:
+      f(protocol, *args)
+    else:
+      self.world_tick.submit(f, protocol, *args)
+
+  def report_stats(self):
+    while True:
+      green.await_coro(asyncio.sleep(self.config.stats_interval))
+      self.store.report_stats(self.statsd)
+      self.report_transport_stats()
+
+  def report_transport_stats(self):
+    """
+    Report send queue statistics for all connections to statsd.
+    """
+    coalesced = dropped = disconnects = total_size = max_size = 0
+
+    for transport in self.transports:
+      transport_coalesced, transport_dropped, transport_disconnects = \
+          transport.pop_stats()
+      coalesced += transport_coalesced
+      dropped += transport_dropped
+      disconnects += transport_disconnects
+
+      total_size += transport.queue_size
+      max_size = max([max_size, transport.queue_size])
+
+    self.statsd.incr("net.send_queue.coalesced", coalesced)
+    self.statsd.incr("net.send_queue.dropped", dropped)
+    self.statsd.incr("net.send_queue.disconnects", disconnects)
+    self.statsd.gauge("net.send_queue.size", total_size)
+    self.statsd.gauge("net.send_queue.max_size", max_size)
+
+  def listen(self, port, host, is_private=False, **kwargs):
+    """
+    Accept connections on a port.
+
+    :param is_private: Whether the port is only reachable by other shards and
+                       NPC servers.
+    """
     logger.info("Server listening on %s:%s.", host, port)
-    self.store.lock()
 
-    green.await_coro(
-        websockets.serve(green.coroutine(self.accept),
-                         host, port))
+    if self.config.handler_mode == "native":
+      accept = functools.partial(self.accept_async, is_private=is_private)
+    else:
+      accept = green.coroutine(functools.partial(self.accept,
+                                                 is_private=is_private))
+
+    green.await_coro(websockets.serve(accept, host, port, **kwargs))
+
+  def make_transport(self, websocket):
+    transport = net.Transport(
+        websocket,
+        max_queue_size=self.config.max_send_queue_size or None,
+        overflow_policy=self.config.send_queue_overflow)
+    self.transports.add(transport)
+    return transport
+
+  def accept(self, websocket, path, is_private=False):
+    transport = self.make_transport(websocket)
+
+    try:
+      handlers.Dispatcher(self, transport, is_private=is_private).run()
+    finally:
+      self.transports.remove(transport)
+
+  @asyncio.coroutine
+  def accept_async(self, websocket, path, is_private=False):
+    transport = self.make_transport(websocket)
 
-  def accept(self, websocket, path):
-    handlers.Dispatcher(self, net.Transport(websocket)).run()
+    try:
+      yield from handlers.Dispatcher(self, transport,
+                                     is_private=is_private).run_async()
+    finally:
+      self.transports.remove(transport)
 
 
 def main():
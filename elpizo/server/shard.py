@@ -0,0 +1,326 @@
+import asyncio
+import asyncio_redis
+import collections
+import logging
+import websockets
+
+from asyncio_redis import encoders
+from elpizo.models import geometry
+from elpizo.models import realm
+from elpizo.protos import shards_pb2
+from elpizo.util import green
+from elpizo.util import net
+
+logger = logging.getLogger(__name__)
+
+
+class ShardMap(object):
+  """
+  Describes which shard (worker process) owns what. Regions are assigned to
+  shards by realm ID and, if a stripe width is given, by vertical stripes of
+  regions, so that a realm can be split across shards.
+
+  Every shard also listens on a private port of its own, which other shards
+  relay connections to.
+  """
+
+  LOCK_KEY = "lock.shard.{index}"
+
+  def __init__(self, num_shards, index, host, base_port, stripe_width=0,
+               num_spare_connections=0):
+    self.num_shards = num_shards
+    self.index = index
+    self.host = host
+    self.base_port = base_port
+    self.stripe_width = stripe_width
+
+    # Connections to other shards are opened ahead of time, so that handing a
+    # session off doesn't wait for a connection to be set up.
+    self.num_spare_connections = num_spare_connections
+    self.spare_connections = collections.defaultdict(collections.deque)
+    self.pending_connections = collections.Counter()
+
+  @property
+  def lock_key(self):
+    return self.LOCK_KEY.format(index=self.index)
+
+  def get_shard_for_location(self, realm_id, location):
+    """
+    Get the shard owning the region containing a location.
+
+    :param realm_id: The ID of the realm.
+    :param location: A location in the realm, in tiles.
+    """
+    if not self.stripe_width:
+      return realm_id % self.num_shards
+
+    stripe = location.x // (realm.Region.SIZE * self.stripe_width)
+    return (realm_id + stripe) % self.num_shards
+
+  def is_local_location(self, realm_id, location):
+    return self.get_shard_for_location(realm_id, location) == self.index
+
+  def get_port(self, shard):
+    return self.base_port + shard
+
+  def connect(self, shard):
+    """
+    Connect to the private port of a shard, using a spare connection if there
+    is one.
+
+    :returns: A transport to the shard.
+    """
+    spares = self.spare_connections[shard]
+    self.warm(shard)
+
+    while spares:
+      websocket = spares.popleft()
+      if websocket.open:
+        return net.Transport(websocket)
+
+    return net.Transport(self.open_connection(shard))
+
+  def open_connection(self, shard):
+    return green.await_coro(websockets.connect(
+        "ws://{host}:{port}/".format(host=self.host,
+                                     port=self.get_port(shard))))
+
+  def warm(self, shard=None):
+    """
+    Open spare connections to a shard, or to every other shard, in the
+    background.
+    """
+    if shard is None:
+      for shard in range(self.num_shards):
+        if shard != self.index:
+          self.warm(shard)
+      return
+
+    n = self.num_spare_connections - len(self.spare_connections[shard]) - \
+        self.pending_connections[shard]
+
+    for _ in range(n):
+      self.pending_connections[shard] += 1
+      asyncio.async(green.coroutine(self.open_spare_connection)(shard))
+
+  def open_spare_connection(self, shard):
+    try:
+      self.spare_connections[shard].append(self.open_connection(shard))
+    except Exception as e:
+      logger.warn("Could not open a spare connection to shard %s: %s", shard,
+                  e)
+    finally:
+      self.pending_connections[shard] -= 1
+
+
+class ShardLink(object):
+  """
+  A link between shards over Redis pub/sub. Every shard listens on a channel of
+  its own, and on a channel shared by all shards.
+  """
+
+  CHANNEL = "shards.{index}"
+  ALL_CHANNEL = "shards.all"
+
+  def __init__(self, shards, redis, redis_host, redis_port):
+    self.shards = shards
+    self.redis = redis
+    self.redis_host = redis_host
+    self.redis_port = redis_port
+    self.handlers = {}
+
+  def register(self, field, f):
+    """
+    Register a handler for shard messages with the given field set.
+
+    :param field: The name of the field.
+    :param f: A function taking the sending shard and the field's value.
+    """
+    self.handlers[field] = f
+
+  def publish(self, message, shard=None):
+    """
+    Publish a message to a shard, or to every other shard.
+
+    :param message: The shard message. Its source is filled in.
+    :param shard: The shard to send the message to, or None for every other
+                  shard.
+    """
+    message.source = self.shards.index
+
+    channel = self.ALL_CHANNEL if shard is None \
+                               else self.CHANNEL.format(index=shard)
+    green.await_coro(self.redis.publish(channel.encode("utf-8"),
+                                        message.SerializeToString()))
+
+  def publish_nowait(self, message, shard=None):
+    """
+    Like `publish`, but without waiting for the message to be sent, for use
+    where IO can't be waited on.
+
+    Messages are still sent in order, as the Redis pool writes commands in the
+    order they're issued.
+    """
+    message.source = self.shards.index
+
+    channel = self.ALL_CHANNEL if shard is None \
+                               else self.CHANNEL.format(index=shard)
+    asyncio.async(self.redis.publish(channel.encode("utf-8"),
+                                     message.SerializeToString()))
+
+  def run(self):
+    connection = green.await_coro(asyncio_redis.Connection.create(
+        host=self.redis_host, port=self.redis_port,
+        encoder=encoders.BytesEncoder()))
+
+    try:
+      subscriber = green.await_coro(connection.start_subscribe())
+      green.await_coro(subscriber.subscribe([
+          self.CHANNEL.format(index=self.shards.index).encode("utf-8"),
+          self.ALL_CHANNEL.encode("utf-8")]))
+
+      while True:
+        reply = green.await_coro(subscriber.next_published())
+        message = shards_pb2.ShardMessage.FromString(reply.value)
+
+        if message.source == self.shards.index:
+          # Messages to every shard come back to us too.
+          continue
+
+        for field, value in message.ListFields():
+          if field.name == "source":
+            continue
+
+          try:
+            handler = self.handlers[field.name]
+          except KeyError:
+            logger.warn("Unhandled shard message: %s", field.name)
+            continue
+
+          # Handlers may wait on IO, so each runs separately to keep the
+          # subscription moving.
+          asyncio.async(green.coroutine(self.handle)(
+              handler, field.name, message.source, value))
+    finally:
+      connection.close()
+
+  def handle(self, handler, name, source, value):
+    try:
+      handler(source, value)
+    except Exception:
+      logger.exception("Failed to handle shard message: %s", name)
+
+
+class BoundaryLink(object):
+  """
+  Keeps shards subscribed to the regions of other shards that their clients
+  watch, i.e. regions across a shard boundary.
+
+  Whenever a shard gains or loses its last subscriber to a region it doesn't
+  own, it tells the owner. The owner relays broadcasts to that region to every
+  interested shard, which delivers them to its own subscribers. Broadcasts to
+  regions a shard doesn't own are relayed to their owner, which passes them on
+  to the interested shards they haven't already been relayed to.
+  """
+
+  def __init__(self, shards, shard_link, bus):
+    self.shards = shards
+    self.shard_link = shard_link
+    self.bus = bus
+
+    # (realm ID, x, y) -> indexes of the shards interested in the region.
+    self.remote_interest = collections.defaultdict(set)
+
+    shard_link.register("region_interest", self.on_region_interest)
+    shard_link.register("region", self.on_region_relay)
+
+    bus.interest_listener = self.on_local_interest
+    bus.region_relay = self.relay
+
+  def on_local_interest(self, realm_id, location, interested):
+    owner = self.shards.get_shard_for_location(realm_id, location)
+    if owner == self.shards.index:
+      return
+
+    self.shard_link.publish_nowait(shards_pb2.ShardMessage(
+        region_interest=shards_pb2.RegionInterest(
+            realm_id=realm_id, location=location.to_protobuf(),
+            interested=interested)),
+        owner)
+
+  def on_region_interest(self, source, message):
+    key = (message.realm_id, message.location.x, message.location.y)
+
+    if message.interested:
+      self.remote_interest[key].add(source)
+    else:
+      self.remote_interest[key].discard(source)
+      if not self.remote_interest[key]:
+        del self.remote_interest[key]
+
+  def relay(self, realm_id, locations, origin, packet):
+    """
+    Relay a broadcast to the given regions to other shards.
+
+    :param realm_id: The ID of the realm the regions are in.
+    :param locations: The locations of the regions.
+    :param origin: The origin of the packet, if any.
+    :param packet: The serialized packet.
+    """
+    targets = set()
+
+    for location in locations:
+      owner = self.shards.get_shard_for_location(realm_id, location)
+
+      if owner == self.shards.index:
+        targets.update(self.remote_interest.get(
+            (realm_id, location.x, location.y), ()))
+      else:
+        targets.add(owner)
+
+    if not targets:
+      return
+
+    message = shards_pb2.ShardMessage(region=shards_pb2.RegionRelay(
+        realm_id=realm_id,
+        locations=[location.to_protobuf() for location in locations],
+        packet=packet,
+        relayed_to=sorted(targets)))
+
+    if origin is not None:
+      message.region.origin = origin
+
+    for target in targets:
+      self.shard_link.publish_nowait(message, target)
+
+  def on_region_relay(self, source, message):
+    origin = message.origin if message.HasField("origin") else None
+    packet_type = net.peek_packet_type(message.packet)
+    locations = [geometry.Vector2.from_protobuf(location)
+                 for location in message.locations]
+
+    for protocol in self.bus.get_protocols_for_regions(message.realm_id,
+                                                       locations):
+      protocol.send_packet(message.packet, origin, packet_type)
+
+    # Shards interested in our regions only hear about broadcasts made on
+    # other shards from us.
+    targets = set()
+
+    for location in locations:
+      if self.shards.get_shard_for_location(message.realm_id,
+                                            location) == self.shards.index:
+        targets.update(self.remote_interest.get(
+            (message.realm_id, location.x, location.y), ()))
+
+    targets.difference_update(message.relayed_to)
+    targets.discard(source)
+
+    if not targets:
+      return
+
+    forwarded = shards_pb2.ShardMessage(region=message)
+    forwarded.region.relayed_to.extend(sorted(targets))
+
+    for target in targets:
+      self.shard_link.publish_nowait(forwarded, target)
@@ -0,0 +1,136 @@
+import unittest
+
+from elpizo.models import geometry
+from elpizo.models import realm
+from elpizo.protos import packets_pb2
+from elpizo.protos import shards_pb2
+from elpizo.server import bus
+from elpizo.server import shard
+from elpizo.util import net
+
+
+REALM_ID = 1
+
+
+class MemoryShardLink(object):
+  """
+  A shard link between shards in this process, which delivers messages to the
+  other shards' handlers straight away.
+  """
+
+  def __init__(self, shards, links):
+    self.shards = shards
+    self.links = links
+    self.handlers = {}
+
+    links[shards.index] = self
+
+  def register(self, field, f):
+    self.handlers[field] = f
+
+  def publish_nowait(self, message, shard=None):
+    message.source = self.shards.index
+
+    # Messages are copied, as they would be over Redis.
+    message = shards_pb2.ShardMessage.FromString(message.SerializeToString())
+
+    for index, link in list(self.links.items()):
+      if index != self.shards.index and shard in (None, index):
+        link.deliver(message)
+
+  def deliver(self, message):
+    for field, value in message.ListFields():
+      if field.name != "source":
+        self.handlers[field.name](message.source, value)
+
+
+class MemoryProtocol(object):
+  def __init__(self):
+    self.packets = []
+
+  def send_packet(self, packet, origin=None, packet_type=None):
+    self.packets.append(packet)
+
+
+class Shard(object):
+  def __init__(self, index, num_shards, links):
+    self.shards = shard.ShardMap(num_shards, index, "localhost", 0,
+                                 stripe_width=1)
+    self.bus = bus.Bus()
+    self.boundary_link = shard.BoundaryLink(
+        self.shards, MemoryShardLink(self.shards, links), self.bus)
+
+  def watch(self, bus_key, *locations):
+    protocol = MemoryProtocol()
+    self.bus.add(bus_key, protocol)
+    for location in locations:
+      self.bus.subscribe(bus_key,
+                         (bus.Bus.REGION_NAMESPACE, REALM_ID, location))
+    return protocol
+
+  def broadcast(self, locations, packet):
+    # As an entity broadcasts to regions.
+    for protocol in self.bus.get_protocols_for_regions(REALM_ID, locations):
+      protocol.send_packet(packet)
+    self.bus.relay_to_regions(REALM_ID, locations, None, packet)
+
+
+class BoundaryLinkTest(unittest.TestCase):
+  NUM_SHARDS = 3
+
+  def setUp(self):
+    links = {}
+    self.shards = [Shard(index, self.NUM_SHARDS, links)
+                   for index in range(self.NUM_SHARDS)]
+
+    # The first region in the realm owned by each shard.
+    self.regions = {}
+    for i in range(self.NUM_SHARDS):
+      location = geometry.Vector2(i * realm.Region.SIZE, 0)
+      self.regions[self.shards[0].shards.get_shard_for_location(
+          REALM_ID, location)] = location
+
+    self.packet = net.Protocol.serialize_packet(
+        None, packets_pb2.EchoPacket(payload="relayed"))
+
+  def test_owner_relays_to_interested_shards(self):
+    region = self.regions[1]
+    owner = self.shards[1].watch(1, region)
+    watcher = self.shards[2].watch(2, region)
+
+    self.shards[0].broadcast([region], self.packet)
+
+    self.assertEqual(owner.packets, [self.packet])
+    self.assertEqual(watcher.packets, [self.packet])
+
+  def test_owner_does_not_relay_back_to_source(self):
+    region = self.regions[1]
+    source = self.shards[0].watch(1, region)
+    watcher = self.shards[2].watch(2, region)
+
+    self.shards[0].broadcast([region], self.packet)
+
+    self.assertEqual(source.packets, [self.packet])
+    self.assertEqual(watcher.packets, [self.packet])
+
+  def test_shards_reached_by_source_are_not_relayed_to_again(self):
+    # The watcher owns one of the regions, so it hears from the source
+    # directly, as well as being interested in the other.
+    watcher = self.shards[2].watch(1, self.regions[1], self.regions[2])
+
+    self.shards[0].broadcast([self.regions[1], self.regions[2]], self.packet)
+
+    self.assertEqual(watcher.packets, [self.packet])
+
+  def test_lost_interest_is_not_relayed_to(self):
+    region = self.regions[1]
+    watcher = self.shards[2].watch(2, region)
+    self.shards[2].bus.remove(2)
+
+    self.shards[0].broadcast([region], self.packet)
+
+    self.assertEqual(watcher.packets, [])
+
+
+if __name__ == "__main__":
+  unittest.main()
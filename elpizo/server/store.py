@@ -1,8 +1,11 @@
+import asyncio
 import logging
+import time
 
 from elpizo.models import entities
 from elpizo.models import geometry
 from elpizo.models import realm
+from elpizo.server import shard
 from elpizo.server.util import kvs
 from elpizo.util import green
 from elpizo.util import record
@@ -18,11 +21,36 @@ class StoreError(Exception):
 class GameStore(object):
   _LOCK_KEY = "lock"
 
-  def __init__(self, redis):
+  # Takes the lock in KEYS[1], unless it's held (returning 0) or any key
+  # matching one of the patterns in ARGV is (returning -1), all at once.
+  _LOCK_SCRIPT = """\
+if redis.call("exists", KEYS[1]) == 1 then
+  return 0
+end
+
+for _, pattern in ipairs(ARGV) do
+  if #redis.call("keys", pattern) > 0 then
+    return -1
+  end
+end
+
+redis.call("set", KEYS[1], "")
+return 1
+"""
+
+  CHECKPOINT_BATCH_SIZE = 100
+
+  def __init__(self, redis, bus=None, max_loaded_entities=None,
+               max_loaded_regions=None, lock_key=_LOCK_KEY, shards=None):
     self.redis = redis
+    self.bus = bus
+    self.lock_key = lock_key
+    self.shards = shards
+    self.max_loaded_regions = max_loaded_regions
 
     self.realms = realm.RealmStore(self, self._make_kvs("realms"))
-    self.entities = entities.EntityStore(self, self._make_kvs("entities"))
+    self.entities = entities.EntityStore(self, self._make_kvs("entities"),
+                                         max_loaded_entities)
     self.item_counter = self._make_counter("items.serial")
 
     self.is_lock_acquired = False
@@ -30,9 +58,26 @@ class GameStore(object):
   def lock(self):
     # this acquires an advisory lock -- locking is not mandatory, but I don't
     # suggest you try bypassing it.
-    if not green.await_coro(
-        self.redis.set(self._LOCK_KEY.encode("utf-8"), b"",
-                       only_if_not_exists=True)):
+    #
+    # A shard lock only covers part of the store, so it can't be taken while
+    # something holds the whole store, nor the other way around.
+    if self.lock_key == self._LOCK_KEY:
+      conflicting_lock_key = shard.ShardMap.LOCK_KEY.format(index="*")
+      conflict_error = "Store is locked by a shard."
+    else:
+      conflicting_lock_key = self._LOCK_KEY
+      conflict_error = "Store is locked by an unsharded server."
+
+    script = green.await_coro(self.redis.register_script(self._LOCK_SCRIPT))
+    reply = green.await_coro(script.run(
+        keys=[self.lock_key.encode("utf-8")],
+        args=[conflicting_lock_key.encode("utf-8")]))
+    result = green.await_coro(reply.return_value())
+
+    if result == -1:
+      raise StoreError(conflict_error)
+
+    if result != 1:
       raise StoreError("""\
 Store is locked. This generally occurs if the server was uncleanly shut down, \
 or another copy of the server is running. If you are sure another copy of the \
@@ -44,7 +89,7 @@ server is not running, please run:
 
   def unlock(self):
     unlocked = green.await_coro(
-        self.redis.delete([self._LOCK_KEY.encode("utf-8")])) == 1
+        self.redis.delete([self.lock_key.encode("utf-8")])) == 1
 
     if not self.is_lock_acquired and unlocked:
       logger.warn("Store lock was BROKEN!")
@@ -60,7 +105,7 @@ the database IMMEDIATELY!
     self.is_lock_acquired = False
 
   def is_locked(self):
-    return green.await_coro(self.redis.exists(self._LOCK_KEY.encode("utf-8")))
+    return green.await_coro(self.redis.exists(self.lock_key.encode("utf-8")))
 
   def _make_kvs(self, hash_key):
     return kvs.AsyncRedisHashAdapter(hash_key, self.redis)
@@ -72,7 +117,45 @@ the database IMMEDIATELY!
     assert r.id is not None
     return realm.RegionStore(r, self.entities,
                              self._make_kvs("realms.{id}.regions".format(
-                                 id=r.id)))
+                                 id=r.id)),
+                             self.max_loaded_regions)
+
+  def is_entity_pinned(self, entity):
+    # Entities with a protocol on the bus (i.e. online players) stay loaded.
+    return self.bus is not None and self.bus.has(entity.bus_key)
+
+  def is_region_pinned(self, region):
+    # Regions that someone is watching stay loaded.
+    return self.bus is not None and self.bus.has_subscribers(region.channel)
+
+  def is_location_owned(self, realm_id, location):
+    # Only the shard owning a region writes it, and the entities in it, back to
+    # the store. Other shards may have read-only copies loaded.
+    return self.shards is None or \
+           self.shards.is_local_location(realm_id, location)
+
+  def report_stats(self, statsd):
+    """
+    Report cache statistics for entities and regions to statsd.
+    """
+    region_stores = [r.regions for r in self.realms.loaded_records.values()
+                     if r.regions is not None]
+
+    for name, stores in [("entities", [self.entities]),
+                         ("regions", region_stores)]:
+      hits = misses = evictions = size = 0
+
+      for s in stores:
+        store_hits, store_misses, store_evictions = s.pop_stats()
+        hits += store_hits
+        misses += store_misses
+        evictions += store_evictions
+        size += len(s.loaded_records)
+
+      statsd.incr("store.{}.hits".format(name), hits)
+      statsd.incr("store.{}.misses".format(name), misses)
+      statsd.incr("store.{}.evictions".format(name), evictions)
+      statsd.gauge("store.{}.size".format(name), size)
 
   def create_item(self, item):
     item.id = self.item_counter.next_serial()
@@ -84,3 +167,40 @@ the database IMMEDIATELY!
 
     self.realms.save_all()
     self.entities.save_all()
+
+  def checkpoint(self, batch_size=CHECKPOINT_BATCH_SIZE):
+    """
+    Save only the records that have changed since they were last saved.
+
+    :returns: The number of records saved.
+    """
+    if not self.is_lock_acquired:
+      raise StoreError("Lock not acquired.")
+
+    return self.realms.save_dirty(batch_size) + \
+           self.entities.save_dirty(batch_size)
+
+  def run_checkpointer(self, interval):
+    """
+    Checkpoint the store every `interval` seconds, forever. This bounds the
+    amount of work lost if the server crashes.
+    """
+    while True:
+      green.await_coro(asyncio.sleep(interval))
+
+      start_time = time.monotonic()
+      try:
+        n = self.checkpoint()
+      except StoreError as e:
+        logger.error("Could not checkpoint store: %s", e)
+        continue
+      except Exception:
+        # The records that failed are still dirty, so the next checkpoint
+        # retries them.
+        logger.exception("Could not checkpoint store.")
+        continue
+      end_time = time.monotonic()
+
+      if n > 0:
+        logger.info("Checkpointed %d records in %.2fs.", n,
+                    end_time - start_time)
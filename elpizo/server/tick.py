@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import time
+
+from elpizo.util import green
+from elpizo.util import net
+
+logger = logging.getLogger(__name__)
+
+
+class WorldTick(object):
+  """
+  A fixed-rate simulation tick.
+
+  Rather than being applied as their packets arrive, intents (such as moves)
+  are queued and applied together at the next tick, in the order they arrived.
+  At the end of each tick, every connection sends what the tick produced
+  without waiting out its batch interval.
+  """
+
+  def __init__(self, server, rate):
+    self.server = server
+    self.interval = 1 / rate
+    self.intents = []
+
+  def submit(self, f, protocol, *args):
+    """
+    Queue an intent to be applied at the next tick.
+
+    :param f: The function applying the intent.
+    :param protocol: The protocol the intent arrived on.
+    :param args: Any additional arguments to `f`.
+    """
+    self.intents.append((f, protocol, args))
+
+  def tick(self):
+    intents = self.intents
+    self.intents = []
+
+    for f, protocol, args in intents:
+      if not protocol.transport.is_open or protocol.handed_off:
+        # The connection went away, or was handed off to another shard, while
+        # the intent was queued.
+        continue
+
+      try:
+        f(protocol, *args)
+      except net.Reject as e:
+        logger.warn("Rejected an intent: %s", e)
+      except Exception:
+        # A single bad intent must not stop the world.
+        logger.exception("Failed to apply an intent.")
+
+    for transport in self.server.transports:
+      transport.end_batch()
+
+    self.server.statsd.incr("world.intents", len(intents))
+
+  def run(self):
+    next_tick_time = time.monotonic()
+
+    while True:
+      next_tick_time += self.interval
+      delay = next_tick_time - time.monotonic()
+
+      if delay > 0:
+        green.await_coro(asyncio.sleep(delay))
+      else:
+        # We've fallen behind, so don't try to catch up with a burst of ticks.
+        self.server.statsd.incr("world.overruns")
+        next_tick_time = time.monotonic()
+
+      with self.server.statsd.timer("world.tick"):
+        self.tick()
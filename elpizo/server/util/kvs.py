@@ -1,3 +1,4 @@
+import asyncio
 import logging
 
 from elpizo.util import green
@@ -6,6 +7,11 @@ logger = logging.getLogger(__name__)
 
 
 class AsyncRedisHashAdapter(object):
+  """
+  A key-value store over a Redis hash. Every operation has a native asyncio
+  variant (e.g. `get_async`), and a variant that waits in a greenlet.
+  """
+
   _SERIAL_KEY = "serial"
 
   def __init__(self, hash_key, redis):
@@ -15,27 +21,94 @@ class AsyncRedisHashAdapter(object):
         "{}.{}".format(self.hash_key, self._SERIAL_KEY), self.redis)
 
   def get(self, key):
-    v = green.await_coro(self.redis.hget(self.hash_key.encode("utf-8"),
-                                         str(key).encode("utf-8")))
+    return green.await_coro(self.get_async(key))
+
+  @asyncio.coroutine
+  def get_async(self, key):
+    v = yield from self.redis.hget(self.hash_key.encode("utf-8"),
+                                   str(key).encode("utf-8"))
     if v is None:
       raise KeyError(key)
     return v
 
   def set(self, key, value):
-    green.await_coro(self.redis.hset(self.hash_key.encode("utf-8"),
-                                     str(key).encode("utf-8"), value))
+    green.await_coro(self.set_async(key, value))
+
+  @asyncio.coroutine
+  def set_async(self, key, value):
+    yield from self.redis.hset(self.hash_key.encode("utf-8"),
+                               str(key).encode("utf-8"), value)
 
   def delete(self, key):
-    green.await_coro(self.redis.hdel(self.hash_key.encode("utf-8"),
-                                     [str(key).encode("utf-8")]))
+    green.await_coro(self.delete_async(key))
+
+  @asyncio.coroutine
+  def delete_async(self, key):
+    yield from self.redis.hdel(self.hash_key.encode("utf-8"),
+                               [str(key).encode("utf-8")])
+
+  def get_many(self, keys):
+    """
+    Get the values of many keys in a single round trip. Keys that don't exist
+    are omitted from the result.
+
+    :returns: A dict of keys to values.
+    """
+    return green.await_coro(self.get_many_async(keys))
+
+  @asyncio.coroutine
+  def get_many_async(self, keys):
+    keys = list(keys)
+    if not keys:
+      return {}
+
+    reply = yield from self.redis.hmget(
+        self.hash_key.encode("utf-8"),
+        [str(key).encode("utf-8") for key in keys])
+    values = yield from reply.aslist()
+
+    return {key: value for key, value in zip(keys, values)
+            if value is not None}
+
+  def set_many(self, items):
+    """
+    Set many key-value pairs in a single round trip.
+    """
+    green.await_coro(self.set_many_async(items))
+
+  @asyncio.coroutine
+  def set_many_async(self, items):
+    values = {str(key).encode("utf-8"): value for key, value in items}
+    if not values:
+      return
+
+    yield from self.redis.hmset(self.hash_key.encode("utf-8"), values)
+
+  def delete_many(self, keys):
+    """
+    Delete many keys in a single round trip.
+    """
+    green.await_coro(self.delete_many_async(keys))
+
+  @asyncio.coroutine
+  def delete_many_async(self, keys):
+    fields = [str(key).encode("utf-8") for key in keys]
+    if not fields:
+      return
+
+    yield from self.redis.hdel(self.hash_key.encode("utf-8"), fields)
 
   def next_serial(self):
     return self.counter.next_serial()
 
+  @asyncio.coroutine
+  def next_serial_async(self):
+    return (yield from self.counter.next_serial_async())
+
   def keys(self):
-    for fut in green.await_coro(
-        self.redis.hkeys(self.hash_key.encode("utf-8"))):
-      yield green.await(fut).decode("utf-8")
+    reply = green.await_coro(self.redis.hkeys(self.hash_key.encode("utf-8")))
+    for key in green.await_coro(reply.asset()):
+      yield key.decode("utf-8")
 
 
 class AsyncRedisCounterAdapter(object):
@@ -44,4 +117,8 @@ class AsyncRedisCounterAdapter(object):
     self.redis = redis
 
   def next_serial(self):
-    return int(green.await_coro(self.redis.incr(self.key.encode("utf-8"))))
+    return green.await_coro(self.next_serial_async())
+
+  @asyncio.coroutine
+  def next_serial_async(self):
+    return int((yield from self.redis.incr(self.key.encode("utf-8"))))
@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import statsd
+import time
+
+from elpizo.client.npc_server import behaviors
+from elpizo.client.npc_server import scheduler
+from elpizo.util import green
+
+
+class BenchmarkServer(object):
+  """
+  Just enough of an NPC server for a behavior scheduler to run.
+  """
+
+  def __init__(self):
+    self.statsd = statsd.StatsClient(prefix="elpizo.benchmarks.behaviors")
+
+
+class Behavior(behaviors.Behavior):
+  """
+  A behavior that only counts its updates, and waits `interval` seconds after
+  each, or is idle if None.
+  """
+
+  def __init__(self, interval):
+    super().__init__(None, None)
+    self.interval = interval
+    self.updates = 0
+
+  def on_update(self):
+    self.updates += 1
+    return self.IDLE_INTERVAL if self.interval is None else self.interval
+
+
+def run_via_tasks(behavior):
+  # How the NPC server used to run behaviors: each in its own task and
+  # greenlet, looping forever. Updates waited in the greenlet, and idle ones
+  # didn't wait at all, other than yielding to the event loop in between.
+  behavior.running = True
+
+  while behavior.running:
+    behavior.on_update()
+    if behavior.interval is not None:
+      green.await_coro(asyncio.sleep(behavior.interval))
+    green.await_coro(asyncio.sleep(0))
+
+
+@asyncio.coroutine
+def measure(config, mode, interval):
+  all_behaviors = [Behavior(interval) for _ in range(config.behaviors)]
+
+  start_time = time.perf_counter()
+  start_cpu_time = time.process_time()
+
+  if mode == "tasks":
+    tasks = [asyncio.async(green.coroutine(run_via_tasks)(behavior))
+             for behavior in all_behaviors]
+  else:
+    behavior_scheduler = scheduler.BehaviorScheduler(
+        BenchmarkServer(), config.tick_rate, config.tick_budget)
+    for behavior in all_behaviors:
+      behavior_scheduler.add(behavior)
+    tasks = [asyncio.async(green.coroutine(behavior_scheduler.run)())]
+
+  yield from asyncio.sleep(config.duration)
+
+  cpu_time = time.process_time() - start_cpu_time
+  elapsed = time.perf_counter() - start_time
+
+  for behavior in all_behaviors:
+    behavior.stop()
+  for task in tasks:
+    task.cancel()
+  yield from asyncio.wait(tasks)
+
+  return (cpu_time / elapsed,
+          sum(behavior.updates for behavior in all_behaviors) / elapsed)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Benchmark the CPU used by running behaviors in a task and "
+                  "greenlet each, or from a single behavior scheduler.")
+  parser.add_argument("--behaviors", action="store", default=10000, type=int,
+                      help="Number of behaviors.")
+  parser.add_argument("--intervals", action="store", nargs="+",
+                      default=[0.5], type=float,
+                      help="Seconds between updates of busy behaviors to "
+                           "measure, as well as idle ones.")
+  parser.add_argument("--duration", action="store", default=3, type=float,
+                      help="Seconds to run each measurement for.")
+  parser.add_argument("--tick-rate", action="store", default=20, type=float,
+                      help="Number of scheduler ticks per second.")
+  parser.add_argument("--tick-budget", action="store", default=0.02,
+                      type=float,
+                      help="Seconds each scheduler tick may spend.")
+  config = parser.parse_args()
+
+  loop = asyncio.get_event_loop()
+
+  print("{} behaviors".format(config.behaviors))
+  print("{:>10} {:>10} {:>8} {:>14}".format("interval", "mode", "CPU %",
+                                            "updates per s"))
+
+  for interval in [None] + config.intervals:
+    for mode in ["tasks", "scheduler"]:
+      cpu, updates = loop.run_until_complete(measure(config, mode, interval))
+      print("{:>10} {:>10} {:>8.1f} {:>14.0f}".format(
+          "idle" if interval is None else interval, mode, cpu * 100,
+          updates))
+
+
+if __name__ == "__main__":
+  main()
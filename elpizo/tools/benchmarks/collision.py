@@ -0,0 +1,90 @@
+import argparse
+import random
+import timeit
+
+from elpizo.client.npc_server import store
+from elpizo.models import entities
+from elpizo.models import geometry
+from elpizo.models import realm
+
+
+def make_world(num_drops):
+  s = store.Store()
+
+  r = realm.Realm(id=1, name="Benchmark", size=geometry.Vector2(
+      realm.Region.SIZE, realm.Region.SIZE))
+  s.realms.add(r)
+
+  region = realm.Region(
+      location=geometry.Vector2(0, 0), layers=[],
+      passabilities=[0b1111] * (realm.Region.SIZE * realm.Region.SIZE),
+      entities=set())
+  region.update(realm=r)
+  r.regions.add(region)
+
+  for id in range(num_drops):
+    drop = entities.Drop(
+        id=id, realm_id=r.id, item=None,
+        location=geometry.Vector3(random.randrange(realm.Region.SIZE),
+                                  random.randrange(realm.Region.SIZE), 0))
+    s.entities.add(drop)
+    region.add_entity(drop)
+
+  mover = entities.Player(id=num_drops, realm_id=r.id, direction=3,
+                          location=geometry.Vector3(0, 0, 0))
+  s.entities.add(mover)
+  region.add_entity(mover)
+
+  return r, region, mover
+
+
+def is_unobstructed_linear(region, entity, bounds, direction):
+  # The collision check before the occupancy grid: scan every entity in the
+  # region.
+  return not any(target.bounds.intersects(bounds) and
+                 not target.is_passable_by(entity, direction)
+                 for target in region.entities)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Benchmark collision checks in a region full of drops.")
+  parser.add_argument("--drops", action="store", default=1000, type=int,
+                      help="Number of drops in the region.")
+  parser.add_argument("--number", action="store", default=2000, type=int,
+                      help="Number of checks per measurement.")
+  args = parser.parse_args()
+
+  r, region, mover = make_world(args.drops)
+  bounds = mover.bbox.offset(mover.target_location)
+
+  # Build the occupancy grid outside of the measurement.
+  region.occupancy
+
+  linear = timeit.timeit(
+      lambda: is_unobstructed_linear(region, mover, bounds, mover.direction),
+      number=args.number) / args.number
+  grid = timeit.timeit(
+      lambda: region.is_unobstructed_for(mover, bounds, mover.direction),
+      number=args.number) / args.number
+  full = timeit.timeit(
+      lambda: r.is_passable_by(mover, bounds, mover.direction),
+      number=args.number) / args.number
+
+  def move():
+    with mover.movement():
+      mover.location = geometry.Vector3(random.randrange(realm.Region.SIZE),
+                                        random.randrange(realm.Region.SIZE),
+                                        0)
+  movement = timeit.timeit(move, number=args.number) / args.number
+
+  print("drops in region:               {}".format(args.drops))
+  print("linear scan:                   {:.2f}us".format(linear * 1e6))
+  print("occupancy grid:                {:.2f}us ({:.1f}x)".format(
+      grid * 1e6, linear / grid))
+  print("Realm.is_passable_by:          {:.2f}us".format(full * 1e6))
+  print("movement (grid update):        {:.2f}us".format(movement * 1e6))
+
+
+if __name__ == "__main__":
+  main()
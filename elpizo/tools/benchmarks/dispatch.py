@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+import gc
+import statsd
+import time
+import tracemalloc
+
+from elpizo.protos import packets_pb2
+from elpizo.server import handlers
+from elpizo.util import green
+from elpizo.util import net
+
+
+class PipeEnd(object):
+  """
+  One end of an in-memory websocket, so that only the cost of running
+  connections is measured, rather than that of the network.
+  """
+
+  def __init__(self):
+    self.queue = asyncio.Queue()
+    self.peer = None
+    self.open = True
+
+  @asyncio.coroutine
+  def send(self, packet):
+    self.peer.queue.put_nowait(packet)
+
+  @asyncio.coroutine
+  def recv(self):
+    return (yield from self.queue.get())
+
+  @asyncio.coroutine
+  def close(self):
+    if self.open:
+      self.open = False
+      self.peer.queue.put_nowait(None)
+      self.queue.put_nowait(None)
+
+
+def make_pipe():
+  a, b = PipeEnd(), PipeEnd()
+  a.peer, b.peer = b, a
+  return a, b
+
+
+class BenchmarkServer(object):
+  """
+  Just enough of a server for a dispatcher to handle ECHO packets.
+  """
+
+  def __init__(self):
+    self.statsd = statsd.StatsClient(prefix="elpizo.benchmarks.dispatch")
+    self.debug = False
+
+  def accept(self, websocket, mode):
+    dispatcher = handlers.Dispatcher(self, net.Transport(websocket))
+
+    if mode == "native":
+      return asyncio.async(dispatcher.run_async())
+    else:
+      return asyncio.async(green.coroutine(dispatcher.run)())
+
+
+class Client(object):
+  def __init__(self, websocket):
+    self.websocket = websocket
+    self.packet = net.Protocol.serialize_packet(
+        None, packets_pb2.EchoPacket(payload="benchmark"))
+
+  @asyncio.coroutine
+  def echo(self, n):
+    """
+    Send ECHO packets all at once, and wait for every reply.
+    """
+    for _ in range(n):
+      yield from self.websocket.send(self.packet)
+
+    for _ in range(n):
+      yield from self.websocket.recv()
+
+
+@asyncio.coroutine
+def measure(config, mode):
+  server = BenchmarkServer()
+
+  gc.collect()
+  tracemalloc.start()
+  start_memory, _ = tracemalloc.get_traced_memory()
+
+  clients = []
+  tasks = []
+
+  for _ in range(config.connections):
+    client_end, server_end = make_pipe()
+    tasks.append(server.accept(server_end, mode))
+    clients.append(Client(client_end))
+
+  # A round trip on every connection, so that they're all up and waiting.
+  yield from asyncio.wait([asyncio.async(client.echo(1))
+                           for client in clients])
+
+  gc.collect()
+  end_memory, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  start_time = time.perf_counter()
+  yield from asyncio.wait([asyncio.async(client.echo(config.packets))
+                           for client in clients])
+  elapsed = time.perf_counter() - start_time
+
+  for client in clients:
+    yield from client.websocket.close()
+  yield from asyncio.wait(tasks)
+
+  # Give the writers a chance to finish being cancelled.
+  yield from asyncio.sleep(0)
+
+  return (elapsed / (config.connections * config.packets),
+          (end_memory - start_memory) / config.connections)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Benchmark the per-packet overhead and memory per "
+                  "connection of running connections natively on asyncio, "
+                  "or in greenlets, over in-memory websockets.")
+  parser.add_argument("--connections", action="store", default=1000,
+                      type=int, help="Number of connections.")
+  parser.add_argument("--packets", action="store", default=100, type=int,
+                      help="Number of ECHO packets per connection.")
+  parser.add_argument("--modes", action="store", nargs="+",
+                      default=["native", "green"],
+                      choices=["native", "green"],
+                      help="Handler modes to measure.")
+  config = parser.parse_args()
+
+  loop = asyncio.get_event_loop()
+
+  print("{} connections, {} packets each".format(config.connections,
+                                                 config.packets))
+  print("{:>8} {:>14} {:>18}".format("mode", "us per packet",
+                                     "KiB per connection"))
+
+  for mode in config.modes:
+    per_packet, per_connection = loop.run_until_complete(measure(config, mode))
+    print("{:>8} {:>14.2f} {:>18.2f}".format(mode, per_packet * 1e6,
+                                             per_connection / 1024))
+
+
+if __name__ == "__main__":
+  main()
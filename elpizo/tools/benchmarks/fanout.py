@@ -0,0 +1,54 @@
+import argparse
+import timeit
+
+from elpizo.models import geometry
+from elpizo.protos import packets_pb2
+from elpizo.util import net
+
+
+class NullTransport(object):
+  def send(self, packet, origin=None, packet_type=None):
+    pass
+
+
+def send_per_protocol(protocols, origin, message):
+  for protocol in protocols:
+    protocol.send(origin, message)
+
+
+def send_serialized_once(protocols, origin, message):
+  packet = net.Protocol.serialize_packet(origin, message)
+  for protocol in protocols:
+    protocol.send_packet(packet)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Benchmark broadcasting a MovePacket to many subscribers.")
+  parser.add_argument("--number", action="store", default=1000, type=int,
+                      help="Number of broadcasts per measurement.")
+  parser.add_argument("--subscribers", action="store", nargs="+", type=int,
+                      default=[1, 10, 50, 100, 500],
+                      help="Subscriber counts to measure.")
+  args = parser.parse_args()
+
+  message = packets_pb2.MovePacket(
+      location=geometry.Vector3(10, 20, 0).to_protobuf())
+
+  print("{:>12} {:>16} {:>18} {:>8}".format(
+      "subscribers", "per-protocol us", "serialize-once us", "speedup"))
+
+  for n in args.subscribers:
+    protocols = [net.Protocol(NullTransport()) for _ in range(n)]
+
+    before = timeit.timeit(lambda: send_per_protocol(protocols, 1, message),
+                           number=args.number) / args.number
+    after = timeit.timeit(lambda: send_serialized_once(protocols, 1, message),
+                          number=args.number) / args.number
+
+    print("{:>12} {:>16.2f} {:>18.2f} {:>7.1f}x".format(
+        n, before * 1e6, after * 1e6, before / after))
+
+
+if __name__ == "__main__":
+  main()
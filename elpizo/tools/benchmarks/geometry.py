@@ -0,0 +1,132 @@
+import argparse
+import random
+import timeit
+import tracemalloc
+
+from elpizo.models import geometry
+from elpizo.models import realm
+
+
+class DictVector3(object):
+  # The dict-backed vector used before geometry value types had slots.
+  def __init__(self, x, y, z):
+    self.x = x
+    self.y = y
+    self.z = z
+
+  def map(self, f):
+    return self.__class__(f(self.x), f(self.y), f(self.z))
+
+  def offset(self, other):
+    return self.__class__(self.x + other.x, self.y + other.y, self.z + other.z)
+
+  def __eq__(self, other):
+    return self.x == other.x and self.y == other.y and self.z == other.z
+
+  def __hash__(self):
+    return hash((DictVector3, self.x, self.y, self.z))
+
+
+class DictRectangle(object):
+  # The dict-backed rectangle used before geometry value types had slots.
+  def __init__(self, left, top, width, height):
+    self.left = left
+    self.top = top
+    self.width = width
+    self.height = height
+
+  @property
+  def right(self):
+    return self.left + self.width
+
+  @property
+  def bottom(self):
+    return self.top + self.height
+
+  def intersects(self, other):
+    return self.left < other.right and self.right > other.left and \
+           self.top < other.bottom and self.bottom > other.top
+
+  def contains(self, other):
+    return self.left <= other.left and self.right >= other.right and \
+           self.top <= other.top and self.bottom >= other.bottom
+
+  def offset(self, vec):
+    return self.__class__(self.left + vec.x, self.top + vec.y,
+                          self.width, self.height)
+
+
+def move_storm(vector_type, rectangle_type, num_actors, num_moves):
+  """
+  Simulate the geometry work of a burst of MOVE packets: computing target
+  locations and bounds, checking realm containment, finding the closest region
+  and checking collisions against nearby actors.
+  """
+  directions = [vector_type(*v) for v in [(0, -1, 0), (-1, 0, 0), (0, 1, 0),
+                                          (1, 0, 0)]]
+  realm_bounds = rectangle_type(0, 0, 128, 128)
+  bbox = rectangle_type(0, 0, 1, 1)
+
+  locations = [vector_type(random.randrange(128), random.randrange(128), 0)
+               for _ in range(num_actors)]
+
+  regions_seen = {}
+
+  for i in range(num_moves):
+    actor = i % num_actors
+    location = locations[actor].offset(directions[i % len(directions)])
+    bounds = bbox.offset(location)
+
+    if not realm_bounds.contains(bounds):
+      continue
+
+    region_location = location.map(realm.Region.floor)
+    regions_seen[region_location] = regions_seen.get(region_location, 0) + 1
+
+    if any(bbox.offset(locations[(actor + j) % num_actors]).intersects(bounds)
+           for j in range(1, 8)):
+      continue
+
+    locations[actor] = location
+
+  return locations
+
+
+def measure_memory(vector_type, rectangle_type, n):
+  tracemalloc.start()
+  objects = [(vector_type(i, i, 0), rectangle_type(i, i, 1, 1))
+             for i in range(n)]
+  size, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del objects
+  return size / n
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Benchmark geometry value types under a storm of moves.")
+  parser.add_argument("--actors", action="store", default=300, type=int,
+                      help="Number of actors moving.")
+  parser.add_argument("--moves", action="store", default=100000, type=int,
+                      help="Number of moves per measurement.")
+  parser.add_argument("--repeat", action="store", default=3, type=int,
+                      help="Number of measurements to take the best of.")
+  args = parser.parse_args()
+
+  for name, vector_type, rectangle_type in [
+      ("before (dict-backed)", DictVector3, DictRectangle),
+      ("after (slots)", geometry.Vector3, geometry.Rectangle)]:
+    random.seed(0)
+    elapsed = min(timeit.repeat(
+        lambda: move_storm(vector_type, rectangle_type, args.actors,
+                           args.moves),
+        number=1, repeat=args.repeat))
+    memory = measure_memory(vector_type, rectangle_type, 10000)
+
+    print("{:<22} {:>8.1f}ms per {} moves, {:>6.1f} bytes per "
+          "vector + rectangle".format(name, elapsed * 1000, args.moves,
+                                      memory))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import greenlet
+import time
+
+from elpizo.util import green
+
+
+def await_coro_via_task(coro):
+  # How green.await_coro used to wait: always as a task, always switching
+  # greenlets.
+  fut = asyncio.async(coro)
+  greenlet.getcurrent().parent.switch(fut)
+  return fut.result()
+
+
+@asyncio.coroutine
+def cache_hit():
+  return 1
+
+
+def measure(f, number):
+  start_time = time.perf_counter()
+  for _ in range(number):
+    f()
+  return (time.perf_counter() - start_time) / number
+
+
+def run(config):
+  lock = asyncio.Lock()
+  done = asyncio.Future()
+  done.set_result(1)
+
+  def lock_via_task():
+    await_coro_via_task(lock.acquire())
+    lock.release()
+
+  def lock_inline():
+    with green.locking(lock):
+      pass
+
+  cases = [
+      ("completed coroutine",
+       lambda: await_coro_via_task(cache_hit()),
+       lambda: green.await_coro(cache_hit())),
+      ("completed future",
+       lambda: await_coro_via_task(done),
+       lambda: green.await_coro(done)),
+      ("uncontended lock",
+       lock_via_task,
+       lock_inline),
+  ]
+
+  print("{:>20} {:>12} {:>12} {:>8}".format("", "via task us", "inline us",
+                                            "speedup"))
+
+  for name, before, after in cases:
+    before_time = measure(before, config.number)
+    after_time = measure(after, config.number)
+
+    print("{:>20} {:>12.2f} {:>12.2f} {:>7.1f}x".format(
+        name, before_time * 1e6, after_time * 1e6, before_time / after_time))
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Benchmark waiting in a greenlet on coroutines and futures "
+                  "that complete without suspending.")
+  parser.add_argument("--number", action="store", default=100000, type=int,
+                      help="Number of waits per measurement.")
+  config = parser.parse_args()
+
+  asyncio.get_event_loop().run_until_complete(green.coroutine(run)(config))
+
+
+if __name__ == "__main__":
+  main()
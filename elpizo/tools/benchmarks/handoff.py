@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import functools
+import io
+import logging
+import math
+import statsd
+import time
+import websockets
+
+from Crypto.PublicKey import RSA
+
+from elpizo.client.npc_server import store
+from elpizo.models import entities
+from elpizo.models import geometry
+from elpizo.models import realm
+from elpizo.models.items import registry
+from elpizo.protos import packets_pb2
+from elpizo.server import bus
+from elpizo.server import handlers
+from elpizo.server import policies
+from elpizo.server import shard
+from elpizo.util import green
+from elpizo.util import mint
+from elpizo.util import net
+
+
+REALM_ID = 1
+
+
+class SharedStore(store.Store):
+  """
+  An in-memory game store, whose tables are shared by every shard in the
+  process, as Redis is shared by every shard of a cluster.
+  """
+
+  def __init__(self, shards, tables):
+    self.shards = shards
+    self.tables = tables
+    self.realms = realm.RealmStore(self, store.DictAdapter(tables["realms"]))
+    self.entities = entities.EntityStore(
+        self, store.DictAdapter(tables["entities"]))
+
+  def make_region_store(self, r):
+    return realm.RegionStore(r, self.entities,
+                             store.DictAdapter(self.tables["regions"]))
+
+  def is_location_owned(self, realm_id, location):
+    return self.shards.is_local_location(realm_id, location)
+
+
+class BenchmarkDispatcher(handlers.Dispatcher):
+  def __init__(self, player_id, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.player_id = player_id
+
+  def on_open(self):
+    super().on_open()
+
+    if self.player_id is not None:
+      # Clients are logged in by their connection path, rather than with a
+      # minted token.
+      policy = policies.PlayerPolicy(self.player_id, self.server)
+      self.bind_policy(policy)
+      policy.on_hello(self)
+
+
+class Shard(object):
+  """
+  A shard, with everything the packet handlers need from a server, but with an
+  in-memory store. Every shard listens on its private port, and on a public
+  port above the private ports of all the shards.
+  """
+
+  def __init__(self, config, index, tables, mint):
+    self.config = config
+    self.mint = mint
+    self.shards = shard.ShardMap(config.num_shards, index, "localhost",
+                                 config.base_port, stripe_width=1,
+                                 num_spare_connections=config.spare_connections)
+    self.bus = bus.Bus()
+    self.store = SharedStore(self.shards, tables)
+    self.statsd = statsd.StatsClient(prefix="elpizo.benchmarks.handoff")
+    self.shard_link = None
+    self.debug = False
+
+  @property
+  def public_port(self):
+    return self.shards.get_port(self.config.num_shards + self.shards.index)
+
+  def is_local_location(self, realm_id, location):
+    return self.shards.is_local_location(realm_id, location)
+
+  def submit(self, f, protocol, *args):
+    f(protocol, *args)
+
+  def listen(self):
+    for port, is_private in [(self.shards.get_port(self.shards.index), True),
+                             (self.public_port, False)]:
+      green.await_coro(websockets.serve(
+          green.coroutine(functools.partial(self.accept,
+                                            is_private=is_private)),
+          "localhost", port))
+
+  def accept(self, websocket, path, is_private):
+    BenchmarkDispatcher(None if is_private else int(path.strip("/")), self,
+                        net.Transport(websocket),
+                        is_private=is_private).run()
+
+
+def make_tables(num_players):
+  tables = {"realms": {}, "regions": {}, "entities": {}}
+
+  # Two regions across, with a row of regions for every 16 players. Shards own
+  # alternate columns of regions, so every player starts next to a boundary.
+  size = geometry.Vector2(
+      realm.Region.SIZE * 2,
+      realm.Region.SIZE * math.ceil(num_players / realm.Region.SIZE))
+
+  tables["realms"][REALM_ID] = realm.RealmStore.serialize(
+      realm.Realm(name="Benchmark", size=size))
+
+  player_ids = {}
+
+  for i in range(num_players):
+    id = i + 1
+    tables["entities"][id] = entities.EntityStore.serialize(entities.Player(
+        name="benchmark{}".format(id), gender="female", body="light",
+        facial=None, hair=None, direction=3, health=10, realm_id=REALM_ID,
+        location=geometry.Vector3(realm.Region.SIZE - 1, i, 0),
+        bbox=geometry.Rectangle(0, 0, 1, 1), inventory=[], head_item=None,
+        torso_item=None, legs_item=None, feet_item=None, weapon=None,
+        online=True))
+    player_ids.setdefault(realm.Region.floor(i), []).append(id)
+
+  for y in range(0, size.y, realm.Region.SIZE):
+    for x in range(0, size.x, realm.Region.SIZE):
+      tables["regions"]["{x},{y}".format(x=x, y=y)] = \
+          realm.RegionStore.serialize(realm.Region(
+              location=geometry.Vector2(x, y), layers=[],
+              passabilities=[0b1111] * (realm.Region.SIZE * realm.Region.SIZE),
+              entity_ids_idx=player_ids.get(y, []) if x == 0 else []))
+
+  return tables
+
+
+def run_client(config, shards, id, results):
+  location = geometry.Vector3(realm.Region.SIZE - 1, id - 1, 0)
+  owner = shards[shards[0].shards.get_shard_for_location(REALM_ID, location)]
+
+  transport = net.Transport(green.await_coro(websockets.connect(
+      "ws://localhost:{port}/{id}".format(port=owner.public_port, id=id))))
+
+  echoes = asyncio.Queue()
+
+  def read():
+    while True:
+      packet = transport.recv()
+      if packet is None:
+        break
+
+      for _, message in net.Protocol.deserialize_packets(packet):
+        if isinstance(message, packets_pb2.EchoPacket):
+          echoes.put_nowait(time.monotonic())
+
+  asyncio.async(green.coroutine(read)())
+
+  def echo(*messages):
+    start_time = time.monotonic()
+    for message in messages + (packets_pb2.EchoPacket(payload=str(id)),):
+      transport.send(net.Protocol.serialize_packet(None, message))
+    return green.await_coro(echoes.get()) - start_time
+
+  # Moves must be spaced out for the server to accept them.
+  move_interval = 1 / entities.Actor.BASE_SPEED
+
+  for i in range(config.crossings):
+    results["baseline"].append(echo())
+
+    # Crossing east hands the player off from the shard the client is connected
+    # to; crossing back hands it off down the relay.
+    direction = 3 if i % 2 == 0 else 1
+    transport.send(net.Protocol.serialize_packet(
+        None, packets_pb2.TurnPacket(direction=direction)))
+    green.await_coro(asyncio.sleep(move_interval))
+
+    location = location.offset(entities.Entity.DIRECTION_VECTORS[direction])
+    results["direct" if i % 2 == 0 else "relayed"].append(
+        echo(packets_pb2.MovePacket(location=location.to_protobuf())))
+    green.await_coro(asyncio.sleep(move_interval))
+
+  transport.close()
+
+
+def percentile(samples, p):
+  return samples[min([int(len(samples) * p), len(samples) - 1])]
+
+
+def run(config):
+  tables = make_tables(config.clients)
+
+  # Shards sign handoffs, so they share a private mint key.
+  shard_mint = mint.Mint(io.BytesIO(RSA.generate(2048).exportKey()))
+
+  shards = [Shard(config, index, tables, shard_mint)
+            for index in range(config.num_shards)]
+
+  for s in shards:
+    s.listen()
+
+  for s in shards:
+    s.shards.warm()
+
+  results = {"baseline": [], "direct": [], "relayed": []}
+
+  tasks = [asyncio.async(green.coroutine(run_client)(config, shards, id,
+                                                     results))
+           for id in range(1, config.clients + 1)]
+  green.await_coro(asyncio.wait(tasks))
+
+  for task in tasks:
+    task.result()
+
+  baseline = sorted(results["baseline"])[len(results["baseline"]) // 2]
+
+  print("{} clients, {} crossings each".format(config.clients,
+                                               config.crossings))
+  print("{:<10} {:>8} {:>8} {:>8} {:>8}   (round trip, ms)".format(
+      "", "p50", "p95", "p99", "max"))
+
+  worst = 0
+  for name in ["baseline", "direct", "relayed"]:
+    samples = sorted(results[name])
+    print("{:<10} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f}".format(
+        name, *[percentile(samples, p) * 1000 for p in [0.5, 0.95, 0.99, 1]]))
+
+    if name != "baseline":
+      worst = max([worst, percentile(samples, 0.99) - baseline])
+
+  print("p99 latency added by a handoff: {:.2f}ms".format(worst * 1000))
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Load test handing players off between shards, over "
+                  "websockets on localhost.")
+  parser.add_argument("--clients", action="store", default=100, type=int,
+                      help="Number of players crossing boundaries at once.")
+  parser.add_argument("--crossings", action="store", default=20, type=int,
+                      help="Number of boundary crossings per player.")
+  parser.add_argument("--num-shards", action="store", default=2, type=int,
+                      help="Number of shards.")
+  parser.add_argument("--base-port", action="store", default=9100, type=int,
+                      help="Private port of the first shard.")
+  parser.add_argument("--spare-connections", action="store", default=4,
+                      type=int,
+                      help="Number of connections each shard keeps open to "
+                           "every other shard.")
+  parser.add_argument("--batch-interval", action="store", default=0,
+                      type=float,
+                      help="Batch interval of the shards, which handed off "
+                           "sessions keep.")
+  parser.add_argument("--max-batch-size", action="store", default=8192,
+                      type=int, help="Maximum batch size of the shards.")
+  config = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARN)
+  registry.initialize()
+
+  asyncio.get_event_loop().run_until_complete(
+      green.coroutine(run)(config))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,362 @@
+import argparse
+import networkx
+import random
+import time
+
+from elpizo.client.npc_server import pathfinding
+from elpizo.models import entities
+from elpizo.models import geometry
+from elpizo.models import realm
+
+
+def make_obstacles(size, obstacle_rate, layout):
+  if layout == "noise":
+    return {(x, y) for y in range(size) for x in range(size)
+            if random.random() < obstacle_rate}
+
+  # Patches of impassable terrain, like water or buildings.
+  obstacles = set()
+  while len(obstacles) < obstacle_rate * size * size:
+    left = random.randrange(size)
+    top = random.randrange(size)
+    obstacles.update((x, y)
+                     for y in range(top, min([top + random.randint(1, 8),
+                                              size]))
+                     for x in range(left, min([left + random.randint(1, 8),
+                                               size])))
+  return obstacles
+
+
+def make_world(num_regions, obstacle_rate, layout):
+  size = num_regions * realm.Region.SIZE
+  r = realm.Realm(id=1, name="Benchmark", size=geometry.Vector2(size, size))
+  obstacles = make_obstacles(size, obstacle_rate, layout)
+
+  regions = []
+  for y in range(0, size, realm.Region.SIZE):
+    for x in range(0, size, realm.Region.SIZE):
+      regions.append(realm.Region(
+          location=geometry.Vector2(x, y), layers=[],
+          passabilities=[0b0000 if (x + i, y + j) in obstacles else 0b1111
+                         for j in range(realm.Region.SIZE)
+                         for i in range(realm.Region.SIZE)]))
+
+  r.region_mosaic = {(region.location.x, region.location.y): region
+                     for region in regions}
+  return r, regions
+
+
+def compute_path_graph(region):
+  # How the NPC server used to ingest a region: a graph over the region and a
+  # ring of tiles around it.
+  g = networkx.DiGraph()
+
+  for y in range(region.location.y - 1,
+                 region.location.y + realm.Region.SIZE + 1):
+    for x in range(region.location.x - 1,
+                   region.location.x + realm.Region.SIZE + 1):
+      origin = geometry.Vector2(x, y)
+
+      for direction, delta in entities.Entity.DIRECTION_VECTORS.items():
+        target = origin.offset(delta)
+        if region.is_terrain_passable_by(
+            None,
+            geometry.Rectangle(target.x, target.y, 1, 1),
+            direction):
+          g.add_edge(origin, target)
+
+  return g
+
+
+def ingest_graph(regions):
+  g = networkx.DiGraph()
+
+  for region in regions:
+    # Drop the decoded passabilities, as a freshly received region has none.
+    region.mark_terrain_changed()
+    region_graph = compute_path_graph(region)
+    g.add_nodes_from(region_graph.nodes())
+    g.add_edges_from(region_graph.edges())
+
+  return g
+
+
+def ingest_grid(r, regions):
+  grid = pathfinding.PathGrid(r.size)
+
+  for region in regions:
+    region.mark_terrain_changed()
+    grid.add_region(region)
+
+  return grid
+
+
+def ingest_planner(r, regions):
+  grid = pathfinding.PathGrid(r.size)
+  planner = pathfinding.PathPlanner(grid)
+
+  for region in regions:
+    region.mark_terrain_changed()
+    grid.add_region(region)
+    planner.update_region(region.location)
+
+  return planner
+
+
+def make_reference_graph(r):
+  # The old graph also had unconditional edges out of every region, so paths
+  # are checked against a graph where only the tile moved into decides, as in
+  # the grid.
+  g = networkx.DiGraph()
+
+  for y in range(r.size.y):
+    for x in range(r.size.x):
+      origin = geometry.Vector2(x, y)
+      g.add_node(origin)
+
+      for direction, delta in entities.Entity.DIRECTION_VECTORS.items():
+        target = origin.offset(delta)
+        if r.is_tile_terrain_passable(target.x, target.y, direction):
+          g.add_edge(origin, target)
+
+  return g
+
+
+def manhattan(a, b):
+  return abs(a.x - b.x) + abs(a.y - b.y)
+
+
+def is_open(grid, location):
+  # Whether a tile can be both entered and left, so that walks from it can't
+  # get stuck.
+  index = location.y * grid.width + location.x
+  return grid.exits[index] and \
+         any(passable[index] for passable in grid.passable)
+
+
+def make_pursuits(grid, num_targets, pursuers_per_target, num_steps):
+  """
+  Make the locations of targets random walking for a number of steps, and of
+  pursuers of each starting nearby.
+  """
+  pursuits = []
+
+  while len(pursuits) < num_targets:
+    target = geometry.Vector2(random.randrange(grid.width),
+                              random.randrange(grid.height))
+    if not is_open(grid, target):
+      continue
+
+    pursuers = []
+    while len(pursuers) < pursuers_per_target:
+      pursuer = geometry.Vector2(
+          min([max([target.x + random.randint(-16, 16), 0]),
+               grid.width - 1]),
+          min([max([target.y + random.randint(-16, 16), 0]),
+               grid.height - 1]))
+      if is_open(grid, pursuer):
+        pursuers.append(pursuer)
+
+    targets = [target]
+    for _ in range(num_steps):
+      direction = random.choice([direction for direction in range(4)
+                                 if grid.can_move(target, direction)])
+      target = target.offset(entities.Entity.DIRECTION_VECTORS[direction])
+      targets.append(target)
+
+    pursuits.append((pursuers, targets))
+
+  return pursuits
+
+
+def pursue(planner, pursuits, mode, flow_fields=None):
+  """
+  Step pursuers towards their targets, each target taking a step every other
+  step of its pursuers. Each step is found by replanning ("uncached"), along
+  cached paths ("cached"), or from shared flow fields falling back to cached
+  paths ("shared").
+
+  :returns: The number of steps asked for.
+  """
+  w = planner.grid.width
+  queries = 0
+
+  for pursuers, targets in pursuits:
+    pursuers = list(pursuers)
+    path_caches = [pathfinding.PathCache() for _ in pursuers]
+
+    for i in range(len(targets) * 2):
+      target = targets[i // 2]
+
+      for j, pursuer in enumerate(pursuers):
+        if pursuer == target:
+          continue
+
+        queries += 1
+        index = None
+
+        if mode == "uncached":
+          path = planner.find_path(pursuer, target)
+          if path is not None:
+            index = path[1]
+        else:
+          if mode == "shared":
+            field = flow_fields.get_field(target)
+            if field is not None:
+              index = field.get_next_step(pursuer.y * w + pursuer.x)
+
+          if index is None:
+            index = path_caches[j].get_next_step(planner, pursuer, target)
+
+        if index is not None:
+          pursuers[j] = geometry.Vector2(index % w, index // w)
+
+  return queries
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Benchmark region ingestion and path queries of the grid "
+                  "pathfinder and the hierarchical path planner against the "
+                  "networkx path graph they replaced.")
+  parser.add_argument("--regions", action="store", default=8, type=int,
+                      help="Width of the realm, in regions.")
+  parser.add_argument("--obstacles", action="store", default=0.2, type=float,
+                      help="Fraction of impassable tiles.")
+  parser.add_argument("--layout", action="store", default="patches",
+                      choices=["patches", "noise"],
+                      help="Whether impassable tiles come in patches, or are "
+                           "scattered individually.")
+  parser.add_argument("--queries", action="store", default=200, type=int,
+                      help="Number of path queries.")
+  parser.add_argument("--pursuit-targets", action="store", default=20,
+                      type=int,
+                      help="Number of random walking targets to pursue.")
+  parser.add_argument("--pursuers-per-target", action="store", nargs="+",
+                      default=[1, 4, 16, 64], type=int,
+                      help="Numbers of pursuers per target to measure.")
+  parser.add_argument("--pursuit-steps", action="store", default=50, type=int,
+                      help="Number of steps each target takes.")
+  parser.add_argument("--flow-field-radius", action="store", default=16,
+                      type=int,
+                      help="Radius of flow fields around targets.")
+  parser.add_argument("--seed", action="store", default=0, type=int,
+                      help="Random seed.")
+  args = parser.parse_args()
+
+  random.seed(args.seed)
+  r, regions = make_world(args.regions, args.obstacles,
+                                 args.layout)
+
+  start_time = time.perf_counter()
+  ingest_graph(regions)
+  graph_ingestion = (time.perf_counter() - start_time) / len(regions)
+
+  start_time = time.perf_counter()
+  grid = ingest_grid(r, regions)
+  grid_ingestion = (time.perf_counter() - start_time) / len(regions)
+
+  start_time = time.perf_counter()
+  planner = ingest_planner(r, regions)
+  planner_ingestion = (time.perf_counter() - start_time) / len(regions)
+
+  reference = make_reference_graph(r)
+  queries = [(geometry.Vector2(random.randrange(r.size.x),
+                               random.randrange(r.size.y)),
+              geometry.Vector2(random.randrange(r.size.x),
+                               random.randrange(r.size.y)))
+             for _ in range(args.queries)]
+
+  # Queries are timed one by one, so that those with and without a path can be
+  # told apart: without one, A* searches everywhere it can reach.
+  graph_paths = []
+  graph_times = []
+  for start, goal in queries:
+    start_time = time.perf_counter()
+    try:
+      graph_paths.append(networkx.astar_path(reference, start, goal,
+                                             manhattan))
+    except networkx.NetworkXNoPath:
+      graph_paths.append(None)
+    graph_times.append(time.perf_counter() - start_time)
+
+  grid_paths = []
+  grid_times = []
+  for start, goal in queries:
+    start_time = time.perf_counter()
+    grid_paths.append(grid.find_path(start, goal))
+    grid_times.append(time.perf_counter() - start_time)
+
+  planner_paths = []
+  planner_times = []
+  for start, goal in queries:
+    start_time = time.perf_counter()
+    planner_paths.append(planner.find_path(start, goal))
+    planner_times.append(time.perf_counter() - start_time)
+
+  # Both find shortest paths, but may break ties between them differently. The
+  # planner's paths may be longer.
+  extra_steps = 0
+  for (start, goal), graph_path, grid_path, planner_path in zip(
+      queries, graph_paths, grid_paths, planner_paths):
+    if (graph_path is None) != (grid_path is None) or \
+       (graph_path is None) != (planner_path is None) or \
+       (graph_path is not None and len(graph_path) != len(grid_path)):
+      raise AssertionError("Paths from {!r} to {!r} differ: {!r}, {!r}, "
+                           "{!r}".format(start, goal, graph_path, grid_path,
+                                         planner_path))
+
+    if planner_path is not None:
+      extra_steps += len(planner_path) - len(grid_path)
+
+  print("realm:                         {0}x{0} tiles".format(r.size.x))
+  print("ingestion (networkx):          {:.2f}us per region".format(
+      graph_ingestion * 1e6))
+  print("ingestion (grid):              {:.2f}us per region ({:.1f}x)".format(
+      grid_ingestion * 1e6, graph_ingestion / grid_ingestion))
+  print("ingestion (hierarchical):      {:.2f}us per region ({:.1f}x)".format(
+      planner_ingestion * 1e6, graph_ingestion / planner_ingestion))
+  print("hierarchical path lengths:     {:.2f}% longer".format(
+      extra_steps / max([sum(len(path) - 1 for path in grid_paths
+                             if path is not None), 1]) * 100))
+
+  for name, found in [("all", None), ("with a path", True),
+                      ("without a path", False)]:
+    selected = [times for path, *times in zip(grid_paths, graph_times,
+                                              grid_times, planner_times)
+                if found is None or (path is not None) == found]
+    if not selected:
+      continue
+
+    graph_query, grid_query, planner_query = [
+        sum(column) / len(selected) for column in zip(*selected)]
+
+    print("queries {}: {}".format(name, len(selected)))
+    print("  networkx:                    {:.2f}us".format(graph_query * 1e6))
+    print("  grid:                        {:.2f}us ({:.1f}x)".format(
+        grid_query * 1e6, graph_query / grid_query))
+    print("  hierarchical:                {:.2f}us ({:.1f}x)".format(
+        planner_query * 1e6, graph_query / planner_query))
+
+  print("pursuit steps, {} targets, {} steps each:".format(
+      args.pursuit_targets, args.pursuit_steps))
+  print("{:>12} {:>14} {:>14} {:>14}".format(
+      "pursuers", "uncached us", "cached us", "shared us"))
+
+  for pursuers_per_target in args.pursuers_per_target:
+    pursuits = make_pursuits(grid, args.pursuit_targets, pursuers_per_target,
+                             args.pursuit_steps)
+    flow_fields = pathfinding.FlowFields(grid, args.flow_field_radius,
+                                         args.pursuit_targets)
+
+    step_times = []
+    for mode in ["uncached", "cached", "shared"]:
+      start_time = time.perf_counter()
+      queries = pursue(planner, pursuits, mode, flow_fields)
+      step_times.append((time.perf_counter() - start_time) / queries)
+
+    print("{:>12} {:>14.2f} {:>14.2f} {:>14.2f}".format(
+        pursuers_per_target, *[step_time * 1e6 for step_time in step_times]))
+
+if __name__ == "__main__":
+  main()
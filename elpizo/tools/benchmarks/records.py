@@ -0,0 +1,85 @@
+import argparse
+import timeit
+
+from elpizo.models import entities
+from elpizo.models import geometry
+from elpizo.models import record
+from elpizo.models.items import registry
+from elpizo.models.items import restorative
+from elpizo.models.items.equipment import torso_items
+from elpizo.models.items.equipment import weapons
+
+
+def interpreted_to_protobuf(record_):
+  # The per-field interpreter used before serializers were compiled.
+  proto = record_.PROTOBUF_TYPE()
+
+  for superclass in record_.__class__.__mro__:
+    if not issubclass(superclass, record.ProtobufRecord):
+      break
+
+    for field in superclass.FIELDS:
+      field.serialize_to(proto, record_)
+
+  return proto
+
+
+def interpreted_from_protobuf(cls, proto):
+  record_ = cls()
+
+  for superclass in cls.__mro__:
+    if not issubclass(superclass, record.ProtobufRecord):
+      break
+
+    for field in superclass.FIELDS:
+      field.deserialize_to(record_, proto)
+
+  return record_
+
+
+def make_player(inventory_size):
+  return entities.Player(
+      realm_id=1, location=geometry.Vector3(10, 20, 0),
+      bbox=geometry.Rectangle(0, 0, 1, 1), direction=2, name="benchmark",
+      health=100, gender="female", body="light", facial=None, hair="brown",
+      inventory=[restorative.Carrot(id=i) for i in range(inventory_size)],
+      head_item=None, torso_item=torso_items.WhiteLongsleeveShirt(id=1000),
+      legs_item=None, feet_item=None, weapon=weapons.Dagger(id=1001),
+      online=True)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Benchmark round-tripping an actor through protobufs.")
+  parser.add_argument("--inventory-size", action="store", default=10,
+                      type=int, help="Number of items in the inventory.")
+  parser.add_argument("--number", action="store", default=10000, type=int,
+                      help="Number of round trips per measurement.")
+  parser.add_argument("--repeat", action="store", default=3, type=int,
+                      help="Number of measurements to take the best of.")
+  args = parser.parse_args()
+
+  registry.initialize()
+  player = make_player(args.inventory_size)
+  serialized = player.to_protobuf().SerializeToString()
+
+  assert interpreted_to_protobuf(player).SerializeToString() == serialized
+
+  for name, to_protobuf, from_protobuf in [
+      ("before (interpreted)", interpreted_to_protobuf,
+       lambda proto: interpreted_from_protobuf(entities.Player, proto)),
+      ("after (compiled)", entities.Player.to_protobuf,
+       entities.Player.from_protobuf)]:
+    def round_trip():
+      from_protobuf(entities.Player.PROTOBUF_TYPE.FromString(
+          to_protobuf(player).SerializeToString()))
+
+    elapsed = min(timeit.repeat(round_trip, number=args.number,
+                                repeat=args.repeat))
+
+    print("{:<22} {:>8.1f}us per round trip, {:>8.0f} round trips/s".format(
+        name, elapsed / args.number * 1000000, args.number / elapsed))
+
+
+if __name__ == "__main__":
+  main()
@@ -18,7 +18,8 @@ class ClientShellProtocol(net.Protocol):
 
   def on_open(self):
     logger.info("Client protocol opened.")
-    self.send(None, packets_pb2.HelloPacket(token=self.token))
+    self.send(None, packets_pb2.HelloPacket(token=self.token,
+                                            supports_batching=True))
 
   def on_close(self):
     logger.info("Client protocol closed.")
@@ -1,6 +1,7 @@
 import logging
 
 from elpizo import server
+from elpizo.server import shard
 from elpizo.server import store
 from elpizo.util import green
 
@@ -13,7 +14,17 @@ def repair(app):
         "Proceeding will BREAK THE LOCK! Press ENTER to continue or Ctrl+C "
         "to abort. ")
 
-  app.store.unlock()
+  lock_keys = [store.GameStore._LOCK_KEY]
+  if app.shards is not None:
+    lock_keys.extend(shard.ShardMap.LOCK_KEY.format(index=index)
+                     for index in range(app.shards.num_shards))
+
+  for lock_key in lock_keys:
+    app.store.lock_key = lock_key
+    app.store.unlock()
+
+  # The repair covers every realm, so it holds the lock of the whole store.
+  app.store.lock_key = store.GameStore._LOCK_KEY
   app.store.lock()
 
   for realm in app.store.realms.load_all():
@@ -25,7 +36,8 @@ def repair(app):
               "Region %r bounds entity %s, but entity's bounds are %r. " +
               "Unlinking entity from region.",
               region.location, entity.id, entity.bounds)
-          region.entities.remove(entity)
+          region.remove_entity(entity)
+          region.mark_dirty()
 
 
 def main():
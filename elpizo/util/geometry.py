@@ -3,6 +3,16 @@ import functools
 
 @functools.total_ordering
 class Vector2(object):
+  """
+  A 2D vector.
+
+  Vectors are immutable value types: their fields must never be assigned to
+  after construction. This lets them be shared freely and their hashes be
+  cached.
+  """
+
+  __slots__ = ("x", "y", "_hash")
+
   def __init__(self, x, y):
     self.x = x
     self.y = y
@@ -17,6 +27,8 @@ class Vector2(object):
     return self.__class__(k * self.x, k * self.y)
 
   def offset(self, other):
+    if other.x == 0 and other.y == 0:
+      return self
     return self.__class__(self.x + other.x, self.y + other.y)
 
   def negate(self):
@@ -31,14 +43,28 @@ class Vector2(object):
     return (self.x, self.y) < (other.x, other.y)
 
   def __repr__(self):
-    return "Vector2({x}, {y})".format(**self.__dict__)
+    return "Vector2({x}, {y})".format(x=self.x, y=self.y)
 
   def __hash__(self):
-    return hash((Vector2, self.x, self.y))
+    try:
+      return self._hash
+    except AttributeError:
+      self._hash = hash((Vector2, self.x, self.y))
+      return self._hash
 
 
 @functools.total_ordering
 class Vector3(object):
+  """
+  A 3D vector.
+
+  Vectors are immutable value types: their fields must never be assigned to
+  after construction. This lets them be shared freely and their hashes be
+  cached.
+  """
+
+  __slots__ = ("x", "y", "z", "_hash")
+
   def __init__(self, x, y, z):
     self.x = x
     self.y = y
@@ -55,6 +81,8 @@ class Vector3(object):
     return self.__class__(k * self.x, k * self.y, k * self.z)
 
   def offset(self, other):
+    if other.x == 0 and other.y == 0 and other.z == 0:
+      return self
     return self.__class__(self.x + other.x, self.y + other.y, self.z + other.z)
 
   def negate(self):
@@ -69,14 +97,28 @@ class Vector3(object):
     return (self.x, self.y, self.z) < (other.x, other.y, other.z)
 
   def __repr__(self):
-    return "Vector3({x}, {y}, {z})".format(**self.__dict__)
+    return "Vector3({x}, {y}, {z})".format(x=self.x, y=self.y, z=self.z)
 
   def __hash__(self):
-    return hash((Vector3, self.x, self.y, self.z))
+    try:
+      return self._hash
+    except AttributeError:
+      self._hash = hash((Vector3, self.x, self.y, self.z))
+      return self._hash
 
 
 @functools.total_ordering
 class Rectangle(object):
+  """
+  An axis-aligned rectangle.
+
+  Rectangles are immutable value types: their fields must never be assigned to
+  after construction. This lets them be shared freely and their hashes be
+  cached.
+  """
+
+  __slots__ = ("left", "top", "width", "height", "_hash")
+
   def __init__(self, left, top, width, height):
     self.left = left
     self.top = top
@@ -100,16 +142,28 @@ class Rectangle(object):
     return Vector2(self.bottom, self.right)
 
   def intersects(self, other):
-    return self.left < other.right and self.right > other.left and \
-           self.top < other.bottom and self.bottom > other.top
+    # This is written out in full rather than with right and bottom, as
+    # property lookups are comparatively slow.
+    return self.left < other.left + other.width and \
+           self.left + self.width > other.left and \
+           self.top < other.top + other.height and \
+           self.top + self.height > other.top
 
   def contains(self, other):
-    return self.left <= other.left and self.right >= other.right and \
-           self.top <= other.top and self.bottom >= other.bottom
+    return self.left <= other.left and \
+           self.left + self.width >= other.left + other.width and \
+           self.top <= other.top and \
+           self.top + self.height >= other.top + other.height
+
+  def contains_point(self, x, y):
+    return self.left <= x < self.left + self.width and \
+           self.top <= y < self.top + self.height
 
   def offset(self, vec):
+    if vec.x == 0 and vec.y == 0:
+      return self
     return self.__class__(self.left + vec.x, self.top + vec.y,
-                     self.width, self.height)
+                          self.width, self.height)
 
   def scale(self, k):
     return self.__class__(self.left, self.top, k * self.width, k * self.height)
@@ -121,11 +175,17 @@ class Rectangle(object):
   def __lt__(self, other):
     # NOTE: This ordering is meaningless and is only used for things such as
     # heap ordering.
-    return (self.left, self.top, self.width. self.height) < \
+    return (self.left, self.top, self.width, self.height) < \
            (other.left, other.top, other.width, other.height)
 
   def __repr__(self):
-    return "Rectangle({left}, {top}, {width}, {height})".format(**self.__dict__)
+    return "Rectangle({left}, {top}, {width}, {height})".format(
+        left=self.left, top=self.top, width=self.width, height=self.height)
 
   def __hash__(self):
-    return hash((Rectangle, self.left, self.top, self.width, self.height))
+    try:
+      return self._hash
+    except AttributeError:
+      self._hash = hash((Rectangle, self.left, self.top, self.width,
+                         self.height))
+      return self._hash
@@ -12,8 +12,10 @@ logger = logging.getLogger(__name__)
 def await(fut):
   """
   Wait for a future to complete. This must be run in a child greenlet of a
-  parent greenlet.
+  parent greenlet, unless the future is already done.
   """
+  if fut.done():
+    return fut.result()
 
   g_self = greenlet.getcurrent()
   assert g_self.parent is not None, "there is no parent greenlet"
@@ -24,9 +26,91 @@ def await(fut):
 
 def await_coro(coro, *, loop=None):
   """
-  Wait for an asyncio coroutine to complete.
+  Wait for an asyncio coroutine (or future) to complete.
+
+  The coroutine is run inline in the current greenlet, rather than as a task
+  of its own, so a coroutine that completes without suspending (e.g. on a cache
+  hit, or acquiring an uncontended lock) returns straight away, without
+  scheduling anything or switching greenlets.
+  """
+  if isinstance(coro, asyncio.Future):
+    return await(coro)
+
+  if not hasattr(coro, "send"):
+    # Some other kind of awaitable, which only a task knows how to run.
+    return await(asyncio.async(coro, loop=loop))
+
+  # Drive the coroutine as a task would: whenever it yields a future, wait for
+  # the future to be done and resume it.
+  error = None
+
+  while True:
+    try:
+      if error is None:
+        fut = coro.send(None)
+      else:
+        fut = coro.throw(error)
+    except StopIteration as e:
+      return e.value
+
+    error = None
+
+    if fut is not None and not isinstance(fut, asyncio.Future):
+      error = RuntimeError("Coroutine yielded a non-future: {!r}".format(fut))
+      continue
+
+    # The future belongs to the coroutine, so we wait on one of our own.
+    waiter = asyncio.Future(loop=loop)
+
+    if fut is None:
+      # A bare yield just lets everything else run for a step.
+      (loop or asyncio.get_event_loop()).call_soon(_wake, waiter, None)
+    else:
+      fut.add_done_callback(functools.partial(_wake, waiter))
+
+    try:
+      await(waiter)
+    except asyncio.CancelledError as e:
+      # We were cancelled while waiting, so the coroutine is too.
+      if fut is not None:
+        fut.cancel()
+      error = e
+
+
+def _wake(waiter, fut):
+  if not waiter.done():
+    waiter.set_result(None)
+
+
+def spawn(f, *args, **kwargs):
   """
-  return await(asyncio.async(coro, loop=loop))
+  Call a function that may wait on IO with `await_coro`. If we're already in a
+  child greenlet, it's called inline. Otherwise, it's started in a greenlet of
+  its own straight away, and the rest of it runs as a task from the first time
+  it waits.
+
+  This is for the native path, where only the rare calls that do wait on IO
+  should pay for a greenlet.
+  """
+  if greenlet.getcurrent().parent is not None:
+    f(*args, **kwargs)
+    return
+
+  g = greenlet.greenlet(f)
+  r = g.switch(*args, **kwargs)
+  if isinstance(r, asyncio.Future):
+    asyncio.async(_resume(g, r))
+
+
+@asyncio.coroutine
+def _resume(g, r):
+  while isinstance(r, asyncio.Future):
+    try:
+      next_r = yield from r
+    except BaseException as e:
+      r = g.throw(e)
+    else:
+      r = g.switch(next_r)
 
 
 def coroutine(f):
@@ -53,6 +137,20 @@ LOCK_WARNING_TIME = 0.5
 
 @contextlib.contextmanager
 def locking(lock, annotation=None):
+  """
+  Hold an asyncio lock for the duration of the block, warning if it takes too
+  long to acquire or is held for too long. Only locks that are contended when
+  acquired are timed, so that the uncontended path costs nothing extra.
+  """
+  if not lock.locked():
+    await_coro(lock.acquire())
+
+    try:
+      yield
+    finally:
+      lock.release()
+    return
+
   start_time = time.time()
   await_coro(lock.acquire())
   critical_section_start_time = time.time()
@@ -1,5 +1,8 @@
+import asyncio
+import collections
 import logging
 import sys
+import websockets
 
 from elpizo.protos import packets_pb2
 from elpizo.util import green
@@ -7,18 +10,282 @@ from elpizo.util import green
 logger = logging.getLogger(__name__)
 
 
+def get_packet_type(message):
+  return message.DESCRIPTOR.GetOptions().Extensions[packets_pb2.packet_type]
+
+
+def peek_packet_type(raw):
+  """
+  Get the type of a serialized packet without deserializing it.
+
+  The type is the first field of a packet, so it can be read straight off the
+  front of the serialized packet.
+
+  :returns: The packet type, or None if the packet doesn't start with it.
+  """
+  if not raw or raw[0] != 0x08:
+    return None
+
+  # The type is a varint, tagged as field 1.
+  value = 0
+  shift = 0
+
+  for b in raw[1:]:
+    value |= (b & 0x7f) << shift
+    if not b & 0x80:
+      return value
+    shift += 7
+
+  return None
+
+
 class Transport(object):
-  def __init__(self, websocket):
+  """
+  A transport over a websocket.
+
+  Packets are sent through an outbound queue, which is drained by a writer task
+  per transport, so sending never blocks on a slow connection. If the queue
+  grows past its maximum size, new packets are dropped or the connection is
+  closed, depending on the overflow policy.
+
+  If batching is enabled, the writer waits a short interval for packets to
+  accumulate and sends them together as a single BATCH packet.
+  """
+
+  DROP = "drop"
+  DISCONNECT = "disconnect"
+
+  # Packets of these types are superseded by the next packet of the same type
+  # from the same origin, so a queued one is replaced if nothing else from its
+  # origin was queued after it.
+  COALESCED_PACKET_TYPES = {packets_pb2.Packet.MOVE, packets_pb2.Packet.TURN}
+
+  # Packets of these types are always sent in a frame of their own, so that the
+  # other end can pick them out without unpacking batches.
+  UNBATCHED_PACKET_TYPES = {packets_pb2.Packet.HANDOFF}
+
+  def __init__(self, websocket, max_queue_size=None,
+               overflow_policy=DISCONNECT):
     self.websocket = websocket
+    self.max_queue_size = max_queue_size
+    self.overflow_policy = overflow_policy
+
+    # Entries are [origin, packet type, packet] lists, so that packets can be
+    # replaced while queued.
+    self.queue = collections.deque()
+    self.queued_bytes = 0
+    self.last_queued = {}
+    self.queue_event = asyncio.Event()
+    self.drained = asyncio.Event()
+    self.drained.set()
+    self.overflowed = False
+
+    self.coalesced = 0
+    self.dropped = 0
+    self.disconnects = 0
+
+    self.batch_interval = None
+    self.max_batch_size = None
+    self.batch_full = asyncio.Event()
+
+    self.writer = asyncio.async(self.run_writer())
+
+  def enable_batching(self, interval, max_size):
+    """
+    Send packets in batches. The other end must be able to unpack them.
+
+    :param interval: The number of seconds to wait for packets to accumulate.
+    :param max_size: The number of bytes of packets after which a batch is sent
+                     without waiting any longer.
+    """
+    self.batch_interval = interval
+    self.max_batch_size = max_size
+
+  def end_batch(self):
+    """
+    Send the packets queued so far without waiting out the batch interval.
+    """
+    if self.queue:
+      self.batch_full.set()
 
   def recv(self):
     return green.await_coro(self.websocket.recv())
 
-  def send(self, packet):
-    green.await_coro(self.websocket.send(packet))
+  @asyncio.coroutine
+  def recv_async(self):
+    return (yield from self.websocket.recv())
+
+  def send(self, packet, origin=None, packet_type=None):
+    """
+    Queue a packet to be sent.
+
+    :param packet: The serialized packet.
+    :param origin: The origin of the packet, if any.
+    :param packet_type: The type of the packet, used for coalescing.
+    """
+    if self.overflowed:
+      self.dropped += 1
+      return
+
+    if origin is not None and packet_type in self.COALESCED_PACKET_TYPES:
+      last_entry = self.last_queued.get(origin)
+
+      if last_entry is not None and last_entry[1] == packet_type:
+        self.queued_bytes += len(packet) - len(last_entry[2])
+        last_entry[2] = packet
+        self.coalesced += 1
+        return
+
+    if self.max_queue_size is not None and \
+       len(self.queue) >= self.max_queue_size:
+      self.on_overflow()
+      return
+
+    entry = [origin, packet_type, packet]
+    self.queue.append(entry)
+    self.queued_bytes += len(packet)
+
+    if origin is not None:
+      self.last_queued[origin] = entry
+
+    self.drained.clear()
+    self.queue_event.set()
+
+    if self.max_batch_size is not None and \
+       self.queued_bytes >= self.max_batch_size:
+      self.batch_full.set()
+
+  def on_overflow(self):
+    self.dropped += 1
+
+    if self.overflow_policy == self.DISCONNECT:
+      logger.warn("Outbound queue overflowed (%d packets), disconnecting.",
+                  len(self.queue))
+
+      self.dropped += len(self.queue)
+      self.disconnects += 1
+      self.overflowed = True
+      self.clear()
+
+      # We may be running on behalf of another connection, so we mustn't wait
+      # for the close to finish.
+      asyncio.async(self.websocket.close())
+
+  def clear(self):
+    self.queue.clear()
+    self.queued_bytes = 0
+    self.last_queued.clear()
+
+  def pop_packet(self):
+    entry = self.queue.popleft()
+    origin, _, packet = entry
+
+    if self.last_queued.get(origin) is entry:
+      del self.last_queued[origin]
+    self.queued_bytes -= len(packet)
+
+    return packet
+
+  @asyncio.coroutine
+  def pop_batch(self):
+    if self.batch_interval is None:
+      return self.pop_packet()
+
+    # Give more packets (and coalescing) a chance to arrive, unless the batch
+    # is already full or has been ended.
+    try:
+      yield from asyncio.wait_for(self.batch_full.wait(), self.batch_interval)
+    except asyncio.TimeoutError:
+      pass
+
+    packets = []
+    size = 0
+
+    while self.queue and size < self.max_batch_size:
+      if self.queue[0][1] in self.UNBATCHED_PACKET_TYPES:
+        if not packets:
+          packets.append(self.pop_packet())
+        break
+
+      packet = self.pop_packet()
+      packets.append(packet)
+      size += len(packet)
+
+    # An unbatched packet left at the front of the queue goes out straight
+    # after this batch.
+    if self.queued_bytes < self.max_batch_size and \
+       not (self.queue and
+            self.queue[0][1] in self.UNBATCHED_PACKET_TYPES):
+      self.batch_full.clear()
+
+    if not packets:
+      # The queue was cleared while we were waiting.
+      return None
+
+    if len(packets) == 1:
+      return packets[0]
+
+    return Protocol.serialize_packet_batch(packets)
+
+  @asyncio.coroutine
+  def run_writer(self):
+    try:
+      while True:
+        if not self.queue:
+          self.drained.set()
+          self.queue_event.clear()
+          yield from self.queue_event.wait()
+          continue
+
+        packet = yield from self.pop_batch()
+
+        if packet is not None:
+          yield from self.websocket.send(packet)
+    except websockets.exceptions.InvalidState:
+      # The connection has gone away, so the reader will clean up.
+      pass
+    finally:
+      self.clear()
+      self.drained.set()
+
+  @property
+  def queue_size(self):
+    return len(self.queue)
+
+  def pop_stats(self):
+    """
+    Get the coalesced, dropped and disconnect counts since the last call, and
+    reset them.
+    """
+    stats = (self.coalesced, self.dropped, self.disconnects)
+    self.coalesced = self.dropped = self.disconnects = 0
+    return stats
+
+  def flush(self):
+    """
+    Wait for all queued packets to be written.
+    """
+    green.await_coro(self.flush_async())
+
+  @asyncio.coroutine
+  def flush_async(self):
+    if not self.writer.done():
+      yield from self.drained.wait()
 
   def close(self):
-    green.await_coro(self.websocket.close())
+    green.await_coro(self.close_async())
+
+  @asyncio.coroutine
+  def close_async(self):
+    """
+    Close the transport, once everything queued has been written. The writer
+    is always stopped, even if the other end closed first.
+    """
+    if self.is_open and not self.overflowed:
+      yield from self.flush_async()
+
+    self.writer.cancel()
+    yield from self.websocket.close()
 
   @property
   def is_open(self):
@@ -28,14 +295,20 @@ class Transport(object):
 class Protocol(object):
   PACKETS = {}
 
+  # Packets of these types from a relay are handled by `on_relay_control`
+  # rather than passed on.
+  RELAY_CONTROL_PACKET_TYPES = set()
+
+  relay = None
+  held_packets = None
+
   def __init__(self, transport):
     self.transport = transport
 
   @classmethod
   def serialize_packet(cls, origin, message):
     packet = packets_pb2.Packet(
-        type=message.DESCRIPTOR.GetOptions().Extensions[
-            packets_pb2.packet_type],
+        type=get_packet_type(message),
         payload=message.SerializeToString())
 
     if origin is not None:
@@ -43,9 +316,39 @@ class Protocol(object):
 
     return packet.SerializeToString()
 
+  @classmethod
+  def serialize_packet_batch(cls, packets):
+    """
+    Serialize already serialized packets into a single BATCH packet.
+    """
+    return packets_pb2.Packet(
+        type=packets_pb2.Packet.BATCH,
+        payload=b"".join(
+            encode_message_field(packets_pb2.PacketBatch, "packets", packet)
+            for packet in packets)).SerializeToString()
+
   @classmethod
   def deserialize_packet(cls, raw):
+    return cls.unpack_packet(packets_pb2.Packet.FromString(raw))
+
+  @classmethod
+  def deserialize_packets(cls, raw):
+    """
+    Deserialize a packet, unpacking it if it is a batch.
+
+    :returns: A list of (origin, message) tuples.
+    """
     packet = packets_pb2.Packet.FromString(raw)
+
+    if packet.type == packets_pb2.Packet.BATCH:
+      return [cls.unpack_packet(batched_packet)
+              for batched_packet
+              in packets_pb2.PacketBatch.FromString(packet.payload).packets]
+
+    return [cls.unpack_packet(packet)]
+
+  @classmethod
+  def unpack_packet(cls, packet):
     return packet.origin if packet.HasField("origin") else None, \
            cls.PACKETS[packet.type].FromString(packet.payload)
 
@@ -58,10 +361,27 @@ class Protocol(object):
   def on_message(self, origin, message):
     pass
 
+  @asyncio.coroutine
+  def on_message_async(self, origin, message):
+    """
+    Handle a message on the native path. By default, `on_message` is run in a
+    greenlet of its own, so that it may wait on IO with `green.await_coro`.
+    """
+    yield from green.coroutine(self.on_message)(origin, message)
+
   def on_error(self, e, exc_info):
     raise e
 
+  def on_relay_control(self, relay, origin, message):
+    pass
+
+  def on_relay_closed(self, relay):
+    pass
+
   def run(self):
+    """
+    Run the protocol in a greenlet, until the transport is closed.
+    """
     self.on_open()
 
     try:
@@ -70,20 +390,206 @@ class Protocol(object):
 
         if packet is None:
           break
-        origin, message = self.deserialize_packet(packet)
-        try:
-          self.on_message(origin, message)
-        except Reject as e:
-          logger.warn("Rejected a packet: %s", e)
+
+        if not self.hold_or_relay(packet):
+          self.handle_packet(packet)
     except Exception as e:
       self.on_error(e, sys.exc_info())
     finally:
-      if self.transport.is_open:
-        self.transport.close()
+      self.transport.close()
+      if self.relay is not None:
+        self.relay.close()
       self.on_close()
 
+  @asyncio.coroutine
+  def run_async(self):
+    """
+    Run the protocol as a native asyncio coroutine, until the transport is
+    closed. Messages are handled by `on_message_async`, and the hooks that
+    `run` calls are run in greenlets of their own.
+    """
+    yield from green.coroutine(self.on_open)()
+
+    try:
+      while True:
+        packet = yield from self.transport.recv_async()
+
+        if packet is None:
+          break
+
+        if not self.hold_or_relay(packet):
+          yield from self.handle_packet_async(packet)
+    except Exception as e:
+      yield from green.coroutine(self.on_error)(e, sys.exc_info())
+    finally:
+      yield from self.transport.close_async()
+      if self.relay is not None:
+        yield from self.relay.close_async()
+      yield from green.coroutine(self.on_close)()
+
+  def hold_or_relay(self, packet):
+    """
+    Hold or relay a packet from the transport if required.
+
+    :returns: Whether the packet was held or relayed, rather than left to be
+              handled.
+    """
+    if self.held_packets is not None and \
+       peek_packet_type(packet) not in self.RELAY_CONTROL_PACKET_TYPES:
+      self.held_packets.append(packet)
+      return True
+
+    if self.relay is not None:
+      # Relayed packets are passed on without being deserialized.
+      self.relay.send(packet)
+      return True
+
+    return False
+
+  def handle_packet(self, packet):
+    for origin, message in self.deserialize_packets(packet):
+      try:
+        self.on_message(origin, message)
+      except Reject as e:
+        logger.warn("Rejected a packet: %s", e)
+
+  @asyncio.coroutine
+  def handle_packet_async(self, packet):
+    for origin, message in self.deserialize_packets(packet):
+      try:
+        yield from self.on_message_async(origin, message)
+      except Reject as e:
+        logger.warn("Rejected a packet: %s", e)
+
+  def hold(self):
+    """
+    Hold on to further packets from the transport, rather than handling or
+    relaying them, until `release` is called. This keeps packets in order while
+    a relay is being set up. Relay control packets are still handled.
+    """
+    if self.held_packets is None:
+      self.held_packets = []
+
+  def release(self, *packets):
+    """
+    Stop holding packets, and handle (or relay) all held packets.
+
+    :param packets: Serialized packets to handle before the held packets.
+    """
+    held_packets = self.take_held()
+
+    for packet in list(packets) + held_packets:
+      if self.held_packets is not None:
+        # Handling a packet started holding packets again.
+        self.held_packets.append(packet)
+      elif self.relay is not None:
+        self.relay.send(packet)
+      else:
+        self.handle_packet(packet)
+
+  def take_held(self):
+    """
+    Stop holding packets, without handling the held packets.
+
+    :returns: The held packets.
+    """
+    held_packets = self.held_packets or []
+    self.held_packets = None
+    return held_packets
+
+  def relay_to(self, transport, *packets):
+    """
+    Relay all further packets between this protocol's transport and another
+    transport, without handling them. Held packets are relayed once released.
+
+    :param transport: The transport to relay to.
+    :param packets: Serialized packets to send to the other transport first.
+    """
+    self.relay = transport
+
+    for packet in packets:
+      self.relay.send(packet)
+
+    asyncio.async(self.run_relay(transport))
+
+  @asyncio.coroutine
+  def run_relay(self, relay):
+    try:
+      while True:
+        packet = yield from relay.recv_async()
+
+        if packet is None:
+          break
+
+        if peek_packet_type(packet) in self.RELAY_CONTROL_PACKET_TYPES:
+          yield from green.coroutine(self.on_relay_control)(
+              relay, *self.deserialize_packet(packet))
+        elif self.relay is relay:
+          self.transport.send(packet)
+    finally:
+      yield from relay.close_async()
+
+      if self.relay is relay:
+        yield from self.transport.close_async()
+      else:
+        # A control packet moved the relay elsewhere.
+        yield from green.coroutine(self.on_relay_closed)(relay)
+
   def send(self, origin, message):
-    self.transport.send(self.serialize_packet(origin, message))
+    self.send_packet(self.serialize_packet(origin, message), origin,
+                     get_packet_type(message))
+
+  def send_packet(self, packet, origin=None, packet_type=None):
+    """
+    Send an already serialized packet. This allows a packet to be serialized
+    once and sent to many protocols.
+    """
+    self.transport.send(packet, origin, packet_type)
+
+
+class SerializedMessage(object):
+  """
+  A message that has already been serialized, e.g. assembled from cached
+  serialized parts. It can be sent anywhere a message can.
+  """
+
+  def __init__(self, message_type, serialized):
+    self.DESCRIPTOR = message_type.DESCRIPTOR
+    self.serialized = serialized
+
+  def SerializeToString(self):
+    return self.serialized
+
+
+def encode_varint(value):
+  encoded = bytearray()
+
+  while value > 0x7f:
+    encoded.append(value & 0x7f | 0x80)
+    value >>= 7
+  encoded.append(value)
+
+  return bytes(encoded)
+
+
+def encode_message_field(message_type, field_name, serialized):
+  """
+  Encode an already serialized message as the named field of a message type.
+
+  Serialized protobuf fields can be concatenated in any order, so the result
+  can be appended to the rest of the serialized message without decoding or
+  re-encoding the embedded message.
+
+  :param message_type: The protobuf type containing the field.
+  :param field_name: The name of the (embedded message) field.
+  :param serialized: The serialized embedded message.
+  :returns: The encoded field.
+  """
+  number = message_type.DESCRIPTOR.fields_by_name[field_name].number
+
+  # Wire type 2 is length-delimited.
+  return encode_varint(number << 3 | 2) + encode_varint(len(serialized)) + \
+         serialized
 
 
 for name, descriptor in packets_pb2.DESCRIPTOR.message_types_by_name.items():
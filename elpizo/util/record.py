@@ -1,3 +1,9 @@
+import asyncio
+import collections
+
+from elpizo.util import green
+
+
 class Record(object):
   """
   An implementation of the active record pattern for a key-value store. The
@@ -5,8 +11,14 @@ class Record(object):
 
   The subclass should also not attempt to deserialize anything to the `id`
   member of the class, as it will be overriden by the ID passed into `find`.
+
+  Records track whether they are dirty, i.e. have changed since they were last
+  loaded or saved. Code that mutates a record in place must call
+  `mark_dirty()` for the change to be picked up by `Store.save_dirty()`.
   """
 
+  is_dirty = False
+
   def __init__(self, id=None, **kwargs):
     """
     A record can be initialized with an ID.
@@ -20,6 +32,19 @@ class Record(object):
     """
     for k, v in kwargs.items():
       setattr(self, k, v)
+    self.mark_dirty()
+
+  def mark_dirty(self):
+    """
+    Mark the record as needing to be written to the key-value store.
+    """
+    self.is_dirty = True
+
+  def mark_clean(self):
+    """
+    Mark the record as in sync with the key-value store.
+    """
+    self.is_dirty = False
 
   @property
   def is_fresh(self):
@@ -27,9 +52,35 @@ class Record(object):
 
 
 class Store(object):
-  def __init__(self, kvs):
+  """
+  A store of records backed by a key-value store, with a cache of loaded
+  records.
+
+  If `max_size` is given, the cache is bounded: when it grows past `max_size`,
+  the least recently used records that aren't pinned (see `is_pinned()`) are
+  saved if dirty and evicted.
+
+  Pinned records that eviction comes across are moved to the most recently
+  used end of the cache, so that later evictions don't look at them again
+  until everything else has.
+
+  Lookups also have native asyncio variants (`find_async`, `load_async`, etc.)
+  for the key-value stores that support them. Records they load are evicted
+  in the background.
+  """
+
+  # The most pinned records an eviction looks past, so that a cache of mostly
+  # pinned records doesn't make every eviction scan all of it.
+  MAX_PINNED_SCAN = 64
+
+  def __init__(self, kvs, max_size=None):
     self.kvs = kvs
-    self.loaded_records = {}
+    self.max_size = max_size
+    self.loaded_records = collections.OrderedDict()
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
 
   @classmethod
   def serialize(cls, record):
@@ -62,6 +113,28 @@ class Store(object):
     """
     return self.deserialize(id, self.kvs.get(id))
 
+  @asyncio.coroutine
+  def find_async(self, id):
+    return self.deserialize(id, (yield from self.kvs.get_async(id)))
+
+  def find_many(self, ids):
+    """
+    Find many records from the key-value store by their IDs, in a single
+    request.
+
+    :param ids: The IDs to find.
+    :returns: A dict of IDs to records. IDs that were not found in the
+              underlying key-value store are omitted.
+    """
+    return {id: self.deserialize(id, serialized)
+            for id, serialized in self.kvs.get_many(ids).items()}
+
+  @asyncio.coroutine
+  def find_many_async(self, ids):
+    return {id: self.deserialize(id, serialized)
+            for id, serialized
+            in (yield from self.kvs.get_many_async(ids)).items()}
+
   def load(self, id):
     """
     Get a record with the given ID from the underlying key-value store.
@@ -71,11 +144,103 @@ class Store(object):
                       store.
     :returns: The record, bound to a key-value store.
     """
-    if id not in self.loaded_records:
-      record = self.find(id)
-      self.add(record)
+    record = self._get_loaded(id)
+    if record is not None:
+      return record
+
+    if self._add_found(id, self.find(id)):
+      self.evict(keep=[id])
+
+    return self.loaded_records[id]
+
+  @asyncio.coroutine
+  def load_async(self, id):
+    record = self._get_loaded(id)
+    if record is not None:
+      return record
+
+    if self._add_found(id, (yield from self.find_async(id))):
+      self.evict_soon(keep=[id])
+
     return self.loaded_records[id]
 
+  def load_many(self, ids, evict=True):
+    """
+    Get many records with the given IDs from the underlying key-value store.
+    Records that aren't already loaded are fetched in a single request.
+
+    :param ids: The IDs to find.
+    :param evict: Whether to evict records from the cache after loading.
+    :throws KeyError: A record was not found in the underlying key-value
+                      store.
+    :returns: A list of records, in the same order as the IDs.
+    """
+    ids = list(ids)
+    missing_ids = self._get_missing(ids)
+
+    if missing_ids:
+      for id, record in self.find_many(missing_ids).items():
+        self._add_found(id, record)
+
+    records = [self.loaded_records[id] for id in ids]
+
+    if missing_ids and evict:
+      self.evict(keep=ids)
+
+    return records
+
+  @asyncio.coroutine
+  def load_many_async(self, ids, evict=True):
+    ids = list(ids)
+    missing_ids = self._get_missing(ids)
+
+    if missing_ids:
+      for id, record in (yield from self.find_many_async(missing_ids)).items():
+        self._add_found(id, record)
+
+    records = [self.loaded_records[id] for id in ids]
+
+    if missing_ids and evict:
+      self.evict_soon(keep=ids)
+
+    return records
+
+  def _get_loaded(self, id):
+    record = self.loaded_records.get(id)
+
+    if record is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+      self.loaded_records.move_to_end(id)
+
+    return record
+
+  def _get_missing(self, ids):
+    missing_ids = []
+
+    for id in ids:
+      if id in self.loaded_records:
+        self.hits += 1
+        self.loaded_records.move_to_end(id)
+      else:
+        self.misses += 1
+        missing_ids.append(id)
+
+    return missing_ids
+
+  def _add_found(self, id, record):
+    # The record may have been loaded by someone else while we were fetching
+    # it.
+    if id in self.loaded_records:
+      return False
+
+    self.add(record)
+    # The record was just read from the key-value store, so there's nothing
+    # to write back.
+    record.mark_clean()
+    return True
+
   def keys(self):
     """
     Get all the persisted keys in the store.
@@ -86,15 +251,42 @@ class Store(object):
     """
     Load all of the store into memory.
     """
-    for key in self.keys():
-      yield self.load(key)
+    return self.load_many(self.keys())
 
   def save(self, record):
     """
     Save a record into the underlying key-value store.
     """
     assert record.id is not None
-    self.kvs.set(record.id, self.serialize(record))
+    # The record is marked clean before it's serialized, such that any writes
+    # made while the save is in flight mark it dirty again.
+    record.mark_clean()
+
+    try:
+      self.kvs.set(record.id, self.serialize(record))
+    except:
+      # It wasn't written, so a later save must retry it.
+      record.mark_dirty()
+      raise
+
+  def save_many(self, records):
+    """
+    Save many records into the underlying key-value store, in a single request.
+    """
+    records = list(records)
+
+    items = []
+    try:
+      for record in records:
+        assert record.id is not None
+        record.mark_clean()
+        items.append((record.id, self.serialize(record)))
+      self.kvs.set_many(items)
+    except:
+      # None of them were written, so a later save must retry them.
+      for record in records:
+        record.mark_dirty()
+      raise
 
   def create(self, record):
     """
@@ -108,13 +300,116 @@ class Store(object):
 
     if record.id not in self.loaded_records:
       self.add(record)
+      self.evict(keep=[record.id])
 
   def save_all(self):
     """
     Save all records contained by this store to the backing key-value store.
     """
-    for record in list(self.loaded_records.values()):
-      self.save(record)
+    self.save_many(list(self.loaded_records.values()))
+
+  @property
+  def dirty_records(self):
+    """
+    All loaded records that have changed since they were last saved.
+    """
+    return [record for record in self.loaded_records.values()
+            if record.is_dirty]
+
+  def save_dirty(self, batch_size=None):
+    """
+    Save only the records contained by this store that are dirty to the backing
+    key-value store, in batches of at most `batch_size` records.
+
+    :returns: The number of records saved.
+    """
+    records = self.dirty_records
+
+    if batch_size is None:
+      batch_size = max([len(records), 1])
+
+    for i in range(0, len(records), batch_size):
+      self.save_many(records[i:i + batch_size])
+
+    return len(records)
+
+  def is_pinned(self, record):
+    """
+    Check if a record is in use and must not be evicted from the cache. It may
+    be overriden by subclasses.
+    """
+    return False
+
+  def evict(self, keep=()):
+    """
+    Evict the least recently used records that aren't pinned from the cache,
+    until it holds at most `max_size` records. Dirty records are saved before
+    they are evicted.
+
+    :param keep: IDs of records not to evict, e.g. those just loaded for the
+                 caller. They're left the most recently used.
+    """
+    if self.max_size is None:
+      return
+
+    excess = len(self.loaded_records) - self.max_size
+    if excess <= 0:
+      return
+
+    keep = set(keep)
+
+    victims = []
+    pinned = []
+    for record in self.loaded_records.values():
+      if len(victims) >= excess or len(pinned) >= self.MAX_PINNED_SCAN:
+        break
+
+      if record.id in keep:
+        continue
+
+      if self.is_pinned(record):
+        pinned.append(record)
+      else:
+        victims.append(record)
+
+    for record in pinned:
+      self.loaded_records.move_to_end(record.id)
+
+    for id in keep:
+      if id in self.loaded_records:
+        self.loaded_records.move_to_end(id)
+
+    dirty_victims = [record for record in victims if record.is_dirty]
+    if dirty_victims:
+      self.save_many(dirty_victims)
+
+    for record in victims:
+      # The record may have been changed, pinned or evicted by someone else
+      # while we were saving it.
+      if record.is_dirty or self.is_pinned(record) or \
+         self.loaded_records.get(record.id) is not record:
+        continue
+
+      self.expire(record)
+      self.evictions += 1
+
+  def evict_soon(self, keep=()):
+    """
+    Evict records in a greenlet of its own, as eviction may need to save them.
+    This is for the native path, which can't wait on the key-value store
+    synchronously.
+    """
+    if self.max_size is not None and len(self.loaded_records) > self.max_size:
+      asyncio.async(green.coroutine(self.evict)(keep))
+
+  def pop_stats(self):
+    """
+    Get the cache hit, miss and eviction counts since the last call, and reset
+    them.
+    """
+    stats = (self.hits, self.misses, self.evictions)
+    self.hits = self.misses = self.evictions = 0
+    return stats
 
   def expire(self, record):
     """
@@ -0,0 +1,63 @@
+import unittest
+
+from elpizo.client.npc_server import store
+from elpizo.util import record
+
+
+class Store(record.Store):
+  def __init__(self, max_size):
+    super().__init__(store.DictAdapter({id: id for id in range(10)}),
+                     max_size)
+    self.pinned_ids = set()
+
+  @classmethod
+  def serialize(cls, r):
+    return r.id
+
+  @classmethod
+  def deserialize(cls, id, serialized):
+    return record.Record(id)
+
+  def is_pinned(self, r):
+    return r.id in self.pinned_ids
+
+
+class EvictTest(unittest.TestCase):
+  def setUp(self):
+    self.store = Store(max_size=2)
+
+  def test_evicts_least_recently_used(self):
+    for id in [1, 2, 3]:
+      self.store.load(id)
+
+    self.assertEqual(list(self.store.loaded_records), [2, 3])
+
+  def test_load_returns_record_when_the_rest_are_pinned(self):
+    self.store.pinned_ids.update([1, 2])
+    self.store.load_many([1, 2])
+
+    self.assertEqual(self.store.load(5).id, 5)
+    self.assertEqual(list(self.store.loaded_records), [1, 2, 5])
+
+  def test_loaded_record_stays_more_recent_than_pinned(self):
+    self.store.pinned_ids.add(1)
+    self.store.load_many([1, 2])
+    self.store.load(3)
+
+    # 2 was the victim, and 3 is left the most recently used, rather than
+    # behind the pinned record.
+    self.assertEqual(list(self.store.loaded_records), [1, 3])
+
+    self.store.load(4)
+    self.assertEqual(list(self.store.loaded_records), [1, 4])
+
+  def test_load_many_returns_records_when_the_rest_are_pinned(self):
+    self.store.pinned_ids.update([1, 2])
+    self.store.load_many([1, 2])
+
+    self.assertEqual([r.id for r in self.store.load_many([5, 6])], [5, 6])
+    self.assertEqual(set(self.store.loaded_records), {1, 2, 5, 6})
+
+
+if __name__ == "__main__":
+  unittest.main()